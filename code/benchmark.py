@@ -0,0 +1,736 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers import BertConfig
+from train_multi import parser as train_parser, build_experts, get_runner, expert_kwargs, BertDataset, Saver
+from checkpoints import CheckpointWriter, load_checkpoint
+from serve import Predictor
+from model.contrast_multi import NTXent, MLNS, ASLoss
+from model.fusion import EvidentialFusion
+from model import delta, registry
+from model.ensemble import export_ensemble, load_ensemble
+from model.optim import Adam, FlatAdam, ScheduledOptim
+from model.graph import SelfAttention, GraphLayer
+from model.hierarchy import label_paths, hierarchy_bias, HierarchyBias
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--device', type=str, default='cuda:0')
+parser.add_argument('--seed', default=42, type=int, help='Random seed.')
+subparsers = parser.add_subparsers(dest='bench', required=True)
+
+trunk_parser = subparsers.add_parser('trunk', help='Per-expert BERT passes vs. a trunk shared by the LoRA experts.')
+trunk_parser.add_argument('--data', type=str, default='WebOfScience', help='Dataset.')
+trunk_parser.add_argument('--experts', type=int, nargs='+', default=[3, 5, 8], help='Expert counts to run.')
+trunk_parser.add_argument('--batch', type=int, default=16, help='Batch size.')
+trunk_parser.add_argument('--length', type=int, default=512, help='Tokens per document.')
+trunk_parser.add_argument('--steps', type=int, default=20, help='Timed steps per setting.')
+trunk_parser.add_argument('--train', default=False, action='store_true',
+                          help='Time forward and backward in training mode instead of inference.')
+
+contrast_parser = subparsers.add_parser('contrast', help='Training steps with the original and contrastive BERT '
+                                                         'passes one after the other vs. fused into one batch.')
+contrast_parser.add_argument('--data', type=str, default='WebOfScience', help='Dataset.')
+contrast_parser.add_argument('--experts', type=int, nargs='+', default=[1, 2, 3, 5, 8], help='Expert counts to run.')
+contrast_parser.add_argument('--batch', type=int, default=16, help='Batch size.')
+contrast_parser.add_argument('--length', type=int, default=512, help='Tokens per document.')
+contrast_parser.add_argument('--steps', type=int, default=10, help='Timed steps per setting.')
+contrast_parser.add_argument('--shared-trunk', default=1, type=int,
+                             help='Whether LoRA experts share one pass over the frozen layers.')
+
+loss_parser = subparsers.add_parser('contrastive-loss', help='NTXent and MLNS against the full-matrix reference '
+                                                             'by batch size.')
+loss_parser.add_argument('--batch', type=int, nargs='+', default=[16, 256, 1024, 4096], help='Batch sizes.')
+loss_parser.add_argument('--labels', type=int, default=141, help='Number of labels.')
+loss_parser.add_argument('--hidden', type=int, default=768, help='Hidden size.')
+loss_parser.add_argument('--chunk', type=int, default=1024, help='Similarity rows per block.')
+loss_parser.add_argument('--reference-limit', type=int, default=4096,
+                         help='Largest batch to also run the full-matrix reference on.')
+loss_parser.add_argument('--steps', type=int, default=5, help='Timed steps per setting.')
+
+asl_parser = subparsers.add_parser('asl', help='Asymmetric loss against the previous stateful one by label count.')
+asl_parser.add_argument('--batch', type=int, default=64, help='Batch size.')
+asl_parser.add_argument('--labels', type=int, nargs='+', default=[141, 1000, 10000, 50000], help='Label counts.')
+asl_parser.add_argument('--steps', type=int, default=20, help='Timed steps per setting.')
+
+optim_parser = subparsers.add_parser('optim', help='Per-tensor Adam vs. the flat-buffer one on the experts.')
+optim_parser.add_argument('--data', type=str, default='WebOfScience', help='Dataset.')
+optim_parser.add_argument('--experts', type=int, nargs='+', default=[1, 3, 5, 8], help='Expert counts to run.')
+optim_parser.add_argument('--steps', type=int, default=20, help='Timed steps per setting.')
+
+checkpoint_parser = subparsers.add_parser('checkpoint', help='Saving the best macro and micro checkpoints of '
+                                                                'every expert in the loop vs. in the background.')
+checkpoint_parser.add_argument('--data', type=str, default='WebOfScience', help='Dataset.')
+checkpoint_parser.add_argument('--experts', type=int, default=3, help='Number of experts')
+checkpoint_parser.add_argument('--save-queue', type=int, default=6, help='Pending checkpoints of the background writer.')
+checkpoint_parser.add_argument('--epochs', type=int, default=3, help='Epochs whose checkpoints are saved.')
+
+serve_parser = subparsers.add_parser('serve', help='Throughput and latency of serve.py by batching window under '
+                                                   'a local load generator.')
+serve_parser.add_argument('--data', type=str, default='WebOfScience', help='Dataset whose test documents are sent.')
+serve_parser.add_argument('--experts', type=int, default=3, help='Number of randomly initialized experts to serve.')
+serve_parser.add_argument('--ensemble', type=str, default=None,
+                          help='File written by export.py to serve instead of randomly initialized experts.')
+serve_parser.add_argument('--windows', type=float, nargs='+', default=[0, 2, 5, 10, 20],
+                          help='--max-delay of the server in milliseconds.')
+serve_parser.add_argument('--max-batch', type=int, default=32, help='Documents per micro-batch.')
+serve_parser.add_argument('--requests', type=int, default=512, help='Requests per window.')
+serve_parser.add_argument('--rate', type=float, default=0,
+                          help='Requests per second arriving at random times. 0 runs --concurrency clients that '
+                               'each send the next request once the previous one is answered.')
+serve_parser.add_argument('--concurrency', type=int, default=32, help='Clients when --rate is 0.')
+serve_parser.add_argument('--shared-trunk', default=0, type=int,
+                          help='Whether LoRA experts share one pass over the frozen layers.')
+
+fusion_parser = subparsers.add_parser('fusion', help='Evidential fusion against the per-expert reference loop.')
+fusion_parser.add_argument('--experts', type=int, default=3, help='Number of experts')
+fusion_parser.add_argument('--batch', type=int, default=64, help='Batch size.')
+fusion_parser.add_argument('--labels', type=int, nargs='+', default=[103, 141, 1000, 10000, 50000],
+                           help='Label counts: rcv1, WebOfScience and synthetic taxonomies.')
+fusion_parser.add_argument('--steps', type=int, default=50, help='Timed steps per setting.')
+fusion_parser.add_argument('--eta', default=0.91, type=float)
+
+hierarchy_parser = subparsers.add_parser('hierarchy', help='Whole vs. chunked hierarchy attention bias by taxonomy size.')
+hierarchy_parser.add_argument('--labels', type=int, nargs='+', default=[141, 1000, 5000, 10000, 20000],
+                              help='Label counts of the random taxonomies.')
+hierarchy_parser.add_argument('--depth', type=int, default=4, help='Levels of the random taxonomies.')
+hierarchy_parser.add_argument('--hidden', type=int, default=768, help='Hidden size.')
+hierarchy_parser.add_argument('--heads', type=int, default=12, help='Attention heads.')
+hierarchy_parser.add_argument('--budget', type=int, default=1 << 22, help='Bias entries per chunk.')
+hierarchy_parser.add_argument('--whole-limit', type=int, default=10000,
+                              help='Largest taxonomy to also run with the whole L x L bias.')
+hierarchy_parser.add_argument('--steps', type=int, default=5, help='Timed steps per setting.')
+token_label_parser = subparsers.add_parser('token-label', help='Full vs. chunked token to label attention '
+                                                                'of the last graph layer by taxonomy size.')
+token_label_parser.add_argument('--labels', type=int, nargs='+', default=[141, 1000, 5000, 10000],
+                                help='Taxonomy sizes.')
+token_label_parser.add_argument('--batch', type=int, default=16, help='Batch size.')
+token_label_parser.add_argument('--length', type=int, default=512, help='Tokens per document.')
+token_label_parser.add_argument('--hidden', type=int, default=768, help='Hidden size.')
+token_label_parser.add_argument('--budget', type=int, default=1 << 24, help='Attention probabilities per chunk.')
+token_label_parser.add_argument('--full-limit', type=int, default=5000,
+                                help='Largest taxonomy to also run with the full B x heads x T x L attention.')
+token_label_parser.add_argument('--steps', type=int, default=5, help='Timed steps per setting.')
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, steps, device, warmup=2):
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / steps
+
+
+def model_args(data, experts):
+    return train_parser.parse_args(['--name', 'benchmark', '--data', data, '--experts', str(experts)])
+
+
+def random_batch(batch, length, num_class, vocab_size, device):
+    data = torch.randint(1000, vocab_size, (batch, length), device=device)
+    label = torch.zeros(batch, num_class, dtype=torch.long, device=device)
+    label[torch.arange(batch), torch.randint(0, num_class, (batch,))] = 1
+    return data, label
+
+
+def bench_trunk(args):
+    data_path = os.path.join('data', args.data)
+    num_class = len(torch.load(os.path.join(data_path, 'bert_value_dict.pt')))
+    for experts in args.experts:
+        models = build_experts(model_args(args.data, experts), num_class, data_path, args.device)
+        for model in models:
+            model.train(args.train)
+        vocab_size = models[0].config.vocab_size
+        data, label = random_batch(args.batch, args.length, num_class, vocab_size, args.device)
+        padding_mask = torch.ones_like(data, dtype=torch.bool)
+        results = {}
+        for name, shared in [('per-expert', 0), ('shared-trunk', 1)]:
+            runner = get_runner(models, shared)
+
+            def step():
+                if args.train:
+                    outputs = runner(data, padding_mask, labels=label, return_dict=True)
+                    sum(output['loss'] for output in outputs).backward()
+                    for model in models:
+                        model.zero_grad()
+                else:
+                    with torch.no_grad():
+                        return [output['logits'] for output in runner(data, padding_mask, return_dict=True)]
+
+            results[name] = timeit(step, args.steps, args.device)
+            if not args.train:
+                results[name + '-logits'] = step()
+            print('experts {} {:>12}: {:8.1f} docs/s ({} shared)'.format(
+                experts, name, args.batch / results[name], len(runner.shared)))
+        print('experts {} speedup: {:.2f}x'.format(experts, results['per-expert'] / results['shared-trunk']))
+        if not args.train:
+            diff = max((a - b).abs().max().item()
+                       for a, b in zip(results['per-expert-logits'], results['shared-trunk-logits']))
+            print('experts {} max |logit difference|: {:.2e}'.format(experts, diff))
+        del models
+
+
+def bench_contrast(args):
+    data_path = os.path.join('data', args.data)
+    num_class = len(torch.load(os.path.join(data_path, 'bert_value_dict.pt')))
+    for experts in args.experts:
+        models = build_experts(model_args(args.data, experts), num_class, data_path, args.device)
+        for model in models:
+            model.train()
+        vocab_size = models[0].config.vocab_size
+        data, label = random_batch(args.batch, args.length, num_class, vocab_size, args.device)
+        padding_mask = torch.ones_like(data, dtype=torch.bool)
+        results = {}
+        for name, fuse in [('sequential', 0), ('fused', 1)]:
+            runner = get_runner(models, args.shared_trunk, fuse)
+
+            def step():
+                outputs = runner(data, padding_mask, labels=label, return_dict=True)
+                sum(output['loss'] for output in outputs).backward()
+                for model in models:
+                    model.zero_grad()
+
+            if torch.device(args.device).type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(args.device)
+            results[name] = timeit(step, args.steps, args.device)
+            memory = torch.cuda.max_memory_allocated(args.device) / 2 ** 20 \
+                if torch.device(args.device).type == 'cuda' else float('nan')
+            print('experts {} {:>10}: {:8.1f} ms/step, peak {:8.0f} MiB'.format(
+                experts, name, results[name] * 1e3, memory))
+        print('experts {} step time change: {:+.1%}'.format(experts, results['fused'] / results['sequential'] - 1))
+        del models
+
+
+def bench_optim(args):
+    data_path = os.path.join('data', args.data)
+    num_class = len(torch.load(os.path.join(data_path, 'bert_value_dict.pt')))
+    for experts in args.experts:
+        results = {}
+        for name, optim in [('per-tensor', Adam), ('flat', FlatAdam)]:
+            torch.manual_seed(args.seed)
+            models = build_experts(model_args(args.data, experts), num_class, data_path, args.device)
+            for model in models:
+                for p in model.parameters():
+                    if p.requires_grad:
+                        p.grad = torch.randn_like(p) * 1e-3
+            optimizers = [ScheduledOptim(optim(model.parameters(), lr=3e-5), 3e-5, n_warmup_steps=2000)
+                          for model in models]
+
+            def step():
+                for optimizer in optimizers:
+                    optimizer.step()
+
+            results[name] = timeit(step, args.steps, args.device)
+            results[name + '-params'] = [p.detach().clone() for model in models for p in model.parameters()]
+            print('experts {} {:>10}: {:8.2f} ms/step'.format(experts, name, results[name] * 1e3))
+            del models, optimizers
+        same = all(torch.equal(a, b) for a, b in zip(results['per-tensor-params'], results['flat-params']))
+        print('experts {} speedup: {:.2f}x ({})'.format(experts, results['per-tensor'] / results['flat'],
+                                                     'parameters match' if same else 'PARAMETERS DIFFER'))
+
+
+def disk_usage(path):
+    """Bytes of the files under ``path``, counting hardlinked files once."""
+    inodes = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            inodes[stat.st_ino] = stat.st_size
+    return sum(inodes.values())
+
+
+def saved_match(path, saver):
+    saved = load_checkpoint(path)['param']
+    expected = delta.expert_state(saver.model, saver.pretrained, saver.base_names)['param']
+    return saved.keys() == expected.keys() and all(torch.equal(saved[k], v.cpu()) for k, v in expected.items())
+
+
+def bench_checkpoint(args):
+    data_path = os.path.join('data', args.data)
+    num_class = len(torch.load(os.path.join(data_path, 'bert_value_dict.pt')))
+    model_args_ = model_args(args.data, args.experts)
+    models = build_experts(model_args_, num_class, data_path, args.device)
+    optimizers = [Adam(model.parameters(), lr=3e-5) for model in models]
+    for model in models:
+        for p in model.parameters():
+            if p.requires_grad:
+                p.grad = torch.randn_like(p) * 1e-3
+    for optimizer in optimizers:
+        optimizer.step()
+    for save_queue in [0, args.save_queue]:
+        with tempfile.TemporaryDirectory() as save_dir:
+            writer = CheckpointWriter(save_queue)
+            savers = [Saver(model, optimizer, None, model_args_, writer=writer)
+                      for model, optimizer in zip(models, optimizers)]
+            blocked = 0
+            total = 0
+            for epoch in range(args.epochs):
+                synchronize(args.device)
+                start = time.perf_counter()
+                # both metrics improve, the worst case of the epoch loop
+                for extra in ['_macro', '_micro']:
+                    for i, saver in enumerate(savers, start=1):
+                        saver(0., 0., os.path.join(save_dir, 'checkpoint_best{}{}.pt'.format(extra, i)), key=(i, epoch))
+                blocked += time.perf_counter() - start
+                # what training overlaps with
+                writer.flush()
+                total += time.perf_counter() - start
+            writer.close()
+            same = all(saved_match(os.path.join(save_dir, 'checkpoint_best{}{}.pt'.format(extra, i)), saver)
+                       for extra in ['_macro', '_micro'] for i, saver in enumerate(savers, start=1))
+            print('save-queue {}: {:8.1f} ms/epoch blocking the loop, {:8.1f} ms/epoch until written, {:.1f} MB on disk ({})'.format(
+                save_queue, blocked / args.epochs * 1e3, total / args.epochs * 1e3, disk_usage(save_dir) / 2 ** 20,
+                'checkpoints match' if same else 'CHECKPOINTS DIFFER'))
+
+
+async def http_request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b''
+    header = '{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+    writer.write(header.format(method, path, len(body)).encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads((await reader.readexactly(length)).decode())
+
+
+async def request(socket, method, path, payload=None):
+    reader, writer = await asyncio.open_unix_connection(socket)
+    try:
+        return await http_request(reader, writer, method, path, payload)
+    finally:
+        writer.close()
+
+
+async def generate_load(socket, docs, rate, concurrency, seed):
+    """
+    Sends every document in ``docs`` to ``/predict``.
+
+    :return: List of latencies in seconds, List of responses, wall time in seconds
+    """
+    loop = asyncio.get_event_loop()
+    latencies = [None] * len(docs)
+    responses = [None] * len(docs)
+
+    async def send(i, reader, writer, sent):
+        status, response = await http_request(reader, writer, 'POST', '/predict', {'input_ids': docs[i]})
+        if status != 200:
+            raise RuntimeError('request {} failed with {}: {}'.format(i, status, response))
+        latencies[i] = loop.time() - sent
+        responses[i] = response
+
+    start = loop.time()
+    if rate > 0:
+        # open loop: requests arrive whether or not the earlier ones were answered, latency counts from arrival
+        arrivals = start + np.cumsum(np.random.RandomState(seed).exponential(1 / rate, len(docs)))
+
+        async def arrive(i):
+            await asyncio.sleep(max(arrivals[i] - loop.time(), 0))
+            reader, writer = await asyncio.open_unix_connection(socket)
+            try:
+                await send(i, reader, writer, arrivals[i])
+            finally:
+                writer.close()
+
+        await asyncio.gather(*[arrive(i) for i in range(len(docs))])
+    else:
+        indices = iter(range(len(docs)))
+
+        async def client():
+            reader, writer = await asyncio.open_unix_connection(socket)
+            try:
+                for i in indices:
+                    await send(i, reader, writer, loop.time())
+            finally:
+                writer.close()
+
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, responses, loop.time() - start
+
+
+def start_server(loop, ensemble, socket, args, window, timeout=600):
+    serve_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py')
+    process = subprocess.Popen([sys.executable, serve_py, '--ensemble', ensemble, '--socket', socket,
+                                '--device', args.device, '--shared-trunk', str(args.shared_trunk),
+                                '--max-batch', str(args.max_batch), '--max-delay', str(window)],
+                               stdout=subprocess.DEVNULL)
+    deadline = time.perf_counter() + timeout
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError('serve.py exited with {}'.format(process.returncode))
+        try:
+            loop.run_until_complete(request(socket, 'GET', '/health'))
+            return process
+        except OSError:
+            if time.perf_counter() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.2)
+
+
+def bench_serve(args):
+    data_path = os.path.join('data', args.data)
+    dataset = BertDataset(data_path=data_path)
+    test = torch.load(os.path.join(data_path, 'split.pt'))['test']
+    docs = [dataset.data[test[i % len(test)]][:dataset.max_token - 2].tolist() for i in range(args.requests)]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ensemble = args.ensemble
+        if ensemble is None:
+            model_args_ = model_args(args.data, args.experts)
+            label_dict = registry.label_dict(data_path)
+            models = build_experts(model_args_, len(label_dict), data_path, 'cpu')
+            ensemble = os.path.join(tmp_dir, 'ensemble.bin')
+            label_names = [registry.tokenizer().decode(label_dict[i], skip_special_tokens=True)
+                           for i in range(len(label_dict))]
+            export_ensemble(ensemble, models, expert_kwargs(model_args_, data_path),
+                            registry.label_hierarchy(data_path), args=vars(model_args_), label_names=label_names,
+                            thresholds=None, checkpoints=[])
+            del models
+        models, meta = load_ensemble(ensemble, args.device)
+        predictor = Predictor(models, meta['label_names'], meta.get('thresholds'), shared_trunk=args.shared_trunk,
+                              pad_idx=registry.tokenizer().pad_token_id)
+        # what the server must answer for a document, whichever others share its micro-batch
+        expected = [predictor([doc])[0]['probs'] for doc in docs[:16]]
+        del models, predictor
+        for window in args.windows:
+            socket = os.path.join(tmp_dir, 'serve.sock')
+            process = start_server(loop, ensemble, socket, args, window)
+            try:
+                # warm up the server and its connections before timing
+                loop.run_until_complete(generate_load(socket, docs[:args.max_batch], 0, args.max_batch, args.seed))
+                before = loop.run_until_complete(request(socket, 'GET', '/stats'))[1]
+                latencies, responses, wall = loop.run_until_complete(
+                    generate_load(socket, docs, args.rate, args.concurrency, args.seed))
+                after = loop.run_until_complete(request(socket, 'GET', '/stats'))[1]
+            finally:
+                process.terminate()
+                process.wait()
+            diff = max(abs(p - q) for response, probs in zip(responses, expected)
+                       for p, q in zip(response['probs'], probs))
+            latencies = np.array(latencies) * 1e3
+            print('window {:5.1f} ms: {:8.1f} docs/s, p50 {:8.1f} ms, p99 {:8.1f} ms, {:5.1f} docs/batch ({})'.format(
+                window, len(docs) / wall, np.percentile(latencies, 50), np.percentile(latencies, 99),
+                (after['requests'] - before['requests']) / max(after['batches'] - before['batches'], 1),
+                'responses match' if diff < 1e-4 else 'RESPONSES DIFFER by {:.1e}'.format(diff)))
+    loop.close()
+
+
+def reference_fusion(xis, eta):
+    """The fusion loop that used to be inlined in train_multi.py and test.py."""
+    num_classes = xis[0].size(1)
+    w = [torch.ones(len(xis[0]), dtype=torch.bool, device=xis[0].device)]
+    b0 = None
+    for xi in xis:
+        alpha = torch.exp(xi) + 1
+        S = alpha.sum(dim=1, keepdim=True)
+        b = (alpha - 1) / S
+        u = num_classes / S.squeeze(-1)
+        if b0 is None:
+            C = 0
+        else:
+            bb = b0.view(-1, b0.shape[1], 1) @ b.view(-1, 1, b.shape[1])
+            C = bb.sum(dim=[1, 2]) - bb.diagonal(dim1=1, dim2=2).sum(dim=1)
+        b0 = b
+        w.append(w[-1] * u / (1 - C))
+    exp_w = [torch.exp(wi / eta) for wi in w][:-1]
+    exp_w_sum = sum(exp_w)
+    exp_w = [(x / exp_w_sum).unsqueeze(-1) for x in exp_w]
+    return torch.mean(torch.stack([xis[i] * exp_w[i] for i in range(len(xis))]), dim=0), w[:-1]
+
+
+def bench_fusion(args):
+    fusion = EvidentialFusion(args.eta)
+    for num_class in args.labels:
+        logits = torch.randn(args.experts, args.batch, num_class, device=args.device) * 3
+        xis = list(logits)
+        # the reference builds a B x C x C outer product per expert; skip it where it cannot fit
+        run_reference = args.batch * num_class * num_class * 4 < 2 ** 32
+        with torch.no_grad():
+            fused = fusion(logits)
+            if run_reference:
+                expected, w = reference_fusion(xis, args.eta)
+                torch.testing.assert_close(fused['logits'], expected, rtol=1e-4, atol=1e-5)
+                torch.testing.assert_close(fused['prefix_weights'], torch.stack([wi.float() for wi in w]),
+                                           rtol=1e-4, atol=1e-6)
+                reference_time = timeit(lambda: reference_fusion(xis, args.eta), args.steps, args.device)
+            fusion_time = timeit(lambda: fusion(logits), args.steps, args.device)
+        if run_reference:
+            print('labels {:>6}: reference {:9.3f} ms, fused {:7.3f} ms, speedup {:.1f}x (outputs match)'.format(
+                num_class, reference_time * 1e3, fusion_time * 1e3, reference_time / fusion_time))
+        else:
+            print('labels {:>6}: reference skipped,  fused {:7.3f} ms'.format(num_class, fusion_time * 1e3))
+
+
+def reference_ntxent(x, tau=1.):
+    """NTXent on the full 2B x 2B similarity matrix, as it used to be computed."""
+    n = x.shape[0]
+    x = F.normalize(x, p=2, dim=1) / tau ** 0.5
+    sim = x @ x.t()
+    sim[torch.arange(n), torch.arange(n)] = -1e9
+    logprob = F.log_softmax(sim, dim=1)
+    return -logprob[torch.arange(n), (torch.arange(n) + n // 2) % n].sum() / n
+
+
+def reference_mlns(x, labels):
+    """MLNS on the full B x B similarity and label overlap matrices, as it used to be computed."""
+    x = F.normalize(x, p=2, dim=1)
+    labels = labels.type(x.dtype)
+    C = labels @ labels.t()
+    return ((labels.sum(dim=1).reshape(-1, 1) - C) * (x @ x.t())).sum()
+
+
+def bench_contrastive_loss(args):
+    config = BertConfig(hidden_size=args.hidden, hidden_dropout_prob=0., contrast_chunk_size=args.chunk)
+    ntxent = NTXent(config).to(args.device)
+    ntxent.transform = nn.Identity()
+    mlns = MLNS()
+    for batch in args.batch:
+        x = torch.randn(2 * batch, args.hidden, device=args.device, requires_grad=True)
+        labels = (torch.rand(2 * batch, args.labels, device=args.device) < 0.02).long()
+        settings = [('chunked', lambda: ntxent(x) + mlns(x, labels))]
+        if batch <= args.reference_limit:
+            torch.testing.assert_close(ntxent(x), reference_ntxent(x))
+            torch.testing.assert_close(mlns(x, labels), reference_mlns(x, labels), rtol=1e-4, atol=1e-2)
+            settings.insert(0, ('full', lambda: reference_ntxent(x) + reference_mlns(x, labels)))
+        for name, loss in settings:
+            if torch.device(args.device).type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(args.device)
+            elapsed = timeit(lambda: loss().backward(), args.steps, args.device, warmup=1)
+            memory = torch.cuda.max_memory_allocated(args.device) / 2 ** 20 \
+                if torch.device(args.device).type == 'cuda' else float('nan')
+            print('batch {:>6} {:>8}: {:9.1f} ms, peak {:8.0f} MiB'.format(batch, name, elapsed * 1e3, memory))
+
+
+class ReferenceASLoss(nn.Module):
+    """The asymmetric loss as ContrastModel used to compute it, keeping its intermediates as attributes."""
+
+    def __init__(self, gamma_neg=3, gamma_pos=1, clip=0.05, eps=1e-8):
+        super(ReferenceASLoss, self).__init__()
+        self.gamma_neg = gamma_neg
+        self.gamma_pos = gamma_pos
+        self.clip = clip
+        self.eps = eps
+        self.targets = self.anti_targets = self.xs_pos = self.xs_neg = self.asymmetric_w = self.loss = None
+
+    def forward(self, x, y):
+        self.targets = y
+        self.anti_targets = 1 - y
+        self.xs_pos = torch.sigmoid(x)
+        self.xs_neg = 1.0 - self.xs_pos
+        self.xs_neg.add_(self.clip).clamp_(max=1)
+        self.loss = self.targets * torch.log(self.xs_pos.clamp(min=self.eps))
+        self.loss.add_(self.anti_targets * torch.log(self.xs_neg.clamp(min=self.eps)))
+        self.xs_pos = self.xs_pos * self.targets
+        self.xs_neg = self.xs_neg * self.anti_targets
+        self.asymmetric_w = torch.pow(1 - self.xs_pos - self.xs_neg,
+                                      self.gamma_pos * self.targets + self.gamma_neg * self.anti_targets)
+        self.loss *= self.asymmetric_w
+        return -self.loss.sum()
+
+
+def bench_asl(args):
+    # gammas of 0 on saturated logits, where the focal weight of a label is constant but its base is 0
+    for gamma_neg, gamma_pos in [(3, 1), (0, 1), (4, 0), (0, 0)]:
+        x = torch.tensor([[-10., 0.5, 20.], [20., -20., 0.]], device=args.device, requires_grad=True)
+        y = torch.tensor([[0., 0., 1.], [1., 0., 0.]], device=args.device)
+        expected_grad, = torch.autograd.grad(ReferenceASLoss(gamma_neg, gamma_pos)(x, y), x)
+        for recompute in [False, True]:
+            grad, = torch.autograd.grad(ASLoss(gamma_neg, gamma_pos, recompute=recompute)(x, y), x)
+            torch.testing.assert_close(grad, expected_grad)
+    for num_labels in args.labels:
+        x = torch.randn(args.batch, num_labels, device=args.device, requires_grad=True)
+        y = torch.zeros(args.batch, num_labels, device=args.device)
+        y[torch.arange(args.batch), torch.randint(0, num_labels, (args.batch,))] = 1
+        expected = ReferenceASLoss()(x, y)
+        expected_grad, = torch.autograd.grad(expected, x)
+        for name, loss_fct in [('reference', ReferenceASLoss()), ('stateless', ASLoss()),
+                               ('recompute', ASLoss(recompute=True))]:
+            loss = loss_fct(x, y)
+            loss.backward()
+            torch.testing.assert_close(loss, expected)
+            torch.testing.assert_close(x.grad, expected_grad)
+            x.grad = None
+            del loss
+            if torch.device(args.device).type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(args.device)
+                base = torch.cuda.memory_allocated(args.device)
+
+            def step():
+                loss_fct(x, y).backward()
+                x.grad = None
+
+            elapsed = timeit(step, args.steps, args.device)
+            memory = (torch.cuda.max_memory_allocated(args.device) - base) / 2 ** 20 \
+                if torch.device(args.device).type == 'cuda' else float('nan')
+            print('labels {:>6} {:>10}: {:7.3f} ms, peak {:7.1f} MiB above inputs'.format(
+                num_labels, name, elapsed * 1e3, memory))
+
+
+def random_hierarchy(num_labels, depth, seed=0):
+    """A slot.pt-like taxonomy whose ids are shuffled, so that they do not grow with depth, as in WebOfScience."""
+    rng = torch.Generator().manual_seed(seed)
+    sizes = [max(1, round(num_labels ** ((level + 1) / depth))) for level in range(depth)]
+    sizes[-1] = num_labels - sum(sizes[:-1])
+    ids = torch.randperm(num_labels, generator=rng).tolist()
+    label_hier = {}
+    start = sizes[0]
+    for level in range(1, depth):
+        parents = ids[start - sizes[level - 1]:start]
+        for child in ids[start:start + sizes[level]]:
+            parent = parents[torch.randint(len(parents), (1,), generator=rng).item()]
+            label_hier.setdefault(parent, set()).add(child)
+        start += sizes[level]
+    return label_hier
+
+
+def reference_hierarchy_bias(label_hier, num_labels, distance_embedding, edge_embedding):
+    """The distance and edge tensors as GraphEncoder used to build them, pair by pair."""
+    path_dict = {v: s for s in label_hier for v in label_hier[s]}
+    paths = []
+    for n in range(num_labels):
+        path = [n]
+        while path_dict.get(n, n) != n:
+            n = path_dict[n]
+            path.append(n)
+        paths.append(path + [-1])
+    distance = torch.zeros(num_labels, num_labels, dtype=torch.long)
+    edges = torch.zeros(num_labels, num_labels, 15, dtype=torch.long)
+    for i in range(num_labels):
+        for j in range(num_labels):
+            p = q = 0
+            edge_list = []
+            while p < len(paths[i]) and q < len(paths[j]) and paths[i][p] != paths[j][q]:
+                if paths[i][p] > paths[j][q]:
+                    edge_list.append(paths[i][p])
+                    p += 1
+                else:
+                    edge_list.append(paths[j][q])
+                    q += 1
+            distance[i, j] = p + q
+            edges[i, j, :len(edge_list)] = torch.tensor(edge_list, dtype=torch.long) + 1
+    distance = distance.to(distance_embedding.weight.device)
+    edges = edges.to(edge_embedding.weight.device)
+    return distance_embedding(distance).squeeze(-1) + edge_embedding(edges).sum(dim=2).squeeze(-1) / (distance + 1e-8)
+
+
+def bench_hierarchy(args):
+    config = BertConfig(hidden_size=args.hidden, num_attention_heads=args.heads)
+    attention = SelfAttention(config).to(args.device)
+    distance_embedding = nn.Embedding(20, 1, 0).to(args.device)
+    edge_embedding = nn.Embedding(max(args.labels) + 1, 1, 0).to(args.device)
+    for num_labels in args.labels:
+        label_hier = random_hierarchy(num_labels, args.depth, args.seed)
+        paths = label_paths(label_hier, num_labels).to(args.device)
+        if num_labels <= 300:
+            with torch.no_grad():
+                expected = reference_hierarchy_bias(label_hier, num_labels, distance_embedding, edge_embedding)
+                bias = hierarchy_bias(paths, slice(None), distance_embedding, edge_embedding)
+            torch.testing.assert_close(bias, expected)
+        label_emb = torch.randn(1, num_labels, args.hidden, device=args.device, requires_grad=True)
+        chunk_size = max(1, args.budget // num_labels)
+        settings = [('chunked', HierarchyBias(paths, distance_embedding, edge_embedding, chunk_size))]
+        if num_labels <= args.whole_limit:
+            settings.insert(0, ('whole', None))
+        for name, extra_attn in settings:
+
+            def step():
+                bias = extra_attn
+                if bias is None:
+                    bias = hierarchy_bias(paths, slice(None), distance_embedding, edge_embedding)
+                attention(label_emb, extra_attn=bias)[0].sum().backward()
+
+            if torch.device(args.device).type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(args.device)
+            elapsed = timeit(step, args.steps, args.device, warmup=1)
+            memory = torch.cuda.max_memory_allocated(args.device) / 2 ** 20 \
+                if torch.device(args.device).type == 'cuda' else float('nan')
+            print('labels {:>6} {:>8}: {:9.1f} ms, peak {:8.0f} MiB{}'.format(
+                num_labels, name, elapsed * 1e3, memory,
+                ' ({} rows per chunk)'.format(chunk_size) if extra_attn is not None else ''))
+
+
+def reference_gold_label_weights(layer, inputs_embeds, label_emb, labels, attention_mask, tau=1):
+    """The gold label weights as GraphEncoder used to compute them, from the full masked cross-attention."""
+    label_attn_mask = torch.ones(1, label_emb.size(0), device=label_emb.device)
+    cross_attn_mask = (attention_mask * 1.).unsqueeze(-1).bmm(
+        (label_attn_mask.unsqueeze(0) * 1.).repeat(attention_mask.size(0), 1, 1))
+    attn = layer.cross_attn(inputs_embeds, label_emb.expand(inputs_embeds.size(0), -1, -1),
+                            attention_mask=cross_attn_mask.unsqueeze(1), output_attentions=True, only_attn=True)
+    return (F.gumbel_softmax(attn.mean(dim=1), hard=False, dim=-1, tau=tau) * labels.unsqueeze(1)).sum(-1)
+
+
+def bench_token_label(args):
+    config = BertConfig(hidden_size=args.hidden)
+    layer = GraphLayer(config, last=True).to(args.device).train()
+    for num_labels in args.labels:
+        inputs_embeds = torch.randn(args.batch, args.length, args.hidden, device=args.device, requires_grad=True)
+        label_emb = torch.randn(num_labels, args.hidden, device=args.device, requires_grad=True)
+        labels = (torch.rand(args.batch, num_labels, device=args.device) < 0.01).float()
+        attention_mask = torch.ones(args.batch, args.length, device=args.device)
+        # both draw the same Gumbel noise when all tokens fit in one chunk
+        torch.manual_seed(args.seed)
+        expected = reference_gold_label_weights(layer, inputs_embeds, label_emb, labels, attention_mask)
+        torch.manual_seed(args.seed)
+        weights = layer.gold_label_weights(inputs_embeds, label_emb, labels, budget=1 << 62)
+        torch.testing.assert_close(weights, expected)
+        del expected, weights
+        settings = [('chunked', lambda: layer.gold_label_weights(inputs_embeds, label_emb, labels,
+                                                                 budget=args.budget))]
+        if num_labels <= args.full_limit:
+            settings.insert(0, ('full', lambda: reference_gold_label_weights(layer, inputs_embeds, label_emb, labels,
+                                                                             attention_mask)))
+        for name, forward in settings:
+            if torch.device(args.device).type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(args.device)
+            elapsed = timeit(lambda: forward().sum().backward(), args.steps, args.device, warmup=1)
+            memory = torch.cuda.max_memory_allocated(args.device) / 2 ** 20 \
+                if torch.device(args.device).type == 'cuda' else float('nan')
+            print('labels {:>6} {:>8}: {:9.1f} ms, peak {:8.0f} MiB'.format(num_labels, name, elapsed * 1e3, memory))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    if args.bench == 'trunk':
+        bench_trunk(args)
+    elif args.bench == 'contrast':
+        bench_contrast(args)
+    elif args.bench == 'contrastive-loss':
+        bench_contrastive_loss(args)
+    elif args.bench == 'asl':
+        bench_asl(args)
+    elif args.bench == 'optim':
+        bench_optim(args)
+    elif args.bench == 'checkpoint':
+        bench_checkpoint(args)
+    elif args.bench == 'serve':
+        bench_serve(args)
+    elif args.bench == 'fusion':
+        bench_fusion(args)
+    elif args.bench == 'hierarchy':
+        bench_hierarchy(args)
+    elif args.bench == 'token-label':
+        bench_token_label(args)
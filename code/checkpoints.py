@@ -0,0 +1,137 @@
+import copy
+import os
+import queue
+import shutil
+import threading
+import torch
+
+
+def snapshot(obj, memo=None):
+    """A copy of ``obj`` with every tensor detached and copied to host memory, tensors shared in ``obj`` stay shared."""
+    if memo is None:
+        memo = {}
+    if torch.is_tensor(obj):
+        if id(obj) not in memo:
+            memo[id(obj)] = obj.detach().to('cpu', copy=True)
+        return memo[id(obj)]
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v, memo)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v, memo) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def meta_path(path):
+    """The file next to a checkpoint with what is specific to the metric it was kept for."""
+    return os.path.splitext(path)[0] + '.meta.pt'
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """A checkpoint written by :class:`CheckpointWriter`, merged with its meta file, or a single-file one."""
+    checkpoint = torch.load(path, map_location=map_location)
+    if os.path.exists(meta_path(path)):
+        checkpoint.update(torch.load(meta_path(path), map_location=map_location))
+    return checkpoint
+
+
+def _atomic_save(obj, path):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _atomic_link(source, path):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints as ``path`` with the model and optimizer state and ``meta_path(path)`` with the scores
+    and thresholds of the metric it was kept for. Both are written to a temporary file and renamed, so a
+    crash never leaves a truncated checkpoint, and a path that is a hardlink of another checkpoint is replaced
+    rather than overwritten.
+
+    :meth:`save` only copies the state to host memory. With ``max_pending`` > 0 a background thread writes it
+    and at most ``max_pending`` snapshots wait for the disk, after which :meth:`save` blocks until one is
+    written. With 0 every checkpoint is written before :meth:`save` returns.
+
+    States saved under the same ``key``, e.g. an expert kept for both macro and micro F1 after the same epoch,
+    are copied and written once, the later paths become hardlinks of the first.
+    """
+
+    def __init__(self, max_pending=0):
+        self.max_pending = max_pending
+        self.paths = {}
+        self.error = None
+        if max_pending > 0:
+            self.queue = queue.Queue(max_pending)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def save(self, state, path, meta=None, key=None):
+        """
+        :param state: Dict, the checkpoint, with tensors anywhere in it
+        :param meta: Dict, small entries that differ between paths saved under the same ``key``
+        :param key: hashable, identifies ``state``, or None to always write it
+        """
+        self._check()
+        if key is not None and key in self.paths:
+            job = (self.paths[key], None, path, snapshot(meta))
+        else:
+            job = (None, snapshot(state), path, snapshot(meta))
+            # the old state at ``path`` is about to be replaced
+            self.paths = {k: p for k, p in self.paths.items() if p != path}
+            if key is not None:
+                self.paths[key] = path
+        if self.max_pending > 0:
+            self.queue.put(job)
+        else:
+            self._write(*job)
+
+    def flush(self):
+        """Waits until every checkpoint saved so far is on disk."""
+        if self.max_pending > 0:
+            self.queue.join()
+        self._check()
+
+    def close(self):
+        self.flush()
+        if self.max_pending > 0:
+            self.queue.put(None)
+            self.thread.join()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('writing a checkpoint failed') from self.error
+
+    @staticmethod
+    def _write(source, state, path, meta):
+        if source is not None:
+            _atomic_link(source, path)
+        else:
+            _atomic_save(state, path)
+        if meta is not None:
+            _atomic_save(meta, meta_path(path))
+        elif os.path.exists(meta_path(path)):
+            os.remove(meta_path(path))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    self._write(*job)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
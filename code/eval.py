@@ -2,6 +2,7 @@
 # coding:utf-8
 
 import numpy as np
+import torch
 
 
 def _precision_recall_f1(right, predict, total):
@@ -21,58 +22,13 @@ def _precision_recall_f1(right, predict, total):
     return p, r, f
 
 
-def evaluate(epoch_predicts, epoch_labels, id2label, threshold=0.5, top_k=None):
+def _scores(right_count_list, predicted_count_list, gold_count_list, id2label):
     """
-    :param epoch_labels: List[List[int]], ground truth, label id
-    :param epoch_predicts: List[List[Float]], predicted probability list
-    :param vocab: data_modules.Vocab object
-    :param threshold: Float, filter probability for tagging
-    :param top_k: int, truncate the prediction
-    :return:  confusion_matrix -> List[List[int]],
-    Dict{'precision' -> Float, 'recall' -> Float, 'micro_f1' -> Float, 'macro_f1' -> Float}
+    :param right_count_list: List[int], per class count of right predictions
+    :param predicted_count_list: List[int], per class count of predictions
+    :param gold_count_list: List[int], per class count of labels
+    :return: Dict{'precision' -> Float, 'recall' -> Float, 'micro_f1' -> Float, 'macro_f1' -> Float}
     """
-    assert len(epoch_predicts) == len(epoch_labels), 'mismatch between prediction and ground truth for evaluation'
-    # label2id = vocab.v2i['label']
-    # id2label = vocab.i2v['label']
-    # epoch_gold_label = list()
-    # # get id label name of ground truth
-    # for sample_labels in epoch_labels:
-    #     sample_gold = []
-    #     for label in sample_labels:
-    #         assert label in id2label.keys(), print(label)
-    #         sample_gold.append(id2label[label])
-    #     epoch_gold_label.append(sample_gold)
-
-    epoch_gold = epoch_labels
-
-    # initialize confusion matrix
-    confusion_count_list = [[0 for _ in range(len(id2label))] for _ in range(len(id2label))]
-    right_count_list = [0 for _ in range(len(id2label))]
-    gold_count_list = [0 for _ in range(len(id2label))]
-    predicted_count_list = [0 for _ in range(len(id2label))]
-
-    for sample_predict, sample_gold in zip(epoch_predicts, epoch_gold):
-        np_sample_predict = np.array(sample_predict, dtype=np.float32)
-        sample_predict_descent_idx = np.argsort(-np_sample_predict)
-        sample_predict_id_list = []
-        if top_k is None:
-            top_k = len(sample_predict)
-        for j in range(top_k):
-            if np_sample_predict[sample_predict_descent_idx[j]] > threshold:
-                sample_predict_id_list.append(sample_predict_descent_idx[j])
-        for i in range(len(confusion_count_list)):
-            for predict_id in sample_predict_id_list:
-                confusion_count_list[i][predict_id] += 1
-        # count for the gold and right items
-        for gold in sample_gold:
-            gold_count_list[gold] += 1
-            for label in sample_predict_id_list:
-                if gold == label:
-                    right_count_list[gold] += 1
-
-        # count for the predicted items
-        for label in sample_predict_id_list:
-            predicted_count_list[label] += 1
     precision_dict = dict()
     recall_dict = dict()
     fscore_dict = dict()
@@ -100,4 +56,161 @@ def evaluate(epoch_predicts, epoch_labels, id2label, threshold=0.5, top_k=None):
             'recall': recall_micro,
             'micro_f1': micro_f1,
             'macro_f1': macro_f1,
-            'full': [precision_dict, recall_dict, fscore_dict, right_count_list, predicted_count_list, gold_count_list]}
\ No newline at end of file
+            'full': [precision_dict, recall_dict, fscore_dict, right_count_list, predicted_count_list, gold_count_list]}
+
+
+class MetricAccumulator:
+    """
+    Streaming per-class TP / FP / FN counts, updated batch by batch with tensor ops.
+    Only three [num_class] count vectors are kept, so the batches may come in any order.
+    """
+
+    def __init__(self, num_class, threshold=0.5, top_k=None):
+        """
+        :param threshold: Float, or List[Float] / Tensor [C] of per-class thresholds
+        """
+        if isinstance(threshold, (list, tuple)):
+            threshold = torch.tensor(threshold)
+        self.num_class = num_class
+        self.threshold = threshold
+        self.top_k = top_k
+        self.right = None
+        self.predicted = None
+        self.gold = None
+
+    def update(self, logits, labels):
+        """
+        :param logits: Tensor [B, C], predicted logits
+        :param labels: Tensor [B, C], multi-hot ground truth
+        """
+        self.update_probs(torch.sigmoid(logits.detach()), labels)
+
+    def update_probs(self, probs, labels):
+        """
+        :param probs: Tensor [B, C], predicted probabilities
+        :param labels: Tensor [B, C], multi-hot ground truth
+        """
+        threshold = self.threshold
+        if torch.is_tensor(threshold):
+            threshold = threshold.to(probs.device, probs.dtype)
+        predict = probs > threshold
+        if self.top_k is not None and self.top_k < self.num_class:
+            top = torch.zeros_like(predict)
+            top.scatter_(1, probs.topk(self.top_k, dim=1).indices, True)
+            predict &= top
+        gold = labels == 1
+        counts = torch.stack([(predict & gold).sum(dim=0), predict.sum(dim=0), gold.sum(dim=0)])
+        if self.right is None:
+            self.right, self.predicted, self.gold = torch.zeros_like(counts)
+        self.right += counts[0]
+        self.predicted += counts[1]
+        self.gold += counts[2]
+
+    def compute(self, id2label):
+        """
+        :param id2label: Dict{int -> str}, label names
+        :return: the same dict as :func:`evaluate`
+        """
+        if self.right is None:
+            counts = [[0] * self.num_class] * 3
+        else:
+            counts = [self.right.tolist(), self.predicted.tolist(), self.gold.tolist()]
+        return _scores(*counts, id2label)
+
+
+class ThresholdSweep:
+    """
+    Scores a grid of thresholds in one streaming pass over the predictions.
+
+    Every probability is placed among the sorted thresholds with searchsorted and counted into a
+    per-class histogram, once over all predictions and once over the gold ones. Suffix sums of the
+    histograms give the predicted and right counts of every class at every threshold, from which
+    micro / macro-F1 of each global threshold and the best threshold of each class follow.
+    """
+
+    def __init__(self, num_class, thresholds=None):
+        if thresholds is None:
+            thresholds = torch.linspace(0.005, 0.995, 199)
+        self.num_class = num_class
+        self.thresholds = torch.sort(torch.as_tensor(thresholds, dtype=torch.float))[0]
+        self.predicted = None
+        self.right = None
+
+    def update(self, logits, labels):
+        """
+        :param logits: Tensor [B, C], predicted logits
+        :param labels: Tensor [B, C], multi-hot ground truth
+        """
+        self.update_probs(torch.sigmoid(logits.detach()), labels)
+
+    def update_probs(self, probs, labels):
+        """
+        :param probs: Tensor [B, C], predicted probabilities
+        :param labels: Tensor [B, C], multi-hot ground truth
+        """
+        bins = len(self.thresholds) + 1
+        if self.predicted is None:
+            self.thresholds = self.thresholds.to(probs.device)
+            self.predicted = torch.zeros(self.num_class * bins, dtype=torch.long, device=probs.device)
+            self.right = torch.zeros_like(self.predicted)
+        # the bin of p is the number of thresholds strictly below it, i.e. those it is predicted at
+        bucket = torch.searchsorted(self.thresholds.to(probs.dtype), probs.contiguous())
+        bucket = bucket + torch.arange(self.num_class, device=probs.device) * bins
+        self.predicted += torch.bincount(bucket.flatten(), minlength=len(self.predicted))
+        self.right += torch.bincount(bucket[labels == 1], minlength=len(self.right))
+
+    def compute(self, metric='macro_f1'):
+        """
+        :param metric: str, 'macro_f1' or 'micro_f1', the score the global threshold is chosen by
+        :return: Dict{'thresholds' -> List[Float], 'micro_f1' / 'macro_f1' -> List[Float] per threshold,
+                 'global' -> Float best threshold, 'class' -> List[Float] best threshold per class,
+                 'class_f1' -> List[Float] dev F1 of each class at its threshold}
+        """
+        bins = len(self.thresholds) + 1
+        predicted = self.predicted.view(self.num_class, bins).double()
+        right = self.right.view(self.num_class, bins).double()
+        gold = right.sum(dim=1, keepdim=True)
+        # counts at threshold k are those of the bins above it
+        predicted = predicted.flip(1).cumsum(1).flip(1)[:, 1:]
+        right = right.flip(1).cumsum(1).flip(1)[:, 1:]
+
+        precision = torch.where(predicted > 0, right / predicted.clamp(min=1), torch.zeros_like(right))
+        recall = torch.where(gold > 0, right / gold.clamp(min=1), torch.zeros_like(right))
+        f1 = torch.where(precision + recall > 0, 2 * precision * recall / (precision + recall).clamp(min=1e-12),
+                         torch.zeros_like(right))
+        macro_f1 = f1.mean(dim=0)
+        precision_micro = right.sum(0) / predicted.sum(0).clamp(min=1)
+        recall_micro = right.sum(0) / gold.sum().clamp(min=1)
+        micro_f1 = torch.where(precision_micro + recall_micro > 0,
+                               2 * precision_micro * recall_micro / (precision_micro + recall_micro).clamp(min=1e-12),
+                               torch.zeros_like(precision_micro))
+
+        best = (macro_f1 if metric == 'macro_f1' else micro_f1).argmax()
+        class_f1, class_best = f1.max(dim=1)
+        # classes that are never right on dev keep the global threshold
+        class_thresholds = torch.where(class_f1 > 0, self.thresholds[class_best], self.thresholds[best])
+        return {'thresholds': self.thresholds.tolist(),
+                'micro_f1': micro_f1.tolist(),
+                'macro_f1': macro_f1.tolist(),
+                'global': self.thresholds[best].item(),
+                'class': class_thresholds.tolist(),
+                'class_f1': class_f1.tolist()}
+
+
+def evaluate(epoch_predicts, epoch_labels, id2label, threshold=0.5, top_k=None):
+    """
+    :param epoch_labels: List[List[int]], ground truth, label id
+    :param epoch_predicts: List[List[Float]], predicted probability list
+    :param id2label: Dict{int -> str}, label names
+    :param threshold: Float, filter probability for tagging
+    :param top_k: int, truncate the prediction
+    :return: Dict{'precision' -> Float, 'recall' -> Float, 'micro_f1' -> Float, 'macro_f1' -> Float}
+    """
+    assert len(epoch_predicts) == len(epoch_labels), 'mismatch between prediction and ground truth for evaluation'
+    probs = torch.tensor(np.array(epoch_predicts, dtype=np.float32)).view(len(epoch_predicts), len(id2label))
+    labels = torch.zeros(probs.shape, dtype=torch.long)
+    for i, sample_gold in enumerate(epoch_labels):
+        labels[i, sample_gold] = 1
+    accumulator = MetricAccumulator(len(id2label), threshold, top_k)
+    accumulator.update_probs(probs, labels)
+    return accumulator.compute(id2label)
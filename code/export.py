@@ -0,0 +1,47 @@
+import argparse
+import os
+from train_multi import build_experts, expert_kwargs
+from checkpoints import load_checkpoint
+from logits_cache import checkpoint_hash
+from model import registry, delta
+from model.ensemble import export_ensemble
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', type=str, required=True, help='Name of checkpoint. Commonly as DATASET-NAME.')
+parser.add_argument('--experts', type=int, default=3, help='Number of experts')
+parser.add_argument('--fold', default=None, type=int,
+                    help='Fold to export when the run trained several folds, each saved in its own subdirectory.')
+parser.add_argument('--metric', type=str, default='macro', choices=['macro', 'micro'],
+                    help='Export the checkpoints kept for the best macro or micro F1.')
+parser.add_argument('--output', type=str, default=None,
+                    help='File to write, ensemble_METRIC.bin in the checkpoint directory by default.')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    checkpoint_dir = os.path.join('checkpoints', args.name)
+    if args.fold is not None:
+        checkpoint_dir = os.path.join(checkpoint_dir, 'fold{}'.format(args.fold))
+    paths = [os.path.join(checkpoint_dir, 'checkpoint_best_{}{}.pt'.format(args.metric, i))
+             for i in range(1, args.experts + 1)]
+    checkpoints = [load_checkpoint(path) for path in paths]
+    train_args = checkpoints[0]['args']
+    if not hasattr(train_args, 'graph'):
+        train_args.graph = False
+    data_path = os.path.join('data', train_args.data)
+
+    tokenizer = registry.tokenizer()
+    label_dict = registry.label_dict(data_path)
+    label_names = [tokenizer.decode(label_dict[i], skip_special_tokens=True) for i in range(len(label_dict))]
+    pretrained = "./bert-base-uncased"
+    models = build_experts(train_args, len(label_names), data_path, 'cpu', experts=args.experts,
+                           pretrained=pretrained)
+    for model, checkpoint in zip(models, checkpoints):
+        delta.load_expert(model, checkpoint, pretrained)
+
+    output = args.output or os.path.join(checkpoint_dir, 'ensemble_{}.bin'.format(args.metric))
+    # the logits of the exported experts stay filed under the hashes of their checkpoints
+    export_ensemble(output, models, expert_kwargs(train_args, data_path), registry.label_hierarchy(data_path),
+                    args=vars(train_args), label_names=label_names, thresholds=checkpoints[0].get('thresholds'),
+                    checkpoints=[checkpoint_hash(path) for path in paths])
+    print('exported {} experts to {}'.format(len(models), output))
@@ -0,0 +1,104 @@
+import json
+import os
+import numpy as np
+import torch
+from fairseq.data.indexed_dataset import MMapIndexedDataset, index_file_path, data_file_path
+
+
+class LabelIndex:
+    """
+    Label statistics of an indexed ``Y`` dataset of multi-hot label vectors.
+
+    Holds the number of documents of every class, the ids of those documents as a CSR list
+    (``doc_ids[indptr[c]:indptr[c + 1]]``) and the depth of every class in the hierarchy of
+    ``slot.pt``. It is built once with vectorized reads of the mmap file and cached next to it
+    in ``Y.label_index.npz``; the cache is rebuilt whenever ``Y`` or ``slot.pt`` change.
+    """
+
+    def __init__(self, counts, indptr, doc_ids, depth, num_docs):
+        self.counts = counts
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.depth = depth
+        self.num_docs = num_docs
+
+    @staticmethod
+    def _stamp(data_path):
+        prefix = os.path.join(data_path, 'Y')
+        files = [index_file_path(prefix), data_file_path(prefix), os.path.join(data_path, 'slot.pt')]
+        stamp = {}
+        for name in files:
+            if os.path.exists(name):
+                stat = os.stat(name)
+                stamp[os.path.basename(name)] = [stat.st_size, stat.st_mtime_ns]
+        return json.dumps(stamp, sort_keys=True)
+
+    @classmethod
+    def load(cls, data_path, chunk_size=65536):
+        cache_path = os.path.join(data_path, 'Y.label_index.npz')
+        stamp = cls._stamp(data_path)
+        if os.path.exists(cache_path):
+            cache = np.load(cache_path)
+            if str(cache['stamp']) == stamp:
+                return cls(cache['counts'], cache['indptr'], cache['doc_ids'], cache['depth'], int(cache['num_docs']))
+        index = cls.build(data_path, chunk_size)
+        np.savez(cache_path + '.tmp.npz', stamp=np.array(stamp), counts=index.counts, indptr=index.indptr,
+                 doc_ids=index.doc_ids, depth=index.depth, num_docs=np.array(index.num_docs))
+        os.replace(cache_path + '.tmp.npz', cache_path)
+        return index
+
+    @classmethod
+    def build(cls, data_path, chunk_size=65536):
+        prefix = os.path.join(data_path, 'Y')
+        y_index = MMapIndexedDataset.Index(index_file_path(prefix))
+        sizes = y_index.sizes
+        num_docs, num_class = len(sizes), int(sizes[0])
+        assert (sizes == num_class).all() and y_index[0][0] == 0, 'Y must hold one label vector per document'
+        labels = np.memmap(data_file_path(prefix), dtype=y_index.dtype, mode='r', shape=(num_docs, num_class))
+
+        counts = np.zeros(num_class, dtype=np.int64)
+        docs, classes = [], []
+        for start in range(0, num_docs, chunk_size):
+            positive = np.asarray(labels[start:start + chunk_size]) == 1
+            counts += positive.sum(axis=0)
+            doc, label = np.nonzero(positive)
+            docs.append((doc + start).astype(np.int32))
+            classes.append(label.astype(np.int32))
+        docs, classes = np.concatenate(docs), np.concatenate(classes)
+        doc_ids = docs[np.argsort(classes, kind='stable')]
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+
+        depth = np.zeros(num_class, dtype=np.int64)
+        slot_path = os.path.join(data_path, 'slot.pt')
+        if os.path.exists(slot_path):
+            parent = {}
+            for s, children in torch.load(slot_path).items():
+                for v in children:
+                    parent[v] = s
+            for c in range(num_class):
+                n = c
+                while n in parent and parent[n] != n:
+                    n = parent[n]
+                    depth[c] += 1
+        return cls(counts, indptr, doc_ids, depth, num_docs)
+
+    def docs(self, c):
+        return self.doc_ids[self.indptr[c]:self.indptr[c + 1]]
+
+    @property
+    def level_counts(self):
+        return np.bincount(self.depth, weights=self.counts).astype(np.int64)
+
+    def ldam_margins(self, max_m=0.5):
+        m_list = 1. / np.sqrt(np.sqrt(self.counts))
+        return m_list * (max_m / np.max(m_list))
+
+    def effective_number_weights(self, beta=0.9999):
+        effective_num = 1.0 - np.power(beta, self.counts)
+        per_cls_weights = (1.0 - beta) / np.array(effective_num)
+        return per_cls_weights / np.sum(per_cls_weights) * len(self.counts)
+
+    def diversity_weights(self, reweight_factor=0.05):
+        frequency = self.counts / np.sum(self.counts)
+        per_cls_weights = len(self.counts) * frequency * reweight_factor + 1 - reweight_factor
+        return per_cls_weights / np.max(per_cls_weights)
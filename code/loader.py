@@ -0,0 +1,177 @@
+import collections
+import itertools
+import numpy as np
+import torch
+from torch.utils.data import Sampler, Subset, ConcatDataset
+
+
+def flat_indices(dataset):
+    """Resolves nested Subset / ConcatDataset wrappers to indices of the one dataset underneath."""
+    if isinstance(dataset, Subset):
+        return flat_indices(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([flat_indices(d) for d in dataset.datasets])
+    return np.arange(len(dataset), dtype=np.int64)
+
+
+def kfold_indices(split, n_splits=5):
+    """
+    Cuts the concatenation of ``split['train']`` and ``split['val']`` into ``n_splits`` contiguous
+    folds, the first ``len % n_splits`` of them one document longer.
+
+    :return: List[(train indices, dev indices)], flat np.ndarray indices into the base dataset
+    """
+    combined = np.concatenate([np.asarray(split['train'], dtype=np.int64),
+                               np.asarray(split['val'], dtype=np.int64)])
+    folds = np.array_split(np.arange(len(combined)), n_splits)
+    return [(np.delete(combined, fold), combined[fold]) for fold in folds]
+
+
+class ShuffledBatchSampler(Sampler):
+    """
+    Batches of ``batch_size`` positions in a new random order every epoch, drawn from ``seed`` and the epoch
+    like :class:`TokenBudgetBatchSampler`, so that an epoch can be replayed from any of its batches.
+    """
+
+    def __init__(self, num_items, batch_size, seed=0):
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """``start`` skips the first batches of the epoch, to resume it in the middle."""
+        self.epoch = epoch
+        self.start = start
+
+    def batches(self):
+        order = np.random.RandomState(self.seed + self.epoch).permutation(self.num_items)
+        return [order[start:start + self.batch_size].tolist() for start in range(0, self.num_items, self.batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches()[self.start:])
+
+    def __len__(self):
+        return -(-self.num_items // self.batch_size) - self.start
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batches documents of similar length under a budget of padded tokens.
+
+    Documents are sorted by length and cut into buckets of ``bucket_size`` neighbours. Each bucket
+    is greedily split into batches whose ``batch size * padded length`` stays within
+    ``max_tokens``. When shuffling, documents are shuffled within their bucket and the batches
+    across buckets. Without shuffling the batches come in ascending length order.
+
+    :param lengths: np.ndarray, token count of every position of the dataset being batched
+    """
+
+    def __init__(self, lengths, max_tokens, bucket_size=1024, pad_multiple=1, shuffle=True, seed=0):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.pad_multiple = pad_multiple
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self._batches = None
+
+    def set_epoch(self, epoch, start=0):
+        """``start`` skips the first batches of the epoch, to resume it in the middle."""
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+        self.start = start
+
+    def _padded(self, length):
+        return -(-length // self.pad_multiple) * self.pad_multiple
+
+    def _split(self, bucket):
+        batches = []
+        start = 0
+        longest = 0
+        for end, position in enumerate(bucket):
+            longest_with = max(longest, self._padded(self.lengths[position]))
+            if end > start and (end - start + 1) * longest_with > self.max_tokens:
+                batches.append(bucket[start:end].tolist())
+                start = end
+                longest_with = self._padded(self.lengths[position])
+            longest = longest_with
+        if start < len(bucket):
+            batches.append(bucket[start:].tolist())
+        return batches
+
+    def batches(self):
+        if self._batches is None:
+            if self.shuffle:
+                rng = np.random.RandomState(self.seed + self.epoch)
+                order = rng.permutation(len(self.lengths))
+                order = order[np.argsort(self.lengths[order], kind='stable')]
+            else:
+                order = np.argsort(self.lengths, kind='stable')
+            batches = []
+            for start in range(0, len(order), self.bucket_size):
+                bucket = order[start:start + self.bucket_size]
+                if self.shuffle:
+                    # documents in a bucket have similar lengths, so mixing them costs little padding
+                    bucket = bucket[rng.permutation(len(bucket))]
+                batches += self._split(bucket)
+            if self.shuffle:
+                batches = [batches[i] for i in rng.permutation(len(batches))]
+            self._batches = batches
+        return self._batches
+
+    def __iter__(self):
+        return iter(self.batches()[self.start:])
+
+    def __len__(self):
+        return len(self.batches()) - self.start
+
+
+class Prefetcher:
+    """
+    Copies the batches of a DataLoader to ``device`` up to ``depth`` steps ahead of their use.
+
+    The loader is expected to collate on the CPU into pinned memory, so on CUDA the copies are
+    issued asynchronously on a side stream and the compute stream only waits for the batch it
+    is about to consume.
+    """
+
+    def __init__(self, loader, device, depth=1):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(depth, 1)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _copy(self, batch):
+        data, label, idx = batch
+        if self.stream is None:
+            return data.to(self.device), label.to(self.device), idx, None
+        with torch.cuda.stream(self.stream):
+            data = data.to(self.device, non_blocking=True)
+            label = label.to(self.device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return data, label, idx, ready
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        pending = collections.deque(self._copy(batch) for batch in itertools.islice(batches, self.depth))
+        while pending:
+            data, label, idx, ready = pending.popleft()
+            if ready is not None:
+                stream = torch.cuda.current_stream(self.device)
+                stream.wait_event(ready)
+                # the copies were allocated on the side stream but are freed after use on this one
+                data.record_stream(stream)
+                label.record_stream(stream)
+            batch = next(batches, None)
+            if batch is not None:
+                pending.append(self._copy(batch))
+            yield data, label, idx
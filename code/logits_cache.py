@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+
+def checkpoint_hash(path, chunk_size=1 << 24):
+    """Content hash of a checkpoint file, the key its logits are stored under."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+
+def run_id(checkpoint_dir):
+    """Name of a run in the store, e.g. checkpoints/WebOfScience-test/fold2 -> WebOfScience-test-fold2."""
+    return os.path.relpath(checkpoint_dir, 'checkpoints').replace(os.sep, '-')
+
+
+class LogitsStore:
+    """
+    Per-expert logits of one split on disk, in dataset order, as memory-mapped ``.npy`` files::
+
+        root/<split>/labels.npy             uint8 [N, C] multi-hot ground truth
+        root/<split>/<checkpoint hash>.npy  float16 or float32 [N, C] logits of one expert
+        root/<split>/<run>.json             checkpoint hashes of the experts of a run, in order
+
+    Logits are keyed by the content hash of the checkpoint they come from, so a retrained expert
+    never reuses stale logits and experts of different runs can be fused freely.
+    """
+
+    def __init__(self, root, split):
+        self.path = os.path.join(root, split)
+
+    def logits_path(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def labels(self):
+        return np.load(os.path.join(self.path, 'labels.npy'), mmap_mode='r')
+
+    def logits(self, key):
+        return np.load(self.logits_path(key), mmap_mode='r')
+
+    def experts(self, run):
+        with open(os.path.join(self.path, run + '.json')) as f:
+            return json.load(f)['experts']
+
+    def writer(self, indices, num_class, num_experts, dtype='float16'):
+        """
+        :param indices: np.ndarray, base-dataset indices of the split, in the order rows are stored
+        """
+        return LogitsWriter(self, indices, num_class, num_experts, dtype)
+
+
+class LogitsWriter:
+    """
+    Collects the logits of E experts batch by batch into temporary memmaps, which :meth:`commit`
+    files under checkpoint hashes. Batches may come in any order, rows are placed by dataset index.
+    """
+
+    def __init__(self, store, indices, num_class, num_experts, dtype='float16'):
+        self.store = store
+        os.makedirs(store.path, exist_ok=True)
+        indices = np.asarray(indices, dtype=np.int64)
+        self.position = np.full(indices.max() + 1, -1, dtype=np.int64)
+        self.position[indices] = np.arange(len(indices))
+        prefix = os.path.join(store.path, '.tmp-{}-'.format(os.getpid()))
+        self.labels_path = prefix + 'labels.npy'
+        self.labels = np.lib.format.open_memmap(self.labels_path, mode='w+', dtype=np.uint8,
+                                                shape=(len(indices), num_class))
+        self.logits_paths = [prefix + '{}.npy'.format(i) for i in range(num_experts)]
+        self.logits = [np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(len(indices), num_class))
+                       for path in self.logits_paths]
+
+    def update(self, idx, logits, labels):
+        """
+        :param idx: List[int], dataset indices of the batch
+        :param logits: Tensor [E, B, C], expert logits
+        :param labels: Tensor [B, C], multi-hot ground truth
+        """
+        rows = self.position[np.asarray(idx, dtype=np.int64)]
+        logits = logits.detach().float().cpu().numpy()
+        for store, expert in zip(self.logits, logits):
+            store[rows] = expert
+        self.labels[rows] = labels.cpu().numpy()
+
+    def commit(self, keys, run=None):
+        """Files the logits of expert i under ``keys[i]`` and records them as the experts of ``run``."""
+        for memmap in self.logits + [self.labels]:
+            memmap.flush()
+        labels_path = os.path.join(self.store.path, 'labels.npy')
+        if not os.path.exists(labels_path):
+            shutil.copyfile(self.labels_path, self.labels_path + '.copy')
+            os.replace(self.labels_path + '.copy', labels_path)
+        for key, path in zip(keys, self.logits_paths):
+            if not os.path.exists(self.store.logits_path(key)):
+                shutil.copyfile(path, path + '.copy')
+                os.replace(path + '.copy', self.store.logits_path(key))
+        if run is not None:
+            with open(os.path.join(self.store.path, run + '.json'), 'w') as f:
+                json.dump({'experts': list(keys)}, f, indent=2)
+
+    def close(self):
+        del self.logits, self.labels
+        for path in self.logits_paths + [self.labels_path]:
+            os.remove(path)
@@ -3,6 +3,7 @@ from transformers.models.bert.modeling_bert import BertPreTrainedModel, BertEnco
 from transformers.file_utils import ModelOutput
 from torch.nn import CrossEntropyLoss, MSELoss
 import torch
+import torch.utils.checkpoint
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
@@ -57,32 +58,122 @@ class NTXent(nn.Module):
             nn.Dropout(config.hidden_dropout_prob),
             nn.Linear(config.hidden_size, config.hidden_size),
         )
+        # rows of the 2B x 2B similarity matrix computed at once
+        self.chunk_size = getattr(config, 'contrast_chunk_size', 1024)
+        self._rows = None
+
+    def _arange(self, n, device):
+        if self._rows is None or len(self._rows) < n or self._rows.device != device:
+            self._rows = torch.arange(n, device=device)
+        return self._rows[:n]
+
+    @staticmethod
+    def _block_loss(x, rows, positives):
+        sim = x.index_select(0, rows) @ x.t()
+        sim = sim.scatter(1, rows.unsqueeze(1), -1e9)
+        return F.cross_entropy(sim, positives, reduction='sum')
 
     def forward(self, x, labels=None):
+        """
+        The two views of document i are rows i and i + n / 2 of ``x``. The similarities are computed a block of
+        ``chunk_size`` rows at a time, recomputed in the backward pass when there are several blocks.
+        """
         x = self.transform(x)
         n = x.shape[0]
         x = F.normalize(x, p=2, dim=1) / np.sqrt(self.tau)
-        sim = x @ x.t()
-        sim[np.arange(n), np.arange(n)] = -1e9
-        logprob = F.log_softmax(sim, dim=1)
-        m = 2
-        labels = (np.repeat(np.arange(n), m) + np.tile(np.arange(m) * n // m, n)) % n
-        labels = labels.reshape(n, m)[:, 1:].reshape(-1)
-        loss = -logprob[np.repeat(np.arange(n), m - 1), labels].sum() / n / (m - 1) / self.norm
-        return loss
+        rows = self._arange(n, x.device)
+        positives = (rows + n // 2) % n
+        loss = 0
+        for start in range(0, n, self.chunk_size):
+            block = rows[start:start + self.chunk_size], positives[start:start + self.chunk_size]
+            if n > self.chunk_size and torch.is_grad_enabled() and x.requires_grad:
+                loss = loss + torch.utils.checkpoint.checkpoint(self._block_loss, x, *block)
+            else:
+                loss = loss + self._block_loss(x, *block)
+        return loss / n / self.norm
+
+def asymmetric_loss(x, y, gamma_neg=3, gamma_pos=1, clip=0.05, eps=1e-8, disable_torch_grad_focal_loss=False):
+    """
+    Asymmetric loss, summed: -sum log(q) * (1 - q) ^ gamma, where q is sigmoid(x) for the positive labels and
+    min(1 - sigmoid(x) + clip, 1) for the negative ones. Sigmoid and log are taken once per element.
+
+    :param x: Tensor [B, C], logits
+    :param y: Tensor [B, C], multi-hot targets
+    """
+    positive = y > 0
+    xs_pos = torch.sigmoid(x)
+    xs_neg = 1 - xs_pos
+    if clip is not None and clip > 0:
+        xs_neg = (xs_neg + clip).clamp(max=1)
+    q = torch.where(positive, xs_pos, xs_neg)
+    loss = torch.log(q.clamp(min=eps))
+    if gamma_neg > 0 or gamma_pos > 0:
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not disable_torch_grad_focal_loss):
+            base = 1 - q
+            asymmetric_w = torch.where(positive, base.pow(gamma_pos), base.pow(gamma_neg))
+        loss = loss * asymmetric_w
+    return -loss.sum()
+
+
+def _focal_derivative(base, gamma):
+    if gamma == 0:
+        return torch.zeros_like(base)
+    return gamma * base.pow(gamma - 1)
+
+
+class AsymmetricLossFunction(torch.autograd.Function):
+    """
+    :func:`asymmetric_loss` saving only the logits and targets for the backward pass, which recomputes
+    the elementwise terms of the gradient instead of keeping the B x C intermediates alive.
+    """
+
+    @staticmethod
+    def forward(ctx, x, y, gamma_neg=3, gamma_pos=1, clip=0.05, eps=1e-8, disable_torch_grad_focal_loss=False):
+        ctx.save_for_backward(x, y)
+        ctx.hyper = gamma_neg, gamma_pos, clip, eps, disable_torch_grad_focal_loss
+        return asymmetric_loss(x, y, gamma_neg, gamma_pos, clip, eps)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, y = ctx.saved_tensors
+        gamma_neg, gamma_pos, clip, eps, disable_torch_grad_focal_loss = ctx.hyper
+        positive = y > 0
+        xs_pos = torch.sigmoid(x)
+        d_pos = xs_pos * (1 - xs_pos)
+        xs_neg = 1 - xs_pos
+        d_neg = -d_pos
+        if clip is not None and clip > 0:
+            xs_neg = xs_neg + clip
+            d_neg = d_neg * (xs_neg <= 1).to(x.dtype)
+            xs_neg = xs_neg.clamp(max=1)
+        q = torch.where(positive, xs_pos, xs_neg)
+        dq = torch.where(positive, d_pos, d_neg)
+        grad = dq / q.clamp(min=eps) * (q >= eps).to(x.dtype)
+        if gamma_neg > 0 or gamma_pos > 0:
+            base = 1 - q
+            grad = grad * torch.where(positive, base.pow(gamma_pos), base.pow(gamma_neg))
+            if not disable_torch_grad_focal_loss:
+                # a gamma of 0 has a constant weight, base ** -1 would turn its saturated labels into 0 * inf
+                d_w = torch.where(positive, _focal_derivative(base, gamma_pos), _focal_derivative(base, gamma_neg))
+                grad = grad - torch.log(q.clamp(min=eps)) * d_w * dq
+        return -grad * grad_output, None, None, None, None, None, None
+
 
 class ASLoss(nn.Module):
-    ''' Notice - optimized version, minimizes memory allocation and gpu uploading,
-    favors inplace operations'''
+    """
+    Asymmetric loss of multi-label logits, see :func:`asymmetric_loss`. Keeps no state between calls.
+    With ``recompute``, the gradient is recomputed from the logits by :class:`AsymmetricLossFunction`.
+    """
 
-    def __init__(self, gamma_neg=3, gamma_pos=1, clip=0.05, eps=1e-8, disable_torch_grad_focal_loss=False):
+    def __init__(self, gamma_neg=3, gamma_pos=1, clip=0.05, eps=1e-8, disable_torch_grad_focal_loss=False,
+                 recompute=False):
         super(ASLoss, self).__init__()
         self.gamma_neg = gamma_neg
         self.gamma_pos = gamma_pos
         self.clip = clip
         self.disable_torch_grad_focal_loss = disable_torch_grad_focal_loss
         self.eps = eps
-        self.targets = self.anti_targets = self.xs_pos = self.xs_neg = self.asymmetric_w = self.loss = None
+        self.recompute = recompute
 
     def forward(self, x, y):
         """"
@@ -91,25 +182,11 @@ class ASLoss(nn.Module):
         x: input logits
         y: targets (multi-label binarized vector)
         """
-        self.targets = y
-        self.anti_targets = 1 - y
-        self.xs_pos = torch.sigmoid(x)
-        self.xs_neg = 1.0 - self.xs_pos
-        if self.clip is not None and self.clip > 0:
-            self.xs_neg.add_(self.clip).clamp_(max=1)
-        self.loss = self.targets * torch.log(self.xs_pos.clamp(min=self.eps))
-        self.loss.add_(self.anti_targets * torch.log(self.xs_neg.clamp(min=self.eps)))
-        if self.gamma_neg > 0 or self.gamma_pos > 0:
-            if self.disable_torch_grad_focal_loss:
-                torch.set_grad_enabled(False)
-            self.xs_pos = self.xs_pos * self.targets
-            self.xs_neg = self.xs_neg * self.anti_targets
-            self.asymmetric_w = torch.pow(1 - self.xs_pos - self.xs_neg,
-                                          self.gamma_pos * self.targets + self.gamma_neg * self.anti_targets)
-            if self.disable_torch_grad_focal_loss:
-                torch.set_grad_enabled(True)
-            self.loss *= self.asymmetric_w
-        return -self.loss.sum()
+        if self.recompute and torch.is_grad_enabled() and x.requires_grad:
+            return AsymmetricLossFunction.apply(x, y, self.gamma_neg, self.gamma_pos, self.clip, self.eps,
+                                                self.disable_torch_grad_focal_loss)
+        return asymmetric_loss(x, y, self.gamma_neg, self.gamma_pos, self.clip, self.eps,
+                               self.disable_torch_grad_focal_loss)
 
 class BaseModelOutputWithPoolingAndCrossAttentions(ModelOutput):
     last_hidden_state = None
@@ -120,59 +197,18 @@ class BaseModelOutputWithPoolingAndCrossAttentions(ModelOutput):
     cross_attentions = None
     input_embeds = None
 
-class ASLoss(nn.Module):
-    ''' Notice - optimized version, minimizes memory allocation and gpu uploading,
-    favors inplace operations'''
-
-    def __init__(self, gamma_neg=3, gamma_pos=1, clip=0.05, eps=1e-8, disable_torch_grad_focal_loss=False):
-        super(ASLoss, self).__init__()
-
-        self.gamma_neg = gamma_neg
-        self.gamma_pos = gamma_pos
-        self.clip = clip
-        self.disable_torch_grad_focal_loss = disable_torch_grad_focal_loss
-        self.eps = eps
-        self.targets = self.anti_targets = self.xs_pos = self.xs_neg = self.asymmetric_w = self.loss = None
-
-    def forward(self, x, y):
-        """"
-        Parameters
-        ----------
-        x: input logits
-        y: targets (multi-label binarized vector)
-        """
-        self.targets = y
-        self.anti_targets = 1 - y
-        self.xs_pos = torch.sigmoid(x)
-        self.xs_neg = 1.0 - self.xs_pos
-        if self.clip is not None and self.clip > 0:
-            self.xs_neg.add_(self.clip).clamp_(max=1)
-        self.loss = self.targets * torch.log(self.xs_pos.clamp(min=self.eps))
-        self.loss.add_(self.anti_targets * torch.log(self.xs_neg.clamp(min=self.eps)))
-        if self.gamma_neg > 0 or self.gamma_pos > 0:
-            if self.disable_torch_grad_focal_loss:
-                torch.set_grad_enabled(False)
-            self.xs_pos = self.xs_pos * self.targets
-            self.xs_neg = self.xs_neg * self.anti_targets
-            self.asymmetric_w = torch.pow(1 - self.xs_pos - self.xs_neg,
-                                          self.gamma_pos * self.targets + self.gamma_neg * self.anti_targets)
-            if self.disable_torch_grad_focal_loss:
-                torch.set_grad_enabled(True)
-            self.loss *= self.asymmetric_w
-        return -self.loss.sum()
-
 class MLNS(nn.Module):
     def __init__(self):
         super(MLNS, self).__init__()
 
     def forward(self, x, labels):
+        """
+        sum_ij (|l_i| - l_i . l_j) x_i . x_j over the normalized ``x``, computed as
+        sum_i |l_i| x_i . sum_j x_j - |L^T X|^2 without any B x B matrix.
+        """
         x = F.normalize(x, p=2, dim=1)
-        sim = x @ x.t()
         labels = labels.type(x.dtype)
-        C = labels @ labels.t()
-        beta = labels.sum(dim=1).reshape(-1, 1) - C
-        loss = beta * sim
-        return loss.sum()
+        return (labels.sum(dim=1) * (x @ x.sum(dim=0))).sum() - (labels.t() @ x).pow(2).sum()
 
 class BertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings."""
@@ -376,9 +412,44 @@ class BertModel(BertPreTrainedModel):
             inputs_embeds=inputs_embeds,
         )
 
+    def forward_trunk(self, input_ids, attention_mask, num_layers, token_type_ids=None, embedding_weight=None):
+        """
+        Runs the embeddings and the first ``num_layers`` encoder layers. The returned dict is the
+        ``trunk_output`` accepted by :meth:`forward_top` and :meth:`ContrastModel.forward`.
+        """
+        input_shape = input_ids.size()
+        device = input_ids.device
+        if token_type_ids is None:
+            token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
+        extended_attention_mask = self.get_extended_attention_mask(attention_mask, input_shape, device)
+        hidden_states, inputs_embeds = self.embeddings(
+            input_ids=input_ids,
+            token_type_ids=token_type_ids,
+            embedding_weight=embedding_weight,
+        )
+        for layer_module in self.encoder.layer[:num_layers]:
+            hidden_states = layer_module(hidden_states, attention_mask=extended_attention_mask)[0]
+        return {'hidden_states': hidden_states,
+                'attention_mask': extended_attention_mask,
+                'inputs_embeds': inputs_embeds,
+                'num_layers': num_layers}
+
+    def forward_top(self, trunk_output):
+        """Runs the encoder layers above a trunk computed by :meth:`forward_trunk`."""
+        hidden_states = trunk_output['hidden_states']
+        for layer_module in self.encoder.layer[trunk_output['num_layers']:]:
+            hidden_states = layer_module(hidden_states, attention_mask=trunk_output['attention_mask'])[0]
+        return BaseModelOutputWithPoolingAndCrossAttentions(
+            last_hidden_state=hidden_states,
+            pooler_output=None,
+            inputs_embeds=trunk_output['inputs_embeds'],
+        )
+
+
 class ContrastModel(BertPreTrainedModel):
     def __init__(self, config, cls_loss=True, contrast_loss=True, graph=False, layer=1, data_path=None,
-                multi_label=False, lamb=1, threshold=0.01, tau=1, name=None,NSL=0.01,gama_neg=3,gama_pos=1):
+                multi_label=False, lamb=1, threshold=0.01, tau=1, name=None,NSL=0.01,gama_neg=3,gama_pos=1,
+                asl_recompute=False):
         super(ContrastModel, self).__init__(config)
         self.num_labels = config.num_labels
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
@@ -398,6 +469,11 @@ class ContrastModel(BertPreTrainedModel):
         self.name = name
         self.gama_neg=gama_neg
         self.gama_pos=gama_pos
+        self.asl_lossfct = ASLoss(gamma_neg=gama_neg, gamma_pos=gama_pos, recompute=asl_recompute)
+
+    def contrast_mask(self, inputs_embeds, attention_mask, labels):
+        """Token weights of the contrastive view of a batch, from its word embeddings."""
+        return self.graph_encoder(inputs_embeds, attention_mask, labels, lambda x: self.bert.embeddings(x)[0])
 
     def forward(
             self,
@@ -412,26 +488,52 @@ class ContrastModel(BertPreTrainedModel):
             output_hidden_states=None,
             return_dict=None,
             return_pooled_output=False,
+            trunk_output=None,
+            fuse_contrast=False,
     ):
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
         contrast_mask = None
 
-        outputs = self.bert(
-            input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-            embedding_weight=contrast_mask,
-
-        )
+        if trunk_output is not None:
+            # lower layers were already run by a trunk shared with other experts
+            return_dict = True
+            outputs = self.bert.forward_top(trunk_output)
+            # the trunk may also hold the contrastive view, after the original one
+            contrast_mask = trunk_output.get('contrast_mask')
+        elif fuse_contrast and self.training and labels is not None and input_ids is not None \
+                and attention_mask is not None and not output_attentions and not output_hidden_states:
+            # the contrastive view only depends on the word embeddings, so both views run as one 2B batch
+            return_dict = True
+            inputs_embeds = self.bert.embeddings.word_embeddings(input_ids)
+            contrast_mask = self.contrast_mask(inputs_embeds, attention_mask, labels)
+            outputs = self.bert(
+                attention_mask=torch.cat([attention_mask, attention_mask]),
+                token_type_ids=torch.cat([token_type_ids, token_type_ids]) if token_type_ids is not None else None,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=torch.cat([inputs_embeds, inputs_embeds]),
+                return_dict=return_dict,
+                embedding_weight=torch.cat([torch.ones_like(contrast_mask), contrast_mask]),
+            )
+        else:
+            outputs = self.bert(
+                input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+                embedding_weight=contrast_mask,
+
+            )
         pooled_output = outputs[0]
         pooled_output = self.dropout(self.pooler(pooled_output))
+        if contrast_mask is not None:
+            pooled_output, contrast_sequence_output = pooled_output.chunk(2)
 
         loss = 0
         contrastive_loss = None
@@ -443,7 +545,7 @@ class ContrastModel(BertPreTrainedModel):
                 loss_fct = CrossEntropyLoss()
                 target = labels.view(-1)
             else:
-                loss_fct = ASLoss(gamma_neg=self.gama_neg,gamma_pos=self.gama_pos)
+                loss_fct = self.asl_lossfct
                 target = labels.to(torch.float32)
 
             if self.cls_loss:
@@ -454,21 +556,21 @@ class ContrastModel(BertPreTrainedModel):
                     loss += loss_fct(logits.view(-1, self.num_labels), target)
 
             if self.training:
-                contrast_mask = self.graph_encoder(outputs['inputs_embeds'],
-                                                   attention_mask, labels, lambda x: self.bert.embeddings(x)[0])
-                contrast_output = self.bert(
-                    input_ids,
-                    attention_mask=attention_mask,
-                    token_type_ids=token_type_ids,
-                    position_ids=position_ids,
-                    head_mask=head_mask,
-                    inputs_embeds=None,
-                    output_attentions=output_attentions,
-                    output_hidden_states=output_hidden_states,
-                    return_dict=return_dict,
-                    embedding_weight=contrast_mask,
-                )
-                contrast_sequence_output = self.dropout(self.pooler(contrast_output[0]))
+                if contrast_mask is None:
+                    contrast_mask = self.contrast_mask(outputs['inputs_embeds'], attention_mask, labels)
+                    contrast_output = self.bert(
+                        input_ids,
+                        attention_mask=attention_mask,
+                        token_type_ids=token_type_ids,
+                        position_ids=position_ids,
+                        head_mask=head_mask,
+                        inputs_embeds=None,
+                        output_attentions=output_attentions,
+                        output_hidden_states=output_hidden_states,
+                        return_dict=return_dict,
+                        embedding_weight=contrast_mask,
+                    )
+                    contrast_sequence_output = self.dropout(self.pooler(contrast_output[0]))
                 contrast_logits = self.classifier(contrast_sequence_output)
 
                 contrastive_loss = self.contrastive_lossfct(
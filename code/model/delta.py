@@ -0,0 +1,72 @@
+import hashlib
+import torch
+from . import registry
+from .experts import unwrap
+
+
+def base_key(pretrained):
+    """Hash of the pretrained BERT weights the experts were built from, once an expert has loaded them."""
+
+    def build():
+        state_dict = registry.pretrained_state_dict(pretrained)
+        assert state_dict is not None, 'no expert has been built from {} yet'.format(pretrained)
+        sha = hashlib.sha1()
+        for name in sorted(state_dict):
+            sha.update(name.encode())
+            sha.update(state_dict[name].contiguous().numpy())
+        return sha.hexdigest()[:16]
+
+    return registry.shared(('base_key', pretrained), build)
+
+
+def base_names(model, pretrained):
+    """
+    Names in the state dict of ``model`` of the frozen tensors that still equal the pretrained weights,
+    i.e. what a checkpoint of a LoRA expert can leave out and take from ``pretrained`` again.
+    The fully fine-tuned expert has none.
+    """
+    base = registry.pretrained_state_dict(pretrained)
+    model = unwrap(model)
+    trainable = {name for name, p in model.named_parameters() if p.requires_grad}
+    names = []
+    for name, t in model.state_dict().items():
+        ref = base.get(name)
+        if ref is None or name in trainable or ref.shape != t.shape or ref.dtype != t.dtype:
+            continue
+        if torch.equal(ref, t.cpu()):
+            names.append(name)
+    return names
+
+
+def expert_state(model, pretrained, names):
+    """
+    The state of an expert without the tensors ``names`` (see :func:`base_names`), which are stored
+    by reference to ``pretrained`` and the hash of its weights.
+
+    :return: Dict{'param' -> the remaining state dict of the unwrapped model,
+                  'base' -> Dict{'pretrained', 'key', 'names'}}
+    """
+    names = set(names)
+    state_dict = unwrap(model).state_dict()
+    return {'param': {k: v for k, v in state_dict.items() if k not in names},
+            'base': {'pretrained': pretrained, 'key': base_key(pretrained), 'names': sorted(names)}}
+
+
+def load_expert(model, checkpoint, pretrained):
+    """
+    Loads a checkpoint saved by ``Saver`` into an expert built by ``build_experts`` from ``pretrained``.
+    Checkpoints of the full state dict, without a 'base', load as they are.
+    """
+    base = checkpoint.get('base')
+    if base is None:
+        model.load_state_dict(checkpoint['param'])
+        return model
+    if base['key'] != base_key(pretrained):
+        raise ValueError('checkpoint was trained from {} ({}), not from {} ({})'.format(
+            base['pretrained'], base['key'], pretrained, base_key(pretrained)))
+    missing, unexpected = unwrap(model).load_state_dict(checkpoint['param'], strict=False)
+    missing = set(missing) - set(base['names'])
+    if missing or unexpected:
+        raise RuntimeError('checkpoint does not match the expert, missing keys {}, unexpected keys {}'.format(
+            sorted(missing), unexpected))
+    return model
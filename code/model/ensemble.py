@@ -0,0 +1,171 @@
+import contextlib
+import json
+import struct
+import numpy as np
+import torch
+import torch.nn as nn
+from transformers import BertConfig
+try:
+    from transformers.modeling_utils import no_init_weights
+except ImportError:
+    no_init_weights = None
+from . import registry
+from .contrast_multi import ContrastModel
+from .experts import unwrap
+
+MAGIC = b'ENSEMBLE'
+ALIGN = 64
+# dtypes by name, with the numpy dtype their bytes are mapped as
+DTYPES = {'float32': (torch.float32, np.float32), 'float16': (torch.float16, np.float16),
+          'bfloat16': (torch.bfloat16, np.int16), 'float64': (torch.float64, np.float64),
+          'int64': (torch.int64, np.int64), 'int32': (torch.int32, np.int32), 'bool': (torch.bool, np.bool_)}
+DTYPE_NAMES = {torch_dtype: name for name, (torch_dtype, _) in DTYPES.items()}
+INIT_FUNCTIONS = ['uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'eye_', 'dirac_',
+                  'xavier_uniform_', 'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_', 'sparse_']
+
+
+def inference_tensors(model):
+    """
+    Every parameter and buffer of an expert by name, with LoRA adapters merged into the weights they adapt,
+    so that the expert runs as a plain ContrastModel.
+
+    :return: Dict{name -> Tensor}, Set of the names of trainable tensors
+    """
+    model = unwrap(model)
+    tensors = dict(model.named_parameters())
+    trainable = {name for name, p in tensors.items() if p.requires_grad}
+    tensors.update(model.named_buffers())
+    for prefix, module in model.named_modules():
+        if not hasattr(module, 'lora_A'):
+            continue
+        for name in [name for name in tensors if name.startswith(prefix + '.lora_')]:
+            del tensors[name]
+        if not module.merged:
+            tensors[prefix + '.weight'] = module.weight + module.get_delta_weight(module.active_adapter)
+        trainable.add(prefix + '.weight')
+    return tensors, trainable & set(tensors)
+
+
+def export_ensemble(path, models, model_kwargs, label_hierarchy, **meta):
+    """
+    Writes the experts into one file that :func:`load_ensemble` maps into memory: a JSON header with the BERT
+    config, ``model_kwargs`` of ContrastModel, ``label_hierarchy`` and ``meta``, e.g. the training arguments,
+    label names and thresholds, followed by the raw bytes of every tensor, each stored once however many
+    experts share it.
+    """
+    blobs = []
+    experts = []
+    index = {}
+    # every expert's tensors stay alive until all are indexed, so that no merged LoRA weight, a temporary,
+    # can reuse the id of an earlier one
+    exported = [inference_tensors(model) for model in models]
+    for tensors, trainable in exported:
+        names = {}
+        for name, tensor in tensors.items():
+            if id(tensor) not in index:
+                index[id(tensor)] = len(blobs)
+                blobs.append(tensor.detach().cpu().contiguous())
+            names[name] = index[id(tensor)]
+        experts.append({'tensors': names, 'trainable': sorted(trainable)})
+    layout = []
+    offset = 0
+    for blob in blobs:
+        layout.append({'dtype': DTYPE_NAMES[blob.dtype], 'shape': list(blob.shape), 'offset': offset})
+        offset += -(-blob.numel() * blob.element_size() // ALIGN) * ALIGN
+    header = json.dumps({'config': unwrap(models[0]).config.to_dict(), 'model_kwargs': model_kwargs,
+                         'label_hierarchy': {str(k): sorted(v) for k, v in label_hierarchy.items()},
+                         'experts': experts, 'blobs': layout, 'meta': meta}).encode()
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for blob, entry in zip(blobs, layout):
+            f.seek(start + entry['offset'])
+            f.write((blob.view(torch.int16) if blob.dtype == torch.bfloat16 else blob).numpy().tobytes())
+        f.truncate(start + offset)
+
+
+@contextlib.contextmanager
+def _skip_init():
+    """
+    Builds modules without initializing their weights, which are all assigned from the file afterwards,
+    and with torch >= 2.0 on the meta device, without allocating them either.
+    """
+    saved = {name: getattr(nn.init, name) for name in INIT_FUNCTIONS if hasattr(nn.init, name)}
+    for name in saved:
+        setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        with contextlib.ExitStack() as stack:
+            if hasattr(torch.device, '__enter__'):
+                stack.enter_context(torch.device('meta'))
+            if no_init_weights is not None:
+                stack.enter_context(no_init_weights())
+            yield
+    finally:
+        for name, init in saved.items():
+            setattr(nn.init, name, init)
+
+
+def _assign(model, name, tensor, parameters, trainable):
+    module_name, _, leaf = name.rpartition('.')
+    module = model.get_submodule(module_name) if module_name else model
+    if leaf in module._parameters:
+        # experts sharing a tensor share the parameter, as after registry.tie_frozen
+        if id(tensor) not in parameters:
+            parameters[id(tensor)] = nn.Parameter(tensor, requires_grad=trainable)
+        module._parameters[leaf] = parameters[id(tensor)]
+    else:
+        module._buffers[leaf] = tensor
+
+
+def load_ensemble(path, device='cpu'):
+    """
+    The experts written by :func:`export_ensemble`, in eval mode. On the CPU their tensors are views into the
+    memory-mapped file, read from disk as they are first used, and tensors the experts share stay shared.
+
+    :return: List[ContrastModel], Dict meta
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not an exported ensemble'.format(path))
+        length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length).decode())
+    start = -(-(len(MAGIC) + 8 + length) // ALIGN) * ALIGN
+    # copy-on-write, so that the tensors are writable without ever writing to the file
+    data = np.memmap(path, mode='c', offset=start) if header['blobs'] else None
+    blobs = []
+    for entry in header['blobs']:
+        dtype, np_dtype = DTYPES[entry['dtype']]
+        count = int(np.prod(entry['shape']))
+        array = np.frombuffer(data, dtype=np_dtype, count=count, offset=entry['offset'])
+        tensor = torch.from_numpy(array).view(entry['shape'])
+        if dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        blobs.append(tensor.to(device))
+
+    kwargs = header['model_kwargs']
+    config = BertConfig.from_dict(header['config'])
+    tensors = {name: blobs[i] for name, i in header['experts'][0]['tensors'].items()}
+    hierarchy = {name: tensors['graph_encoder.' + name] for name in ['label_path', 'distance_mat', 'edge_mat']
+                 if 'graph_encoder.' + name in tensors}
+    if 'distance_mat' in hierarchy:
+        num_class = hierarchy['label_path'].size(0)
+        hierarchy['distance_mat'] = hierarchy['distance_mat'].view(num_class, num_class)
+        hierarchy['edge_mat'] = hierarchy['edge_mat'].view(num_class, num_class, -1)
+    registry.preload(kwargs['data_path'], tensors['graph_encoder.label_name'].tolist(),
+                     {int(k): set(v) for k, v in header['label_hierarchy'].items()}, hierarchy)
+
+    models = []
+    parameters = {}
+    for expert in header['experts']:
+        with _skip_init():
+            model = ContrastModel(config, **kwargs)
+        trainable = set(expert['trainable'])
+        for name, i in expert['tensors'].items():
+            _assign(model, name, blobs[i], parameters, name in trainable)
+        missing = [name for name, t in list(model.named_parameters()) + list(model.named_buffers())
+                   if t.device.type == 'meta']
+        if missing:
+            raise RuntimeError('{} has no tensors for {}'.format(path, missing))
+        model.eval()
+        models.append(model)
+    return models, header['meta']
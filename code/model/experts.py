@@ -0,0 +1,165 @@
+import re
+import torch
+from .fusion import decided
+
+
+def unwrap(model):
+    """Returns the ContrastModel behind an expert, which may be wrapped by PEFT."""
+    if hasattr(model, 'get_base_model'):
+        return model.get_base_model()
+    return model
+
+
+def lora_split_layer(target_modules):
+    """The first encoder layer touched by LoRA; everything below it stays frozen."""
+    layers = [int(n) for module in target_modules for n in re.findall(r'encoder\.layer\.(\d+)\.', module)]
+    return min(layers)
+
+
+def _trunk_parameters(model, num_layers):
+    bert = unwrap(model).bert
+    params = list(bert.embeddings.named_parameters())
+    for i, layer in enumerate(bert.encoder.layer[:num_layers]):
+        params += [('{}.{}'.format(i, name), p) for name, p in layer.named_parameters()]
+    return params
+
+
+def _same_trunk(model, reference, num_layers):
+    params = _trunk_parameters(model, num_layers)
+    if any(p.requires_grad for _, p in params):
+        return False
+    ref_params = dict(_trunk_parameters(reference, num_layers))
+    for name, p in params:
+        ref = ref_params.get(name)
+        if ref is None or ref.shape != p.shape:
+            return False
+        if ref is not p and not torch.equal(ref.data, p.data):
+            return False
+    return True
+
+
+class ExpertRunner:
+    """
+    Runs every expert of the ensemble on a batch.
+
+    With ``split_layer`` set, the experts whose embeddings and first ``split_layer`` encoder layers
+    are frozen and identical (the LoRA experts, which only adapt the top layer) share one trunk
+    pass per batch, and only the layers above it plus the heads run per expert. Otherwise every
+    expert runs its full BERT, as before.
+
+    With ``fuse_contrast``, training runs the original and the contrastive view of the batch through
+    BERT as one batch of twice the size instead of two passes one after the other. The contrastive
+    views of the experts sharing the trunk also go through the trunk together, as one batch.
+    """
+
+    def __init__(self, models, split_layer=None, fuse_contrast=False):
+        self.models = models
+        self.split_layer = split_layer
+        self.fuse_contrast = fuse_contrast
+        self.shared = []
+        if split_layer is not None:
+            for i, model in enumerate(models):
+                reference = models[self.shared[0]] if self.shared else model
+                if _same_trunk(model, reference, split_layer):
+                    self.shared.append(i)
+            if len(self.shared) < 2:
+                self.shared = []
+
+    def trunk(self, input_ids, attention_mask):
+        bert = unwrap(self.models[self.shared[0]]).bert
+        with torch.no_grad():
+            return bert.forward_trunk(input_ids, attention_mask, self.split_layer)
+
+    def contrast_trunks(self, input_ids, attention_mask, labels, trunk_output):
+        """
+        Per shared expert, the trunk output of the original view followed by its contrastive view,
+        the contrastive views of all shared experts computed in one pass.
+        """
+        masks = [unwrap(self.models[i]).contrast_mask(trunk_output['inputs_embeds'], attention_mask, labels)
+                 for i in self.shared]
+        bert = unwrap(self.models[self.shared[0]]).bert
+        # the trunk is frozen, it only needs a graph if the masks are trained
+        with torch.set_grad_enabled(torch.is_grad_enabled() and any(mask.requires_grad for mask in masks)):
+            contrast = bert.forward_trunk(input_ids.repeat(len(masks), 1), attention_mask.repeat(len(masks), 1),
+                                          self.split_layer, embedding_weight=torch.cat(masks))
+        attention = torch.cat([trunk_output['attention_mask'], trunk_output['attention_mask']])
+        return [dict(trunk_output, hidden_states=torch.cat([trunk_output['hidden_states'], hidden_states]),
+                     attention_mask=attention, contrast_mask=mask)
+                for hidden_states, mask in zip(contrast['hidden_states'].chunk(len(masks)), masks)]
+
+    def __call__(self, input_ids, attention_mask, **kwargs):
+        trunk_outputs = {}
+        if self.shared:
+            trunk_output = self.trunk(input_ids, attention_mask)
+            if self.fuse_contrast and kwargs.get('labels') is not None and self.models[self.shared[0]].training:
+                trunk_outputs = dict(zip(self.shared, self.contrast_trunks(input_ids, attention_mask,
+                                                                           kwargs['labels'], trunk_output)))
+            else:
+                trunk_outputs = {i: trunk_output for i in self.shared}
+        outputs = []
+        for i, model in enumerate(self.models):
+            if i in trunk_outputs:
+                outputs.append(model(input_ids, attention_mask, trunk_output=trunk_outputs[i], **kwargs))
+            else:
+                outputs.append(model(input_ids, attention_mask, fuse_contrast=self.fuse_contrast, **kwargs))
+        return outputs
+
+
+class ExpertCascade:
+    """
+    Runs the experts of an :class:`ExpertRunner` in order at inference, each only on the documents that are still
+    undecided, i.e. for which no expert so far met the exit condition of :func:`model.fusion.decided`.
+
+    Every document gets the logits of ``fusion`` over the experts it went through, so the documents that run all
+    of them get exactly those of the full ensemble. The LoRA experts sharing a trunk compute it once, on the
+    documents left at the first of them.
+    """
+
+    def __init__(self, runner, fusion, bound, criterion='prefix'):
+        self.runner = runner
+        self.fusion = fusion
+        self.bound = bound
+        self.criterion = criterion
+
+    def __call__(self, input_ids, attention_mask):
+        """
+        :return: Dict{'logits' -> [B, C] fused logits, 'depth' -> [B] experts run per document,
+                 'uncertainty' -> [E, B], NaN for the experts a document skipped}
+        """
+        num_experts = len(self.runner.models)
+        batch_size = input_ids.size(0)
+        rows = torch.arange(batch_size, device=input_ids.device)
+        depth = torch.full_like(rows, num_experts)
+        uncertainty = torch.full((num_experts, batch_size), float('nan'), device=input_ids.device)
+        logits = None
+        trunk_output = None
+        prefix = b0 = None
+        for i, model in enumerate(self.runner.models):
+            if i in self.runner.shared:
+                if trunk_output is None:
+                    trunk_output = self.runner.trunk(input_ids[rows], attention_mask[rows])
+                    trunk_rows = torch.full_like(depth, -1)
+                    trunk_rows[rows] = torch.arange(len(rows), device=rows.device)
+                # the documents left are a subset of those the trunk ran on
+                position = trunk_rows[rows]
+                output = model(input_ids[rows], attention_mask[rows], return_dict=True,
+                               trunk_output={k: v[position] if torch.is_tensor(v) else v
+                                             for k, v in trunk_output.items()})
+            else:
+                output = model(input_ids[rows], attention_mask[rows], return_dict=True)
+            x = output['logits']
+            if logits is None:
+                logits = x.new_zeros(num_experts, batch_size, x.size(-1))
+            logits[i, rows] = x
+            b, u = self.fusion.evidence(x)
+            uncertainty[i, rows] = u.to(uncertainty.dtype)
+            if i == num_experts - 1:
+                break
+            # in the order of EvidentialFusion, so that the same documents stop as there
+            prefix = u if b0 is None else prefix * (u / (1 - self.fusion.conflict(b0, b)))
+            stop = decided(prefix, u, self.bound, self.criterion)
+            depth[rows[stop]] = i + 1
+            rows, prefix, b0 = rows[~stop], prefix[~stop], b[~stop]
+            if not len(rows):
+                break
+        return {'logits': self.fusion.truncated(logits, depth), 'depth': depth, 'uncertainty': uncertainty}
@@ -0,0 +1,150 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class EvidentialFusion(nn.Module):
+    """
+    Fuses the logits of E experts through their Dirichlet evidence.
+
+    Each expert's logits give alpha = exp(x) + 1, belief b = (alpha - 1) / S and uncertainty
+    u = C / S. The prefix weight of expert m is the product of u / (1 - conflict) over the experts
+    before it, where the conflict of an expert with its predecessor is the off-diagonal sum of the
+    outer product of their beliefs, i.e. sum(b0) * sum(b) - b0 . b. The fused logits are the mean
+    of the experts reweighted by softmax(w / eta) over the experts.
+    """
+
+    def __init__(self, eta=0.91):
+        super(EvidentialFusion, self).__init__()
+        self.eta = eta
+
+    @staticmethod
+    def evidence(logits):
+        """
+        :param logits: Tensor [..., C]
+        :return: belief [..., C], uncertainty [...]
+        """
+        alpha = torch.exp(logits) + 1
+        S = alpha.sum(dim=-1)
+        return (alpha - 1) / S.unsqueeze(-1), logits.size(-1) / S
+
+    @staticmethod
+    def conflict(b0, b):
+        """Conflict of the beliefs ``b`` [..., C] of an expert with those ``b0`` of the one before it."""
+        return b0.sum(dim=-1) * b.sum(dim=-1) - (b0 * b).sum(dim=-1)
+
+    def forward(self, logits):
+        """
+        :param logits: Tensor [E, B, C], stacked expert logits
+        :return: Dict{'logits' -> [B, C] fused logits, 'prefix_weights' -> [E, B],
+                 'weights' -> [E, B] normalized fusion weights, 'uncertainty' -> [E, B]}
+        """
+        b, u = self.evidence(logits)
+        conflict = self.conflict(b[:-1], b[1:])
+        ones = torch.ones_like(u[:1])
+        ratio = u[:-1] / torch.cat([ones, 1 - conflict], dim=0)[:-1]
+        prefix = torch.cat([ones, torch.cumprod(ratio, dim=0)], dim=0)
+
+        weights = torch.softmax(prefix / self.eta, dim=0)
+        fused = (logits * weights.unsqueeze(-1)).mean(dim=0)
+        return {'logits': fused,
+                'prefix_weights': prefix,
+                'weights': weights,
+                'uncertainty': u}
+
+    def truncated(self, logits, depth):
+        """
+        Fused logits of the first ``depth`` experts of each document, fused as an ensemble of that many experts.
+        The logits of the experts after them are never read.
+
+        :param logits: Tensor [E, B, C], stacked expert logits
+        :param depth: LongTensor [B], experts per document, from 1 to E
+        :return: Tensor [B, C]
+        """
+        fused = logits.new_empty(logits.shape[1:])
+        for m in torch.unique(depth).tolist():
+            index = (depth == m).nonzero().squeeze(1)
+            fused[index] = self.forward(logits[:m, index])['logits']
+        return fused
+
+
+CASCADE_CRITERIA = ['prefix', 'uncertainty']
+
+
+def decided(next_prefix_weights, uncertainty, bound, criterion='prefix'):
+    """
+    Whether a cascade stops after an expert: once the prefix weight the next expert would get is below ``bound``,
+    or with ``criterion`` 'uncertainty' once the uncertainty of the expert itself is.
+    """
+    if criterion == 'prefix':
+        return next_prefix_weights < bound
+    if criterion == 'uncertainty':
+        return uncertainty < bound
+    raise ValueError('unknown criterion {}'.format(criterion))
+
+
+def cascade_depth(prefix_weights, uncertainty, bound, criterion='prefix'):
+    """
+    Experts a cascade runs on each document, from the outputs of :class:`EvidentialFusion` on all experts.
+    Prefix weights only depend on the experts before, so this is where running them in order stops.
+
+    :param prefix_weights: Tensor [E, B]
+    :param uncertainty: Tensor [E, B]
+    :return: LongTensor [B], from 1 to E
+    """
+    stop = decided(prefix_weights[1:], uncertainty[:-1], bound, criterion)
+    return (stop.long().cumsum(dim=0) == 0).sum(dim=0) + 1
+
+
+class EvidentialExpertLoss(nn.Module):
+    """
+    Gated evidential loss of all experts in one batched pass.
+
+    Every expert gets the margin-adjusted Dirichlet NLL on the first gold label plus the annealed KL
+    term towards the uniform Dirichlet. An expert only learns from the samples where its prefix
+    weight, normalized by the largest one of the sample, is above ``ta``; its own model loss is
+    counted once per kept sample. Expert 0 has the constant prefix weight 1 and keeps every sample.
+    """
+
+    def __init__(self, m_list, per_cls_weights=None, ta=0.5):
+        super(EvidentialExpertLoss, self).__init__()
+        self.ta = ta
+        self.register_buffer('m_list', m_list)
+        self.register_buffer('per_cls_weights', per_cls_weights)
+
+    def gate(self, prefix_weights):
+        mask = prefix_weights / prefix_weights.max(dim=0, keepdim=True)[0] > self.ta
+        mask[0] = True
+        return mask
+
+    def forward(self, logits, labels, prefix_weights, expert_losses, kl_weight):
+        """
+        :param logits: Tensor [E, B, C], expert logits
+        :param labels: Tensor [B, C], multi-hot ground truth
+        :param prefix_weights: Tensor [E, B], from EvidentialFusion
+        :param expert_losses: Tensor [E], the loss returned by each expert model
+        :param kl_weight: Float, annealing coefficient of the KL term
+        :return: scalar loss summed over experts
+        """
+        num_classes = logits.size(-1)
+        labels = labels.to(logits.dtype)
+        y = torch.argmax(labels, dim=1)
+        index = F.one_hot(y, num_classes).bool()
+        x = torch.where(index, logits - self.m_list[y].view(1, -1, 1), logits)
+
+        target = y.view(1, -1, 1).expand(x.size(0), -1, 1)
+        nll = torch.logsumexp(x, dim=-1) - x.gather(-1, target).squeeze(-1)
+        if self.per_cls_weights is not None:
+            nll = nll * self.per_cls_weights[y]
+
+        alpha_tilde = labels + (1 - labels) * (torch.exp(x) + 1)
+        S_tilde = alpha_tilde.sum(dim=-1)
+        kl = torch.lgamma(S_tilde) - math.lgamma(num_classes) - torch.lgamma(alpha_tilde).sum(dim=-1) \
+             + ((alpha_tilde - 1) * (torch.digamma(alpha_tilde) - torch.digamma(S_tilde).unsqueeze(-1))).sum(dim=-1)
+        sample_loss = nll + kl_weight * kl
+
+        mask = self.gate(prefix_weights)
+        kept = mask.sum(dim=1).to(logits.dtype)
+        sample_loss = torch.where(mask, sample_loss, torch.zeros_like(sample_loss))
+        return (expert_losses * kept).sum() + sample_loss.sum()
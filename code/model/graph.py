@@ -1,11 +1,12 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from transformers import AutoTokenizer
+import torch.utils.checkpoint
 from transformers.activations import ACT2FN
-import os
 
 from torch_geometric.nn import GCNConv, GATConv
+from .hierarchy import hierarchy_bias, HierarchyBias
+from . import registry
 
 GRAPH = "GRAPHORMER"
 
@@ -106,6 +107,16 @@ class BartAttention(nn.Module):
         value_states = value_states.view(*proj_shape)
 
         src_len = key_states.size(1)
+        if callable(extra_attn):
+            assert attention_mask is None and not output_attentions, 'chunked attention has no mask or weights'
+            attn_output = self._chunked_attention(query_states, key_states, value_states, extra_attn)
+            attn_output = (
+                attn_output.view(bsz, self.num_heads, tgt_len, self.head_dim)
+                .transpose(1, 2)
+                .reshape(bsz, tgt_len, embed_dim)
+            )
+            return self.out_proj(attn_output), None, past_key_value
+
         attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
         if extra_attn is not None:
             attn_weights += extra_attn
@@ -158,6 +169,39 @@ class BartAttention(nn.Module):
         return attn_output, attn_weights_reshaped, past_key_value
 
 
+    def shared_keys(self, key_value_states):
+        """Keys [heads, S, head_dim] of ``key_value_states`` [S, E], projected once for every query of the batch."""
+        return self.k_proj(key_value_states).view(-1, self.num_heads, self.head_dim).transpose(0, 1)
+
+    def mean_attention(self, hidden_states, key_states):
+        """Attention probabilities of ``hidden_states`` [B, T, E] over ``key_states``, averaged over heads: [B, T, S]."""
+        bsz, tgt_len, _ = hidden_states.size()
+        query_states = self._shape(self.q_proj(hidden_states) * self.scaling, tgt_len, bsz)
+        return F.softmax(torch.matmul(query_states, key_states.transpose(1, 2)), dim=-1).mean(dim=1)
+
+    def _chunked_attention(self, query_states, key_states, value_states, extra_attn):
+        """
+        Attention a chunk of ``extra_attn.chunk_size`` queries at a time, with the bias of each chunk
+        computed by ``extra_attn(start, end)``. When training, chunks are recomputed in the backward
+        pass, so only one chunk of attention weights is alive at any time.
+        """
+
+        def attend(query, key, value, start):
+            attn_weights = torch.bmm(query, key.transpose(1, 2)) + extra_attn(start, start + query.size(1))
+            attn_weights = F.softmax(attn_weights, dim=-1)
+            attn_probs = F.dropout(attn_weights, p=self.dropout, training=self.training)
+            return torch.bmm(attn_probs, value)
+
+        outputs = []
+        for start in range(0, query_states.size(1), extra_attn.chunk_size):
+            query = query_states[:, start:start + extra_attn.chunk_size]
+            if self.training and torch.is_grad_enabled():
+                outputs.append(torch.utils.checkpoint.checkpoint(attend, query, key_states, value_states, start))
+            else:
+                outputs.append(attend(query, key_states, value_states, start))
+        return torch.cat(outputs, dim=1)
+
+
 class GraphLayer(nn.Module):
     def __init__(self, config, last=False):
         super(GraphLayer, self).__init__()
@@ -194,17 +238,13 @@ class GraphLayer(nn.Module):
         self.output_layer_norm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, label_emb, extra_attn, self_attn_mask, inputs_embeds, cross_attn_mask):
+    def forward(self, label_emb, extra_attn, self_attn_mask=None):
         if GRAPH == 'GRAPHORMER':
             label_emb = self.hir_attn(label_emb,
                                       attention_mask=self_attn_mask, extra_attn=extra_attn)[0]
         elif GRAPH == 'GCN' or GRAPH == 'GAT':
             label_emb = self.hir_attn(label_emb.squeeze(0), edge_index=extra_attn)
         if self.last:
-            label_emb = label_emb.expand(inputs_embeds.size(0), -1, -1)
-            label_emb = self.cross_attn(inputs_embeds, label_emb,
-                                        attention_mask=cross_attn_mask.unsqueeze(1), output_attentions=True,
-                                        only_attn=True)
             return label_emb
 
         label_emb = self.output_layer_norm(self.dropout(self.output_layer(label_emb)) + label_emb)
@@ -212,29 +252,55 @@ class GraphLayer(nn.Module):
             label_emb = self.dropout(self.classifier(label_emb))
         return label_emb
 
+    def gold_label_weights(self, inputs_embeds, label_emb, labels, tau=1, budget=1 << 24):
+        """
+        Gumbel-softmax over the labels of the head-averaged token to label attention, summed over the gold labels.
+        Tokens attend to the labels a chunk at a time, at most ``budget`` attention probabilities per chunk, and
+        chunks are recomputed in the backward pass, so no B x heads x T x L tensor is ever alive.
+
+        :param inputs_embeds: Tensor [B, T, H]
+        :param label_emb: Tensor [L, H]
+        :param labels: Tensor [B, L], multi-hot
+        :return: Tensor [B, T]
+        """
+        key_states = self.cross_attn.shared_keys(label_emb)
+        labels = labels.unsqueeze(1)
+
+        def weights(queries, keys, labels):
+            token_probs = self.cross_attn.mean_attention(queries, keys)
+            return (F.gumbel_softmax(token_probs, hard=False, dim=-1, tau=tau) * labels).sum(-1)
+
+        bsz, tgt_len, _ = inputs_embeds.size()
+        chunk_size = max(1, budget // (bsz * self.cross_attn.num_heads * label_emb.size(0)))
+        if chunk_size >= tgt_len:
+            return weights(inputs_embeds, key_states, labels)
+        outputs = []
+        for start in range(0, tgt_len, chunk_size):
+            queries = inputs_embeds[:, start:start + chunk_size]
+            if self.training and torch.is_grad_enabled() and (queries.requires_grad or key_states.requires_grad):
+                outputs.append(torch.utils.checkpoint.checkpoint(weights, queries, key_states, labels))
+            else:
+                outputs.append(weights(queries, key_states, labels))
+        return torch.cat(outputs, dim=1)
+
 
 class GraphEncoder(nn.Module):
     def __init__(self, config, graph=False, layer=1, data_path=None, threshold=0.01, tau=1):
         super(GraphEncoder, self).__init__()
         self.config = config
         self.tau = tau
-        self.label_dict = torch.load(os.path.join(data_path,
-                                                  'bert_value_dict.pt'))
-        self.tokenizer = AutoTokenizer.from_pretrained("./bert-base-uncased")
-
-        self.label_dict = {i: self.tokenizer.decode(v) for i, v in self.label_dict.items()}
-        self.label_name = []
-        for i in range(len(self.label_dict)):
-            self.label_name.append(self.label_dict[i])
-        self.label_name = self.tokenizer(self.label_name, padding='longest')['input_ids']
+        self.tokenizer = registry.tokenizer()
+        self.label_name = registry.label_name_ids(data_path)
         self.label_name = nn.Parameter(torch.tensor(self.label_name, dtype=torch.long), requires_grad=False)
         self.hir_layers = nn.ModuleList([GraphLayer(config, last=i == layer - 1) for i in range(layer)])
         self.label_num = len(self.label_name)
         self.graph = graph
         self.threshold = threshold
+        # token to label attention entries computed at once by the last layer
+        self.token_label_budget = getattr(config, 'token_label_budget', 1 << 24)
 
         if graph:
-            label_hier = torch.load(os.path.join(data_path, 'slot.pt'))
+            label_hier = registry.label_hierarchy(data_path)
             path_dict = {}
             num_class = 0
             for s in label_hier:
@@ -247,94 +313,68 @@ class GraphEncoder(nn.Module):
                 for i in range(num_class):
                     if i not in path_dict:
                         path_dict[i] = i
-                self.inverse_label_list = {}
-                def get_root(path_dict, n):
-                    ret = []
-                    while path_dict[n] != n:
-                        ret.append(n)
-                        n = path_dict[n]
-                    ret.append(n)
-                    return ret
-
-                for i in range(num_class):
-                    self.inverse_label_list.update({i: get_root(path_dict, i) + [-1]})
-                label_range = torch.arange(len(self.inverse_label_list))
-                self.label_id = label_range
-                node_list = {}
-
-                def get_distance(node1, node2):
-                    p = 0
-                    q = 0
-                    node_list[(node1, node2)] = a = []
-                    node1 = self.inverse_label_list[node1]
-                    node2 = self.inverse_label_list[node2]
-                    while p < len(node1) and q < len(node2):
-                        if node1[p] > node2[q]:
-                            a.append(node1[p])
-                            p += 1
-
-                        elif node1[p] < node2[q]:
-                            a.append(node2[q])
-                            q += 1
-
-                        else:
-                            break
-                    return p + q
-                self.distance_mat = self.label_id.reshape(1, -1).repeat(self.label_id.size(0), 1)
-                hier_mat_t = self.label_id.reshape(-1, 1).repeat(1, self.label_id.size(0))
-                self.distance_mat.map_(hier_mat_t, get_distance)
-                self.distance_mat = self.distance_mat.view(1, -1)
-                self.edge_mat = torch.zeros(len(self.inverse_label_list), len(self.inverse_label_list), 15,
-                                            dtype=torch.long)
-                for i in range(len(self.inverse_label_list)):
-                    for j in range(len(self.inverse_label_list)):
-                        edge_list = node_list[(i, j)]
-                        self.edge_mat[i, j, :len(edge_list)] = torch.tensor(edge_list) + 1
-                self.edge_mat = self.edge_mat.view(-1, self.edge_mat.size(-1))
-                self.id_embedding = nn.Embedding(len(self.inverse_label_list) + 1, config.hidden_size,
-                                                 len(self.inverse_label_list))
+                self.label_id = torch.arange(num_class)
+                # dense L x L distance and edge tensors only for small taxonomies, larger ones compute the bias
+                # from the root paths, a chunk of labels fitting in hierarchy_budget bias entries at a time
+                self.chunk_size = max(1, getattr(config, 'hierarchy_budget', 1 << 22) // num_class)
+                self.dense = num_class <= getattr(config, 'hierarchy_dense_limit', 1024)
+                hierarchy = registry.hierarchy(data_path, num_class, self.dense)
+                self.register_buffer('label_path', hierarchy['label_path'], persistent=False)
+                if self.dense:
+                    self.distance_mat = nn.Parameter(hierarchy['distance_mat'].view(1, -1), requires_grad=False)
+                    self.edge_mat = nn.Parameter(hierarchy['edge_mat'].view(num_class * num_class, -1),
+                                                 requires_grad=False)
+                self._register_load_state_dict_pre_hook(self._convert_hierarchy_state)
+                self.id_embedding = nn.Embedding(num_class + 1, config.hidden_size, num_class)
                 self.distance_embedding = nn.Embedding(20, 1, 0)
-                self.edge_embedding = nn.Embedding(len(self.inverse_label_list) + 1, 1, 0)
+                self.edge_embedding = nn.Embedding(num_class + 1, 1, 0)
                 self.label_id = nn.Parameter(self.label_id, requires_grad=False)
-                self.edge_mat = nn.Parameter(self.edge_mat, requires_grad=False)
-                self.distance_mat = nn.Parameter(self.distance_mat, requires_grad=False)
             self.edge_list = [[v, i] for v, i in path_dict.items()]
             self.edge_list += [[i, v] for v, i in path_dict.items()]
             self.edge_list = nn.Parameter(torch.tensor(self.edge_list).transpose(0, 1), requires_grad=False)
 
+    def _convert_hierarchy_state(self, state_dict, prefix, *args):
+        # the dense tensors only depend on slot.pt, so checkpoints load whichever way the bias is computed
+        for name in ['distance_mat', 'edge_mat']:
+            if not self.dense:
+                state_dict.pop(prefix + name, None)
+            elif prefix + name not in state_dict:
+                state_dict[prefix + name] = getattr(self, name)
+
     def forward(self, inputs_embeds, attention_mask, labels, embeddings):
         label_mask = self.label_name != self.tokenizer.pad_token_id
         label_emb = embeddings(self.label_name)
         label_emb = (label_emb * label_mask.unsqueeze(-1)).sum(dim=1) / label_mask.sum(dim=1).unsqueeze(-1)
         label_emb = label_emb.unsqueeze(0)
-        label_attn_mask = torch.ones(1, label_emb.size(1), device=label_emb.device)
         extra_attn = None
-        self_attn_mask = (label_attn_mask * 1.).t().mm(label_attn_mask * 1.).unsqueeze(0).unsqueeze(0)
-        cross_attn_mask = (attention_mask * 1.).unsqueeze(-1).bmm(
-            (label_attn_mask.unsqueeze(0) * 1.).repeat(attention_mask.size(0), 1, 1))
         expand_size = label_emb.size(-2) // self.label_name.size(0)  
         if self.graph:
             if GRAPH == 'GRAPHORMER':
                 label_emb += self.id_embedding(self.label_id[:, None].expand(-1, expand_size)).view(1, -1,
                                                                                                     self.config.hidden_size)
-                extra_attn = self.distance_embedding(self.distance_mat) + self.edge_embedding(self.edge_mat).sum(
-                    dim=1) / (
-                                     self.distance_mat.view(-1, 1) + 1e-8)
-                extra_attn = extra_attn.view(self.label_num, 1, self.label_num, 1).expand(-1, expand_size, -1,
-                                                                                          expand_size)
-                extra_attn = extra_attn.reshape(self.label_num * expand_size, -1)
+                if self.dense:
+                    extra_attn = self.distance_embedding(self.distance_mat) + self.edge_embedding(self.edge_mat).sum(
+                        dim=1) / (
+                                         self.distance_mat.view(-1, 1) + 1e-8)
+                elif self.chunk_size >= self.label_num:
+                    extra_attn = hierarchy_bias(self.label_path, slice(None), self.distance_embedding,
+                                                self.edge_embedding)
+                else:
+                    extra_attn = HierarchyBias(self.label_path, self.distance_embedding, self.edge_embedding,
+                                               self.chunk_size)
+                if not callable(extra_attn):
+                    extra_attn = extra_attn.view(self.label_num, 1, self.label_num, 1).expand(-1, expand_size, -1,
+                                                                                              expand_size)
+                    extra_attn = extra_attn.reshape(self.label_num * expand_size, -1)
             elif GRAPH == 'GCN' or GRAPH == 'GAT':
                 extra_attn = self.edge_list
         for hir_layer in self.hir_layers:
-            label_emb = hir_layer(label_emb, extra_attn, self_attn_mask, inputs_embeds, cross_attn_mask)
-
-        token_probs = label_emb.mean(dim=1).view(attention_mask.size(0), attention_mask.size(1),
-                                                 self.label_name.size(0),
-                                                 )
+            label_emb = hir_layer(label_emb, extra_attn)
 
         # sum
-        contrast_mask = (F.gumbel_softmax(token_probs, hard=False, dim=-1, tau=self.tau) * labels.unsqueeze(1)).sum(
-            -1)
+        label_emb = label_emb.view(-1, self.config.hidden_size)
+        contrast_mask = self.hir_layers[-1].gold_label_weights(inputs_embeds, label_emb, labels, self.tau,
+                                                               self.token_label_budget)
 
         temp = self.threshold
         _mask = contrast_mask > temp
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import torch
+
+
+def label_paths(label_hier, num_class):
+    """
+    :param label_hier: Dict{parent -> Set[child]}, as in slot.pt
+    :param num_class: int, labels without a parent are roots
+    :return: LongTensor [L, D], the ancestors of every label from itself up to its root, then -1 padding.
+             Every row ends with at least one -1.
+    """
+    path_dict = {}
+    for s in label_hier:
+        for v in label_hier[s]:
+            path_dict[v] = s
+    paths = []
+    for n in range(num_class):
+        path = [n]
+        while path_dict.get(n, n) != n:
+            n = path_dict[n]
+            path.append(n)
+        paths.append(path)
+    depth = max(len(path) for path in paths) + 1
+    return torch.tensor([path + [-1] * (depth - len(path)) for path in paths], dtype=torch.long)
+
+
+def merge_walk(row_paths, col_paths):
+    """
+    The walk of ``get_distance`` in GraphEncoder, run for every pair of a row and a column label at once.
+    Both root paths are merged from the front, always stepping past the larger id, until they meet.
+    On trees whose ids grow with depth this is the path through the lowest common ancestor.
+
+    :param row_paths: LongTensor [R, D], see :func:`label_paths`
+    :param col_paths: LongTensor [C, D]
+    :return: generator of LongTensor [R, C], the label passed at each step, -1 for pairs already met
+    """
+    p = torch.zeros(row_paths.size(0), col_paths.size(0), dtype=torch.long, device=row_paths.device)
+    q = torch.zeros_like(p)
+    col_paths = col_paths.t()
+    for _ in range(row_paths.size(1) + col_paths.size(0)):
+        a = row_paths.gather(1, p)
+        b = col_paths.gather(0, q)
+        forward = a > b
+        backward = a < b
+        if not (forward | backward).any():
+            break
+        yield torch.where(forward, a, torch.where(backward, b, torch.full_like(a, -1)))
+        p += forward
+        q += backward
+
+
+def dense_hierarchy(paths, max_edges=15):
+    """
+    The L x L distance tensor and the L x L x ``max_edges`` tensor of the labels passed between every pair,
+    offset by one with 0 as padding, as GraphEncoder used to fill them pair by pair.
+    """
+    distance = torch.zeros(paths.size(0), paths.size(0), dtype=torch.long, device=paths.device)
+    edges = torch.zeros(paths.size(0), paths.size(0), max_edges, dtype=torch.long, device=paths.device)
+    for k, step in enumerate(merge_walk(paths, paths)):
+        assert k < max_edges, 'paths between labels longer than {} edges'.format(max_edges)
+        distance += step >= 0
+        edges[:, :, k] = step + 1
+    return distance, edges
+
+
+def hierarchy_key(data_path):
+    """Hash of the taxonomy and the label dict of a dataset."""
+    sha = hashlib.sha1()
+    for name in ['slot.pt', 'bert_value_dict.pt']:
+        with open(os.path.join(data_path, name), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()[:16]
+
+
+def load_hierarchy(data_path, num_class, dense=True):
+    """
+    The root paths and, if ``dense``, the dense distance and edge tensors of a dataset's taxonomy.
+    Built once and cached in ``data_path/hierarchy.<hash>.pt``, keyed by :func:`hierarchy_key`.
+
+    :return: Dict{'label_path' -> LongTensor [L, D], 'distance_mat' -> [L, L], 'edge_mat' -> [L, L, 15]}
+    """
+    cache_path = os.path.join(data_path, 'hierarchy.{}.pt'.format(hierarchy_key(data_path)))
+    if os.path.exists(cache_path):
+        hierarchy = torch.load(cache_path)
+        if 'edge_mat' in hierarchy or not dense:
+            return hierarchy
+    hierarchy = {'label_path': label_paths(torch.load(os.path.join(data_path, 'slot.pt')), num_class)}
+    if dense:
+        hierarchy['distance_mat'], hierarchy['edge_mat'] = dense_hierarchy(hierarchy['label_path'])
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    torch.save(hierarchy, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return hierarchy
+
+
+def hierarchy_bias(paths, rows, distance_embedding, edge_embedding):
+    """
+    Graphormer spatial and edge bias between labels ``rows`` and all labels, computed from the root paths
+    instead of dense L x L distance and edge tensors: distance_embedding(d) + sum(edge_embedding(e + 1)) / d.
+
+    :param paths: LongTensor [L, D], see :func:`label_paths`
+    :param rows: LongTensor [R] or slice
+    :return: Tensor [R, L]
+    """
+    distance = 0
+    edges = 0
+    for step in merge_walk(paths[rows], paths):
+        distance = distance + (step >= 0).long()
+        # pairs that already met pass -1, i.e. the zero padding row of edge_embedding
+        edges = edges + edge_embedding(step + 1).squeeze(-1)
+    if not torch.is_tensor(distance):
+        distance = torch.zeros(len(paths[rows]), len(paths), dtype=torch.long, device=paths.device)
+    return distance_embedding(distance).squeeze(-1) + edges / (distance + 1e-8)
+
+
+class HierarchyBias:
+    """
+    The hierarchy attention bias as a function of the query rows, so that attention over a large taxonomy
+    can be computed a chunk of ``chunk_size`` labels at a time without any L x L tensor.
+    """
+
+    def __init__(self, paths, distance_embedding, edge_embedding, chunk_size):
+        self.paths = paths
+        self.distance_embedding = distance_embedding
+        self.edge_embedding = edge_embedding
+        self.chunk_size = chunk_size
+
+    def __call__(self, start, end):
+        return hierarchy_bias(self.paths, slice(start, end), self.distance_embedding, self.edge_embedding)
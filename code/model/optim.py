@@ -162,3 +162,164 @@ class Adam(torch.optim.Optimizer):
                     p.data.copy_(p_data_fp32)
 
         return loss
+
+
+class _FlatBucket:
+    """Trainable parameters of one device and dtype, their gradients and Adam state, each in one flat buffer."""
+
+    def __init__(self, params, amsgrad=False):
+        self.params = params
+        dtype, device = params[0].dtype, params[0].device
+        total = sum(p.numel() for p in params)
+        self.data = torch.zeros(total, dtype=dtype, device=device)
+        self.grad = torch.zeros(total, dtype=dtype, device=device)
+        self.grads = []
+        self.slices = []
+        offset = 0
+        for p in params:
+            view = self.data[offset:offset + p.numel()].view_as(p)
+            view.copy_(p.data)
+            p.data = view
+            grad = self.grad[offset:offset + p.numel()].view_as(p)
+            if p.grad is not None:
+                grad.copy_(p.grad)
+            p.grad = grad
+            self.grads.append(grad)
+            self.slices.append(slice(offset, offset + p.numel()))
+            offset += p.numel()
+        # low precision parameters are updated through an fp32 master copy
+        self.master = self.data if dtype not in {torch.float16, torch.bfloat16} else self.data.float()
+        self.exp_avg = torch.zeros_like(self.master)
+        self.exp_avg_sq = torch.zeros_like(self.master)
+        self.max_exp_avg_sq = torch.zeros_like(self.master) if amsgrad else None
+        self.step = 0
+
+    def sync_grads(self):
+        """Brings gradients that were replaced, e.g. set to None by model.zero_grad(), back into the buffer."""
+        for p, grad in zip(self.params, self.grads):
+            if p.grad is not grad:
+                if p.grad is None:
+                    grad.zero_()
+                else:
+                    grad.copy_(p.grad)
+                p.grad = grad
+
+    def state(self, i):
+        state = {'step': self.step,
+                 'exp_avg': self.exp_avg[self.slices[i]].view_as(self.params[i]),
+                 'exp_avg_sq': self.exp_avg_sq[self.slices[i]].view_as(self.params[i])}
+        if self.max_exp_avg_sq is not None:
+            state['max_exp_avg_sq'] = self.max_exp_avg_sq[self.slices[i]].view_as(self.params[i])
+        return state
+
+
+class FlatAdam(torch.optim.Optimizer):
+    """
+    :class:`Adam` over flat buffers: the trainable parameters of a group, their gradients and the optimizer
+    state are views into one contiguous buffer per device and dtype, so a step runs a few kernels per buffer
+    instead of per parameter tensor. Float16 and bfloat16 parameters are updated through fp32 master weights.
+
+    Unlike :class:`Adam`, a parameter without a gradient in a step is updated with a zero gradient instead of
+    being skipped. That leaves it unchanged while its moments are zero and weight decay is off, e.g. for the
+    heads the loss never reaches. Frozen parameters are left out. The state dict has the per-parameter layout
+    of :class:`Adam`, so checkpoints load into either optimizer.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
+                 weight_decay=0, amsgrad=False):
+        defaults = dict(lr=lr, betas=betas, eps=eps,
+                        weight_decay=weight_decay, amsgrad=amsgrad)
+        super(FlatAdam, self).__init__(params, defaults)
+        self.buckets = []
+        for group in self.param_groups:
+            params = {}
+            for p in group['params']:
+                if p.requires_grad:
+                    params.setdefault((p.device, p.dtype), []).append(p)
+            self.buckets.append([_FlatBucket(bucket, group['amsgrad']) for bucket in params.values()])
+
+    def _bucket_states(self):
+        for buckets in self.buckets:
+            for bucket in buckets:
+                for i, p in enumerate(bucket.params):
+                    yield bucket, i, p
+
+    def zero_grad(self, set_to_none=False):
+        """Zeroes the flat gradient buffers in place, the parameters keep their gradient views."""
+        for buckets in self.buckets:
+            for bucket in buckets:
+                bucket.grad.zero_()
+                bucket.sync_grads()
+
+    def state_dict(self):
+        self.state.clear()
+        for bucket, i, p in self._bucket_states():
+            self.state[p] = bucket.state(i)
+        return super(FlatAdam, self).state_dict()
+
+    def load_state_dict(self, state_dict):
+        # not through Optimizer.load_state_dict, which would cast fp32 moments to the dtype of half parameters
+        groups = state_dict['param_groups']
+        if len(groups) != len(self.param_groups) or \
+                any(len(a['params']) != len(b['params']) for a, b in zip(groups, self.param_groups)):
+            raise ValueError('loaded state dict does not match the parameter groups of the optimizer')
+        params = {}
+        for group, saved in zip(self.param_groups, groups):
+            group.update({k: v for k, v in saved.items() if k != 'params'})
+            params.update(zip(saved['params'], group['params']))
+        states = {params[k]: v for k, v in state_dict['state'].items() if k in params}
+        for bucket, i, p in self._bucket_states():
+            state = states.get(p)
+            if not state:
+                continue
+            for name, flat in bucket.state(i).items():
+                if name == 'step':
+                    bucket.step = int(state['step'])
+                elif name in state:
+                    flat.copy_(state[name])
+        # the parameters may have been loaded since the buffers were built
+        for buckets in self.buckets:
+            for bucket in buckets:
+                if bucket.master is not bucket.data:
+                    bucket.master.copy_(bucket.data)
+
+    def step(self, closure=None):
+        """Performs a single optimization step.
+        Arguments:
+            closure (callable, optional): A closure that reevaluates the model
+                and returns the loss.
+        """
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group, buckets in zip(self.param_groups, self.buckets):
+            beta1, beta2 = group['betas']
+            for bucket in buckets:
+                bucket.sync_grads()
+                grad = bucket.grad
+                if grad.dtype in {torch.float16, torch.bfloat16}:
+                    grad = grad.float()
+
+                bucket.step += 1
+                bucket.exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                bucket.exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                if group['amsgrad']:
+                    torch.max(bucket.max_exp_avg_sq, bucket.exp_avg_sq, out=bucket.max_exp_avg_sq)
+                    denom = bucket.max_exp_avg_sq.sqrt().add_(group['eps'])
+                else:
+                    denom = bucket.exp_avg_sq.sqrt().add_(group['eps'])
+
+                bias_correction1 = 1 - beta1 ** bucket.step
+                bias_correction2 = 1 - beta2 ** bucket.step
+                step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+
+                if group['weight_decay'] != 0:
+                    bucket.master.add_(bucket.master, alpha=-group['weight_decay'] * group['lr'])
+
+                bucket.master.addcdiv_(bucket.exp_avg, denom, value=-step_size)
+
+                if bucket.master is not bucket.data:
+                    bucket.data.copy_(bucket.master)
+
+        return loss
@@ -0,0 +1,94 @@
+import os
+import torch
+from transformers import AutoTokenizer
+from .experts import unwrap
+from .hierarchy import load_hierarchy
+
+# everything the experts of an ensemble would otherwise each load for themselves, once per process
+_registry = {}
+
+
+def shared(key, build):
+    """Returns the object registered under ``key``, calling ``build`` to create it on first use."""
+    if key not in _registry:
+        _registry[key] = build()
+    return _registry[key]
+
+
+def tokenizer(path="./bert-base-uncased"):
+    return shared(('tokenizer', path), lambda: AutoTokenizer.from_pretrained(path))
+
+
+def label_dict(data_path):
+    """Label id -> token ids of the label name, as in bert_value_dict.pt."""
+    return shared(('label_dict', data_path), lambda: torch.load(os.path.join(data_path, 'bert_value_dict.pt')))
+
+
+def label_hierarchy(data_path):
+    """Parent -> children, as in slot.pt."""
+    return shared(('slot', data_path), lambda: torch.load(os.path.join(data_path, 'slot.pt')))
+
+
+def label_name_ids(data_path):
+    """The label names re-tokenized and padded to the longest, as GraphEncoder embeds them."""
+
+    def build():
+        names = {i: tokenizer().decode(v) for i, v in label_dict(data_path).items()}
+        return tokenizer()([names[i] for i in range(len(names))], padding='longest')['input_ids']
+
+    return shared(('label_name_ids', data_path), build)
+
+
+def hierarchy(data_path, num_class, dense=True):
+    """See :func:`model.hierarchy.load_hierarchy`."""
+    return shared(('hierarchy', data_path, dense), lambda: load_hierarchy(data_path, num_class, dense))
+
+
+def preload(data_path, label_name_ids, label_hierarchy, hierarchy):
+    """
+    Registers the label data of ``data_path`` that an exported ensemble carries, so that building its experts
+    reads nothing from the dataset. ``hierarchy`` is dense if it has the edge tensor.
+    """
+    _registry[('label_name_ids', data_path)] = label_name_ids
+    _registry[('slot', data_path)] = label_hierarchy
+    _registry[('hierarchy', data_path, 'edge_mat' in hierarchy)] = hierarchy
+
+
+def pretrained_state_dict(pretrained):
+    """The BERT weights of ``pretrained`` once an expert has loaded them, else None."""
+    return _registry.get(('state_dict', pretrained))
+
+
+def register_pretrained_state_dict(pretrained, model):
+    """Keeps a CPU copy of the freshly loaded BERT weights of ``model`` for the next experts built from ``pretrained``."""
+    shared(('state_dict', pretrained),
+           lambda: {k: v.detach().cpu().clone() for k, v in model.state_dict().items() if k.startswith('bert.')})
+
+
+def _frozen_tensors(model):
+    for name, p in model.named_parameters():
+        if not p.requires_grad:
+            yield name, p
+    for name, b in model.named_buffers():
+        yield name, b
+
+
+def tie_frozen(model, others):
+    """
+    Makes the frozen parameters and buffers of ``model`` that equal those of an expert in ``others``
+    the same tensors, e.g. the BERT weights below the adapters of LoRA experts or the label and hierarchy
+    tensors of the graph encoders. Trainable weights keep their own copies.
+    """
+    references = {}
+    for other in others:
+        for name, t in _frozen_tensors(unwrap(other)):
+            references.setdefault(name, t)
+    model = unwrap(model)
+    for name, t in list(_frozen_tensors(model)):
+        ref = references.get(name)
+        if ref is None or ref is t or ref.shape != t.shape or ref.dtype != t.dtype or ref.device != t.device:
+            continue
+        if isinstance(ref, torch.nn.Parameter) != isinstance(t, torch.nn.Parameter) or not torch.equal(ref, t):
+            continue
+        module_name, _, leaf = name.rpartition('.')
+        setattr(model.get_submodule(module_name) if module_name else model, leaf, ref)
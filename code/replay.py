@@ -0,0 +1,94 @@
+import argparse
+import time
+import numpy as np
+import torch
+from eval import MetricAccumulator, ThresholdSweep
+from logits_cache import LogitsStore
+from model.fusion import EvidentialFusion, CASCADE_CRITERIA, cascade_depth
+
+parser = argparse.ArgumentParser(description='Re-runs fusion and metrics on expert logits cached by test.py or '
+                                             'the dev loop of train_multi.py, without loading any model.')
+parser.add_argument('--store', type=str, default='logits', help='Root directory of the logits store.')
+parser.add_argument('--split', type=str, required=True, help='Cached split, e.g. WebOfScience-test.')
+parser.add_argument('--run', type=str, default=None, help='Run whose experts to fuse, e.g. WebOfScience-test_macro.')
+parser.add_argument('--experts', type=str, nargs='+', default=None,
+                    help='Checkpoint hashes of the experts to fuse, in order. Overrides --run.')
+parser.add_argument('--subset', type=int, nargs='+', default=None,
+                    help='Positions of the experts of the run to fuse, in order, e.g. 0 2.')
+parser.add_argument('--eta', type=float, nargs='+', default=[0.91], help='Fusion temperatures to try.')
+parser.add_argument('--threshold', type=float, default=0.5)
+parser.add_argument('--chunk', type=int, default=8192, help='Documents fused at once.')
+parser.add_argument('--cascade-bound', type=float, nargs='+', default=None,
+                    help='Also score cascades stopping at these bounds, see test.py --cascade-bound.')
+parser.add_argument('--cascade-criterion', type=str, default='prefix', choices=CASCADE_CRITERIA)
+
+
+def replay(logits, labels, eta, threshold=0.5, chunk=8192):
+    """
+    :param logits: List[np.ndarray [N, C]], memory-mapped expert logits
+    :param labels: np.ndarray [N, C], multi-hot ground truth
+    :return: (MetricAccumulator, ThresholdSweep) over the fused logits
+    """
+    num_class = labels.shape[1]
+    fusion = EvidentialFusion(eta)
+    metrics = MetricAccumulator(num_class, threshold)
+    sweep = ThresholdSweep(num_class)
+    with torch.no_grad():
+        for start in range(0, len(labels), chunk):
+            x = torch.from_numpy(np.stack([expert[start:start + chunk] for expert in logits])).float()
+            y = torch.from_numpy(np.array(labels[start:start + chunk]))
+            fused = fusion(x)['logits']
+            metrics.update(fused, y)
+            sweep.update(fused, y)
+    return metrics, sweep
+
+
+def replay_cascade(logits, labels, eta, bound, criterion='prefix', threshold=0.5, chunk=8192):
+    """
+    Scores each document fused over the experts that a cascade stopping at ``bound`` runs on it.
+
+    :return: MetricAccumulator, LongTensor [E] of the documents stopping after each expert
+    """
+    fusion = EvidentialFusion(eta)
+    metrics = MetricAccumulator(labels.shape[1], threshold)
+    depths = torch.zeros(len(logits), dtype=torch.long)
+    with torch.no_grad():
+        for start in range(0, len(labels), chunk):
+            x = torch.from_numpy(np.stack([expert[start:start + chunk] for expert in logits])).float()
+            y = torch.from_numpy(np.array(labels[start:start + chunk]))
+            fused = fusion(x)
+            depth = cascade_depth(fused['prefix_weights'], fused['uncertainty'], bound, criterion)
+            metrics.update(fusion.truncated(x, depth), y)
+            depths += torch.bincount(depth - 1, minlength=len(logits))
+    return metrics, depths
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    store = LogitsStore(args.store, args.split)
+    experts = args.experts if args.experts is not None else store.experts(args.run)
+    if args.subset is not None:
+        experts = [experts[i] for i in args.subset]
+    logits = [store.logits(key) for key in experts]
+    labels = store.labels()
+    id2label = {i: str(i) for i in range(labels.shape[1])}
+    print('experts', experts, 'documents', len(labels))
+    for eta in args.eta:
+        start = time.perf_counter()
+        metrics, sweep = replay(logits, labels, eta, args.threshold, args.chunk)
+        scores = metrics.compute(id2label)
+        swept = sweep.compute('macro_f1')
+        print('eta {}: precision {:.4f} recall {:.4f} macro {:.4f} micro {:.4f} | '
+              'threshold {:.3f} macro {:.4f}, class thresholds macro {:.4f} ({:.1f}s)'.format(
+                  eta, scores['precision'], scores['recall'], scores['macro_f1'], scores['micro_f1'],
+                  swept['global'], max(swept['macro_f1']), float(np.mean(swept['class_f1'])),
+                  time.perf_counter() - start))
+        for bound in args.cascade_bound or []:
+            metrics, depths = replay_cascade(logits, labels, eta, bound, args.cascade_criterion, args.threshold,
+                                             args.chunk)
+            scores = metrics.compute(id2label)
+            print('eta {} cascade {} < {}: precision {:.4f} recall {:.4f} macro {:.4f} micro {:.4f} | '
+                  'experts per document {:.3f}, stopping after each expert {}'.format(
+                      eta, args.cascade_criterion, bound, scores['precision'], scores['recall'], scores['macro_f1'],
+                      scores['micro_f1'], (depths * torch.arange(1, len(logits) + 1)).sum().item() / len(labels),
+                      depths.tolist()))
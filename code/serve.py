@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from train_multi import get_runner
+from model.fusion import EvidentialFusion
+from model import registry
+from model.ensemble import load_ensemble
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--ensemble', type=str, required=True, help='File written by export.py with the experts to serve.')
+parser.add_argument('--device', type=str, default='cuda:0')
+parser.add_argument('--eta', default=0.91, type=float,
+                    help='eta is a temperature factor that adjusts the sensitivity of prefix weights.')
+parser.add_argument('--shared-trunk', default=0, type=int,
+                    help='Whether LoRA experts share one pass over the frozen layers below the adapted one.')
+parser.add_argument('--pad-multiple', default=8, type=int,
+                    help='Round the padded length of a micro-batch up to a multiple of this.')
+parser.add_argument('--max-batch', default=32, type=int, help='Documents per micro-batch.')
+parser.add_argument('--max-delay', default=5., type=float,
+                    help='Milliseconds a request waits for others to join its micro-batch.')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--socket', type=str, default=None, help='Listen on this unix socket instead of --host/--port.')
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+
+class Predictor:
+    """
+    Fused label probabilities of a list of tokenized documents, padded into one batch that every expert runs on.
+
+    The probabilities are the sigmoid of the fused logits, as in test.py, and a label is predicted above its
+    tuned threshold, or 0.5 without one. Per expert come its Dirichlet uncertainty and fusion weight.
+    """
+
+    def __init__(self, models, label_names, thresholds=None, eta=0.91, shared_trunk=0, pad_idx=0, pad_multiple=8,
+                 max_token=512):
+        self.models = models
+        self.label_names = label_names
+        self.runner = get_runner(models, shared_trunk)
+        self.fusion = EvidentialFusion(eta)
+        self.device = next(models[0].parameters()).device
+        self.threshold = torch.tensor(thresholds['class'] if thresholds is not None else 0.5, device=self.device)
+        self.pad_idx = pad_idx
+        self.pad_multiple = pad_multiple
+        self.max_token = max_token
+
+    def batch(self, docs):
+        docs = [doc[:self.max_token - 2] for doc in docs]
+        length = max(len(doc) for doc in docs)
+        length = min(-(-length // self.pad_multiple) * self.pad_multiple, self.max_token)
+        data = torch.full([len(docs), length], self.pad_idx, dtype=torch.long)
+        for i, doc in enumerate(docs):
+            data[i, :len(doc)] = torch.as_tensor(doc, dtype=torch.long)
+        return data.to(self.device)
+
+    def __call__(self, docs):
+        """
+        :param docs: List[List[int]], token ids of each document
+        :return: List[Dict{'probs' -> List[C], 'labels' -> names of the predicted labels,
+                 'uncertainty' -> List[E], 'weights' -> List[E]}]
+        """
+        data = self.batch(docs)
+        with torch.no_grad():
+            outputs = self.runner(data, data != self.pad_idx, return_dict=True)
+            fused = self.fusion(torch.stack([output['logits'] for output in outputs]))
+            probs = torch.sigmoid(fused['logits'])
+            predicted = (probs > self.threshold).cpu().tolist()
+        probs = probs.cpu().tolist()
+        uncertainty = fused['uncertainty'].t().cpu().tolist()
+        weights = fused['weights'].t().cpu().tolist()
+        return [{'probs': probs[i],
+                 'labels': [name for name, p in zip(self.label_names, predicted[i]) if p],
+                 'uncertainty': uncertainty[i],
+                 'weights': weights[i]} for i in range(len(docs))]
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests into micro-batches for ``predict``, which runs on one worker thread while the
+    event loop keeps accepting requests.
+
+    A micro-batch starts with the oldest waiting request and is run once it holds ``max_batch`` requests or that
+    request has waited ``max_delay`` seconds, counting the time it queued behind the previous micro-batch. With
+    ``max_delay`` 0 it takes whatever arrived while the previous one ran.
+    """
+
+    def __init__(self, predict, max_batch=32, max_delay=0.005):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = collections.deque()
+        self.ready = None
+        self.executor = ThreadPoolExecutor(1)
+        self.requests = 0
+        self.batches = 0
+
+    async def submit(self, doc):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((doc, future, loop.time()))
+        if self.ready is not None:
+            self.ready.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        # created here, on the loop it waits on
+        self.ready = asyncio.Event()
+        while True:
+            while not self.pending:
+                self.ready.clear()
+                await self.ready.wait()
+            deadline = self.pending[0][2] + self.max_delay
+            while len(self.pending) < self.max_batch and loop.time() < deadline:
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            batch = [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+            # requests whose client went away in the meantime
+            batch = [request for request in batch if not request[1].done()]
+            if not batch:
+                continue
+            self.requests += len(batch)
+            self.batches += 1
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict, [doc for doc, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {'requests': self.requests, 'batches': self.batches,
+                'mean_batch': self.requests / self.batches if self.batches else 0.}
+
+
+class Server:
+    """
+    A small HTTP/1.1 server with keep-alive connections on top of a :class:`MicroBatcher`.
+
+    ``POST /predict`` takes ``{"text": str}`` or ``{"input_ids": List[int]}`` and returns the result of
+    :class:`Predictor` for the document. ``GET /health`` describes the ensemble and ``GET /stats`` counts the
+    requests and micro-batches so far.
+    """
+
+    def __init__(self, batcher, tokenizer, info):
+        self.batcher = batcher
+        self.tokenizer = tokenizer
+        self.info = info
+
+    def encode(self, request):
+        if 'input_ids' in request:
+            return [int(i) for i in request['input_ids']]
+        # as the documents were tokenized for training, which the dataset truncates to 510 tokens
+        return self.tokenizer.encode(request['text'], truncation=True, max_length=512)
+
+    async def respond(self, method, path, body):
+        if path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            try:
+                doc = self.encode(json.loads(body.decode()))
+                if not doc:
+                    raise ValueError('empty document')
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {'error': '{}: {}'.format(type(e).__name__, e)}
+            try:
+                return 200, await self.batcher.submit(doc)
+            except Exception as e:
+                return 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+        if path in ('/health', '/stats'):
+            if method != 'GET':
+                return 405, {'error': 'use GET'}
+            return 200, self.info if path == '/health' else self.batcher.stats()
+        return 404, {'error': 'unknown path {}'.format(path)}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.decode('latin-1').split()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if len(parts) == 3:
+                    status, response = await self.respond(parts[0], parts[1], body)
+                else:
+                    status, response = 400, {'error': 'malformed request line'}
+                keep_alive = len(parts) == 3 and parts[2] == 'HTTP/1.1' and headers.get('connection') != 'close'
+                payload = json.dumps(response).encode()
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n'.format(
+                    status, REASONS[status], len(payload), '' if keep_alive else 'Connection: close\r\n').encode())
+                writer.write(payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(server, batcher, host='127.0.0.1', port=8000, socket=None):
+    """Runs ``server`` until SIGINT or SIGTERM."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = loop.create_task(batcher.run())
+    if socket is not None:
+        if os.path.exists(socket):
+            os.remove(socket)
+        listener = loop.run_until_complete(asyncio.start_unix_server(server.handle, socket))
+    else:
+        listener = loop.run_until_complete(asyncio.start_server(server.handle, host, port))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+    print('serving on {}'.format(socket or '{}:{}'.format(host, port)), flush=True)
+    try:
+        loop.run_forever()
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        worker.cancel()
+        loop.run_until_complete(asyncio.gather(worker, return_exceptions=True))
+        batcher.executor.shutdown()
+        loop.close()
+        if socket is not None and os.path.exists(socket):
+            os.remove(socket)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    start = time.perf_counter()
+    models, ensemble = load_ensemble(args.ensemble, args.device)
+    tokenizer = registry.tokenizer()
+    predictor = Predictor(models, ensemble['label_names'], ensemble.get('thresholds'), args.eta, args.shared_trunk,
+                          tokenizer.pad_token_id, args.pad_multiple)
+    # the first batch pays for lazy initialization, not the first client
+    predictor([[tokenizer.cls_token_id, tokenizer.sep_token_id]])
+    batcher = MicroBatcher(predictor, args.max_batch, args.max_delay / 1e3)
+    info = {'experts': len(models), 'labels': ensemble['label_names'], 'max_batch': args.max_batch,
+            'max_delay': args.max_delay}
+    print('loaded {} experts in {:.2f}s'.format(len(models), time.perf_counter() - start), flush=True)
+    serve(Server(batcher, tokenizer, info), batcher, args.host, args.port, args.socket)
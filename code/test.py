@@ -1,13 +1,17 @@
 import numpy as np
-from transformers import AutoTokenizer, BertConfig
 import torch
-from torch.utils.data import DataLoader, Subset
+from torch.utils.data import Subset
 from tqdm import tqdm
 import argparse
 import os
-from train import BertDataset, CommonBertEmbeddings
-from eval import evaluate
-from model.contrast import ContrastModel
+from train_multi import BertDataset, build_experts, get_runner, get_loader
+from eval import MetricAccumulator
+from logits_cache import LogitsStore, checkpoint_hash, run_id
+from checkpoints import load_checkpoint
+from model.fusion import EvidentialFusion, CASCADE_CRITERIA
+from model.experts import ExpertCascade
+from model import registry, delta
+from model.ensemble import load_ensemble
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--device', type=str, default='cuda:3')
@@ -16,6 +20,31 @@ parser.add_argument('--name', type=str, required=True, help='Name of checkpoint.
 parser.add_argument('--experts', type=int, default=3, help='Number of experts')
 parser.add_argument('--eta', default=0.91, type=float,
                     help='eta is a temperature factor that adjusts the sensitivity of prefix weights.')
+parser.add_argument('--shared-trunk', default=0, type=int,
+                    help='Whether LoRA experts share one pass over the frozen layers below the adapted one.')
+parser.add_argument('--dynamic-padding', default=0, type=int,
+                    help='Whether to pad each batch to its longest document instead of 512 tokens.')
+parser.add_argument('--pad-multiple', default=8, type=int,
+                    help='Round dynamically padded lengths up to a multiple of this.')
+parser.add_argument('--max-tokens', default=0, type=int,
+                    help='Padded tokens per batch. Batches documents of similar length instead of --batch ones.')
+parser.add_argument('--prefetch', default=0, type=int,
+                    help='Batches copied to the device ahead of use. Keeps items on the CPU and collates them '
+                         'into pinned memory. 0 moves every item to the device in the dataset instead.')
+parser.add_argument('--workers', default=0, type=int, help='DataLoader worker processes when prefetching.')
+parser.add_argument('--fold', default=None, type=int,
+                    help='Fold to test when the run trained several folds, each saved in its own subdirectory.')
+parser.add_argument('--cache-logits', type=str, default=None,
+                    help='Directory to store the logits of every expert in, for replay.py.')
+parser.add_argument('--cache-dtype', type=str, default='float16', choices=['float16', 'float32'])
+parser.add_argument('--ensemble', type=str, default=None,
+                    help='Load the experts from a file written by export.py instead of from the checkpoints.')
+parser.add_argument('--cascade-bound', default=0, type=float,
+                    help='Run the experts in order and stop for a document once its --cascade-criterion is below '
+                         'this. 0 runs every expert on every document.')
+parser.add_argument('--cascade-criterion', type=str, default='prefix', choices=CASCADE_CRITERIA,
+                    help='prefix stops once the prefix weight of the next expert is below --cascade-bound, '
+                         'uncertainty once the uncertainty of the last expert run is.')
 extra_choices = ['_macro1', '_micro1', '_macro2', '_micro2']
 extra_args = []
 args = parser.parse_args()
@@ -31,118 +60,121 @@ args = parser.parse_args()
 
 
 if __name__ == '__main__':
-    checkpoints = []
-
-    for i in range(1, experts + 1):
-        extra = f'_macro{i}' if i % 2 == 1 else f'_micro{i}'
-        checkpoint = torch.load(os.path.join('checkpoints', args.name, f'checkpoint_best{extra}.pt'),
-                                map_location='cpu')
-        checkpoints.append(checkpoint)
+    checkpoint_dir = os.path.join('checkpoints', args.name)
+    if args.fold is not None:
+        checkpoint_dir = os.path.join(checkpoint_dir, 'fold{}'.format(args.fold))
     eta = args.eta
     batch_size = args.batch
     device = args.device
+    shared_trunk = args.shared_trunk
+    dynamic_padding = args.dynamic_padding
+    pad_multiple = args.pad_multiple
+    max_tokens = args.max_tokens
+    prefetch = args.prefetch
+    workers = args.workers
+    cache_logits = args.cache_logits
+    cache_dtype = args.cache_dtype
     extra = args.extra1
-    args = checkpoint['args'] if checkpoint['args'] is not None else args
+    ensemble = args.ensemble
+    cascade_bound = args.cascade_bound
+    cascade_criterion = args.cascade_criterion
+    if cascade_bound > 0 and cache_logits is not None:
+        parser.error('--cache-logits needs the logits of every expert, which --cascade-bound skips')
+    models = []
+    model_checkpoints = []
+    model_checkpoint_paths = []
+    if ensemble is not None:
+        models, ensemble = load_ensemble(ensemble, device)
+        args = argparse.Namespace(**ensemble['args'])
+    else:
+        for i in range(1, experts + 1):
+            extra = f'_macro{i}'
+            model_checkpoint_paths.append(os.path.join(checkpoint_dir, f'checkpoint_best{extra}.pt'))
+            checkpoint = load_checkpoint(model_checkpoint_paths[-1])
+            model_checkpoints.append(checkpoint)
+        args = checkpoint['args'] if checkpoint['args'] is not None else args
     data_path = os.path.join('data', args.data)
 
     if not hasattr(args, 'graph'):
         args.graph = False
     print(args)
-    tokenizer = AutoTokenizer.from_pretrained("./bert-base-uncased")
+    tokenizer = registry.tokenizer()
 
-    label_dict = torch.load(os.path.join(data_path, 'bert_value_dict.pt'))
-    label_dict = {i: tokenizer.decode(v, skip_special_tokens=True) for i, v in label_dict.items()}
+    if ensemble is not None:
+        label_dict = dict(enumerate(ensemble['label_names']))
+    else:
+        label_dict = registry.label_dict(data_path)
+        label_dict = {i: tokenizer.decode(v, skip_special_tokens=True) for i, v in label_dict.items()}
     num_class = len(label_dict)
 
-    dataset = BertDataset(device=device, pad_idx=tokenizer.pad_token_id, data_path=data_path)
+    dataset = BertDataset(device='cpu' if prefetch > 0 else device, pad_idx=tokenizer.pad_token_id,
+                          data_path=data_path,
+                          dynamic_padding=dynamic_padding or max_tokens > 0, pad_multiple=pad_multiple)
 
-    models = []
-    model_checkpoints = []
-    for i in range(1, experts + 1):
-        extra = f'_macro{i}'
-        checkpoint = torch.load(os.path.join('checkpoints', args.name, f'checkpoint_best{extra}.pt'),
-                                map_location='cpu')
-        model_checkpoints.append(checkpoint)
-
-    config = BertConfig(num_labels=num_class,
-                        contrast_loss=args.contrast, graph=args.graph,
-                        layer=args.layer, data_path=data_path, multi_label=args.multi,
-                        lamb=args.lamb, threshold=args.thre, tau=args.tau)
-    shared_embeddings = CommonBertEmbeddings(config)
-    for i in range(experts):
-        checkpoint = model_checkpoints[i]
-        model = ContrastModel.from_pretrained("./bert-base-uncased", num_labels=num_class,
-                                              contrast_loss=args.contrast, graph=args.graph,
-                                              layer=args.layer, data_path=data_path, multi_label=args.multi,
-                                              lamb=args.lamb, threshold=args.thre).to(device)
-        model.bert_embeddings = shared_embeddings
-        model.load_state_dict(checkpoint['param'])
-        model.eval()
-        models.append(model)
+    pretrained = "./bert-base-uncased"
+    if ensemble is None:
+        for model, checkpoint in zip(build_experts(args, num_class, data_path, device, experts=experts,
+                                                   pretrained=pretrained), model_checkpoints):
+            delta.load_expert(model, checkpoint, pretrained)
+            model.eval()
+            models.append(model)
+    experts = len(models)
+    runner = get_runner(models, shared_trunk)
+    fusion = EvidentialFusion(eta)
+    cascade = ExpertCascade(runner, fusion, cascade_bound, cascade_criterion) if cascade_bound > 0 else None
+    depths = torch.zeros(experts, dtype=torch.long)
 
     split = torch.load(os.path.join(data_path, 'split.pt'))
     test = Subset(dataset, split['test'])
-    test = DataLoader(test, batch_size=batch_size, shuffle=False, collate_fn=dataset.collate_fn)
+    test, test_sampler = get_loader(dataset, test, batch_size, max_tokens, workers=workers, prefetch=prefetch,
+                                    device=device)
 
-    truth = []
-    pred = []
-    index = []
-    slot_truth = []
-    slot_pred = []
-    reweight_temperature = eta
+    metrics = MetricAccumulator(num_class)
+    # thresholds swept on the dev set when the checkpoint was saved
+    thresholds = ensemble['thresholds'] if ensemble is not None else model_checkpoints[0].get('thresholds')
+    tuned_metrics = {}
+    if thresholds is not None:
+        tuned_metrics = {'global': MetricAccumulator(num_class, thresholds['global']),
+                         'class': MetricAccumulator(num_class, thresholds['class'])}
+    writer = None
+    if cache_logits is not None:
+        writer = LogitsStore(cache_logits, args.data + '-test').writer(split['test'], num_class, experts, cache_dtype)
     pbar = tqdm(test)
-    encoding_array = []
     with torch.no_grad():
-        i = 0
         for data, label, idx in pbar:
-            outputs = []
             padding_mask = data != tokenizer.pad_token_id
-            for model in models:
-                output = model(data, padding_mask, labels=label, return_dict=True)
-                outputs.append(output)
-            xis = [None] * len(outputs)
-            for i in range(len(outputs)):
-                xis[i] = outputs[i]['logits']
-            num_classes = outputs[0]['num_labels']
-            w = [torch.ones(len(xis[0]), dtype=torch.bool, device=xis[0].device)]
-            b0 = None
-            for xi in xis:
-                alpha = torch.exp(xi) + 1
-                S = alpha.sum(dim=1, keepdim=True)
-                b = (alpha - 1) / S
-                u = num_classes / S.squeeze(-1)
-
-                if b0 is None:
-                    C = 0
-                else:
-                    bb = b0.view(-1, b0.shape[1], 1) @ b.view(-1, 1, b.shape[1])
-                    C = bb.sum(dim=[1, 2]) - bb.diagonal(dim1=1, dim2=2).sum(dim=1)
-                b0 = b
-                w.append(w[-1] * u / (1 - C))
-            exp_w = [torch.exp(wi / eta) for wi in w]
-            exp_w = exp_w[:-1]
-            exp_w_sum = sum(exp_w)
-            normalized_list = [x / exp_w_sum for x in exp_w]
-            exp_w = normalized_list
-            exp_w = [wi.unsqueeze(-1) for wi in exp_w]
-            reweighted_outs = []
-            for i in range(len(xis)):
-                reweighted_outs.append(xis[i] * exp_w[i])
-            xi = torch.mean(torch.stack(reweighted_outs), dim=0)
-            encoding_array.append(xi)
-            for l in label:
-                t = []  
-                for i in range(l.size(0)):
-                    if l[i].item() == 1:
-                        t.append(i)
-                truth.append(t)
-            for l in xi:
-                pred.append(torch.sigmoid(l).tolist())
+            if cascade is not None:
+                output = cascade(data, padding_mask)
+                xi = output['logits']
+                depths += torch.bincount(output['depth'] - 1, minlength=experts).cpu()
+            else:
+                outputs = runner(data, padding_mask, labels=label, return_dict=True)
+                logits = torch.stack([output['logits'] for output in outputs])
+                xi = fusion(logits)['logits']
+            metrics.update(xi, label)
+            for tuned in tuned_metrics.values():
+                tuned.update(xi, label)
+            if writer is not None:
+                writer.update(idx, logits, label)
     pbar.close()
+    if writer is not None:
+        if ensemble is not None:
+            keys = ensemble['checkpoints']
+        else:
+            keys = [checkpoint_hash(path) for path in model_checkpoint_paths]
+        writer.commit(keys, run_id(checkpoint_dir) + '_macro')
+        writer.close()
 
-    scores = evaluate(pred, truth, label_dict)
+    scores = metrics.compute(label_dict)
     macro_f1 = scores['macro_f1']
     micro_f1 = scores['micro_f1']
     precision = scores['precision']
     recall = scores['recall']
     print('precision', precision, 'recall', recall, 'macro', macro_f1, 'micro', micro_f1)
+    for name, tuned in tuned_metrics.items():
+        scores = tuned.compute(label_dict)
+        print('{} thresholds: precision'.format(name), scores['precision'], 'recall', scores['recall'],
+              'macro', scores['macro_f1'], 'micro', scores['micro_f1'])
+    if cascade is not None:
+        print('experts per document {:.3f}, documents stopping after each expert {}'.format(
+            (depths * torch.arange(1, experts + 1)).sum().item() / depths.sum().item(), depths.tolist()))
@@ -1,15 +1,25 @@
-from transformers import AutoTokenizer, BertConfig
+from transformers import BertConfig
 from fairseq.data import data_utils
 import torch
-from torch.utils.data import Dataset, DataLoader, Subset, ConcatDataset
-from model.optim import ScheduledOptim, Adam
+from torch.utils.data import Dataset, DataLoader, Subset
+from model.optim import ScheduledOptim, Adam, FlatAdam
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import json
+import multiprocessing
 import os
-from eval import evaluate
+import time
+from eval import MetricAccumulator, ThresholdSweep
 from model.contrast_multi import ContrastModel, BertEmbeddings
+from model.experts import ExpertRunner, lora_split_layer
+from model.fusion import EvidentialFusion, EvidentialExpertLoss
+from model import registry, delta
+from label_index import LabelIndex
+from logits_cache import LogitsStore, checkpoint_hash, run_id
+from checkpoints import CheckpointWriter, load_checkpoint
+from loader import ShuffledBatchSampler, TokenBudgetBatchSampler, Prefetcher, flat_indices, kfold_indices
 import torch.nn as nn
-import torch.nn.functional as F
 import numpy as np
 from torch.nn import CrossEntropyLoss
 import peft
@@ -20,7 +30,8 @@ import utils
 
 
 class BertDataset(Dataset):
-    def __init__(self, max_token=512, device='cpu', pad_idx=0, data_path=None):
+    def __init__(self, max_token=512, device='cpu', pad_idx=0, data_path=None, dynamic_padding=False,
+                 pad_multiple=1):
         self.device = device
         super(BertDataset, self).__init__()
         self.data = data_utils.load_indexed_dataset(
@@ -31,6 +42,9 @@ class BertDataset(Dataset):
         )
         self.max_token = max_token
         self.pad_idx = pad_idx
+        # pad each batch to its longest document, rounded up to pad_multiple, instead of max_token
+        self.dynamic_padding = dynamic_padding
+        self.pad_multiple = pad_multiple
 
     def __getitem__(self, item):
         data = self.data[item][:self.max_token - 2].to(
@@ -41,11 +55,19 @@ class BertDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+    def lengths(self, indices):
+        """Token counts after truncation, read from the size index without decoding any document."""
+        return np.minimum(self.data.sizes[indices], self.max_token - 2)
+
     def collate_fn(self, batch):
         if not isinstance(batch, list):
             return batch['data'], batch['label'], batch['idx']
         label = torch.stack([b['label'] for b in batch], dim=0)
-        data = torch.full([len(batch), self.max_token], self.pad_idx, device=label.device, dtype=batch[0]['data'].dtype)
+        length = self.max_token
+        if self.dynamic_padding:
+            length = max(len(b['data']) for b in batch)
+            length = min(-(-length // self.pad_multiple) * self.pad_multiple, self.max_token)
+        data = torch.full([len(batch), length], self.pad_idx, device=label.device, dtype=batch[0]['data'].dtype)
         idx = [b['idx'] for b in batch]
         for i, b in enumerate(batch):
             data[i][:len(b['data'])] = b['data']
@@ -59,19 +81,50 @@ class CommonBertEmbeddings(nn.Module):
 
 
 class Saver:
-    def __init__(self, model, optimizer, scheduler, args):
+    """
+    Saves an expert without the frozen weights it shares with ``pretrained``, only a reference to them and the
+    hash of their values, so that a LoRA expert writes its adapters and heads instead of all of BERT.
+    """
+    def __init__(self, model, optimizer, scheduler, args, pretrained='bert-base-uncased', writer=None):
         self.model = model
         self.optimizer = optimizer
         self.scheduler = scheduler
         self.args = args
-
-    def __call__(self, score, best_score, name):
-        torch.save({'param': self.model.state_dict(),
-                    'optim': self.optimizer.state_dict(),
-                    'sche': self.scheduler.state_dict() if self.scheduler is not None else None,
-                    'score': score, 'args': self.args,
-                    'best_score': best_score},
-                   name)
+        self.pretrained = pretrained
+        self.base_names = delta.base_names(model, pretrained)
+        self.writer = writer if writer is not None else CheckpointWriter()
+
+    def state(self):
+        return {**delta.expert_state(self.model, self.pretrained, self.base_names),
+                'optim': self.optimizer.state_dict(),
+                'sche': self.scheduler.state_dict() if self.scheduler is not None else None,
+                'args': self.args}
+
+    def load(self, state):
+        delta.load_expert(self.model, state, self.pretrained)
+        self.optimizer.load_state_dict(state['optim'])
+        if self.scheduler is not None:
+            self.scheduler.load_state_dict(state['sche'])
+
+    def __call__(self, score, best_score, name, thresholds=None, key=None):
+        self.writer.save(self.state(), name, {'score': score, 'best_score': best_score, 'thresholds': thresholds},
+                         key)
+
+
+def save_resume(writer, path, savers, **progress):
+    """
+    Everything train_fold needs to continue from the batch it is about to train on: all experts with their
+    optimizers, the random number generators and ``progress``, e.g. the epoch, the batch and the best scores.
+    """
+    writer.save({'experts': [saver.state() for saver in savers], 'rng': utils.rng_state(), **progress}, path)
+
+
+def load_resume(path, savers):
+    """Loads the experts and optimizers saved by :func:`save_resume` and returns the rest."""
+    state = load_checkpoint(path)
+    for saver, expert in zip(savers, state.pop('experts')):
+        saver.load(expert)
+    return state
 class FGM():
     def __init__(self, model):
         self.model = model
@@ -121,6 +174,110 @@ parser.add_argument('--ta', default=0.5, type=float,
                     help='If prefix weight ≤ tau , the loss of expert m on the sample will be eliminated.')
 parser.add_argument('--eta', default=0.91, type=float,
                     help='eta is a temperature factor that adjusts the sensitivity of prefix weights.')
+parser.add_argument('--dynamic-padding', default=0, type=int,
+                    help='Whether to pad each batch to its longest document instead of 512 tokens.')
+parser.add_argument('--pad-multiple', default=8, type=int,
+                    help='Round dynamically padded lengths up to a multiple of this.')
+parser.add_argument('--max-tokens', default=0, type=int,
+                    help='Padded tokens per batch. Batches documents of similar length instead of --batch random ones.')
+parser.add_argument('--prefetch', default=0, type=int,
+                    help='Batches copied to the device ahead of use. Keeps items on the CPU and collates them '
+                         'into pinned memory. 0 moves every item to the device in the dataset instead.')
+parser.add_argument('--workers', default=0, type=int, help='DataLoader worker processes when prefetching.')
+parser.add_argument('--log-interval', default=50, type=int, help='Steps between training loss reports.')
+parser.add_argument('--shared-trunk', default=0, type=int,
+                    help='Whether LoRA experts share one pass over the frozen layers below the adapted one.')
+parser.add_argument('--fuse-contrast', default=0, type=int,
+                    help='Whether to run the original and the contrastive view of a batch through BERT as one batch.')
+parser.add_argument('--asl-recompute', default=0, type=int,
+                    help='Whether the asymmetric loss recomputes its gradient from the logits instead of saving it.')
+parser.add_argument('--flat-adam', default=0, type=int,
+                    help='Whether to keep parameters and Adam state in flat buffers, updated a buffer at a time.')
+parser.add_argument('--save-queue', default=0, type=int,
+                    help='Checkpoints copied to host memory and waiting for a background thread to write them. '
+                         '0 writes them before training goes on.')
+parser.add_argument('--save-interval', default=0, type=int,
+                    help='Batches between checkpoints of the whole training state, taken between optimizer updates '
+                         'and at the start of every epoch, for --resume. 0 takes none.')
+parser.add_argument('--resume', default=0, type=int,
+                    help='Whether to continue from the last --save-interval checkpoint of the run, if there is one.')
+parser.add_argument('--n-splits', default=5, type=int, help='Folds of the cross validation over train and val.')
+parser.add_argument('--fold', default=1, type=int, help='Fold used as dev set. -1 trains every fold.')
+parser.add_argument('--fold-workers', default=1, type=int, help='Folds trained in parallel processes.')
+parser.add_argument('--fold-devices', type=str, nargs='+', default=None,
+                    help='Devices the parallel folds are spread over. Defaults to --device.')
+parser.add_argument('--cache-logits', type=str, default=None,
+                    help='Directory to store the dev logits of every saved expert in, for replay.py.')
+parser.add_argument('--cache-dtype', type=str, default='float16', choices=['float16', 'float32'])
+
+LORA_TARGET_MODULES = ['bert.encoder.layer.11.intermediate.dense', 'bert.encoder.layer.11.output.dense']
+
+
+def get_lora_config():
+    return LoraConfig(
+        r=128,
+        lora_alpha=4096,
+        target_modules=LORA_TARGET_MODULES,
+        lora_dropout=0.05,
+        bias="none",
+    )
+
+
+def expert_kwargs(args, data_path):
+    """The arguments of ContrastModel besides its config, as the training arguments ``args`` set them."""
+    return dict(contrast_loss=args.contrast, graph=args.graph, layer=args.layer, data_path=data_path,
+                multi_label=args.multi, lamb=args.lamb, threshold=args.thre, tau=args.tau, name=args.name,
+                asl_recompute=getattr(args, 'asl_recompute', 0))
+
+
+def build_experts(args, num_class, data_path, device, experts=None, pretrained='bert-base-uncased'):
+    """
+    Expert 0 fine-tunes the whole model, the others only train LoRA adapters on the top layer.
+    The pretrained weights are read once per process and the frozen tensors the experts have in common,
+    i.e. the BERT weights under the adapters and the label and hierarchy tensors, are stored once.
+    """
+    models = []
+    for i in range(experts if experts is not None else args.experts):
+        model = ContrastModel.from_pretrained(pretrained, state_dict=registry.pretrained_state_dict(pretrained),
+                                              num_labels=num_class, **expert_kwargs(args, data_path))
+        registry.register_pretrained_state_dict(pretrained, model)
+        model = model.to(device)
+        if i > 0:
+            model = get_peft_model(model, get_lora_config())
+        registry.tie_frozen(model, models)
+        models.append(model)
+    return models
+
+
+def get_loader(dataset, subset, batch_size, max_tokens=0, shuffle=False, seed=0, workers=0, prefetch=0,
+               device=None):
+    """
+    A DataLoader over ``subset`` with fixed-size batches or, given ``max_tokens``, token-budget ones.
+    With ``prefetch`` the dataset is expected to stay on the CPU: batches are collated by ``workers``
+    processes into pinned memory and copied to ``device`` ``prefetch`` steps ahead.
+    """
+    sampler = None
+    kwargs = {}
+    if prefetch > 0:
+        kwargs = {'num_workers': workers, 'pin_memory': torch.device(device).type == 'cuda',
+                  'persistent_workers': workers > 0}
+    if max_tokens > 0:
+        sampler = TokenBudgetBatchSampler(dataset.lengths(flat_indices(subset)), max_tokens,
+                                          pad_multiple=dataset.pad_multiple, shuffle=shuffle, seed=seed)
+        loader = DataLoader(subset, batch_sampler=sampler, collate_fn=dataset.collate_fn, **kwargs)
+    elif shuffle:
+        sampler = ShuffledBatchSampler(len(subset), batch_size, seed=seed)
+        loader = DataLoader(subset, batch_sampler=sampler, collate_fn=dataset.collate_fn, **kwargs)
+    else:
+        loader = DataLoader(subset, batch_size=batch_size, collate_fn=dataset.collate_fn, **kwargs)
+    if prefetch > 0:
+        loader = Prefetcher(loader, device, prefetch)
+    return loader, sampler
+
+
+def get_runner(models, shared_trunk, fuse_contrast=False):
+    return ExpertRunner(models, lora_split_layer(LORA_TARGET_MODULES) if shared_trunk else None, fuse_contrast)
+
 
 def get_root(path_dict, n):
     ret = []
@@ -136,17 +293,6 @@ def count_parameters(model):
 def count_layer_parameters(layer):
     return sum(p.numel() for p in layer.parameters() if p.requires_grad)
 
-def get_final_output(x, y):
-    index = torch.zeros_like(x, dtype=torch.bool, device=x.device)
-    index.scatter_(1, y.data.view(-1, 1), 1)
-    index_float = index.float()
-    batch_m = torch.matmul(m_list[None, :],
-                           index_float.transpose(0, 1))
-    batch_m = batch_m.view((-1, 1))
-    x_m = x - batch_m
-    return torch.exp(
-        torch.where(index, x_m, x))
-
 def to(self, device):
     super().to(device)
     self.m_list = self.m_list.to(device)
@@ -168,73 +314,59 @@ def _hook_before_epoch(self, epoch):
             self.per_cls_weights_diversity = None
 
 
-if __name__ == '__main__':
-    torch.autograd.set_detect_anomaly = True
-    args = parser.parse_args()
-    device = args.device
+def checkpoint_dir(args, fold, folds):
+    """All checkpoints of a run, in a subdirectory per fold when several folds are trained."""
+    path = os.path.join('checkpoints', args.name)
+    return path if len(folds) == 1 else os.path.join(path, 'fold{}'.format(fold))
+
+
+def train_fold(args, fold, train_indices, dev_indices, device, save_dir):
+    """
+    Trains the experts on one fold, given as flat indices of the base dataset.
+    Every call opens the memory-mapped data itself, so folds can run in separate processes.
+
+    :return: Dict of the best dev scores of the fold and the epochs they were reached at
+    """
     accelerator = Accelerator()
-    print(args)
     if args.wandb:
         import wandb
-        wandb.init(config=args, project='htc')
+        wandb.init(config=args, project='htc', group=args.name, name='{}-fold{}'.format(args.name, fold),
+                   reinit=True)
     utils.seed_torch(args.seed)
-    args.name = args.data + '-' + args.name
-    tokenizer = AutoTokenizer.from_pretrained("./bert-base-uncased")
+    tokenizer = registry.tokenizer()
     data_path = os.path.join('data', args.data)
-    label_dict = torch.load(os.path.join(data_path, 'bert_value_dict.pt'))
+    label_dict = registry.label_dict(data_path)
     label_dict = {i: tokenizer.decode(v, skip_special_tokens=True) for i, v in label_dict.items()}
     num_class = len(label_dict)
-    dataset = BertDataset(device=device, pad_idx=tokenizer.pad_token_id, data_path=data_path)
+    dataset = BertDataset(device='cpu' if args.prefetch > 0 else device, pad_idx=tokenizer.pad_token_id,
+                          data_path=data_path,
+                          dynamic_padding=args.dynamic_padding or args.max_tokens > 0, pad_multiple=args.pad_multiple)
     ta = args.ta
     eta = args.eta
     reweight_temperature = eta
     annealing = 500
     experts = args.experts
     print(experts)
-    class_count = {}
-    for item in dataset:
-        label = item['label'].tolist()
-        for i, element in enumerate(label):
-            if i not in class_count:
-                class_count[i] = {}
-
-            if element not in class_count[i]:
-                class_count[i][element] = 1
-            else:
-                class_count[i][element] += 1
-
-    class_count_list = []
-    for class_dict in class_count.values():
-        counts = list(class_dict.values())
-        class_count_list.append(counts)
-    class_count_list = [class_count[i][1] for i in sorted(class_count.keys())]
-
+    label_index = LabelIndex.load(data_path)
 
     reweight_epoch = -2
     reweight_factor = 0.05
-    m_list = 1. / np.sqrt(np.sqrt(class_count_list))
     max_m = 0.5
-    m_list = m_list * (max_m / np.max(m_list))
-    m_list = torch.tensor(m_list, dtype=torch.float, requires_grad=False)
+    m_list = torch.tensor(label_index.ldam_margins(max_m), dtype=torch.float, requires_grad=False)
     m_list = m_list.to(device)
 
     if reweight_epoch != -1:
         idx = 1
         betas = [0, 0.9999]
-        effective_num = 1.0 - np.power(betas[idx], class_count_list)
-        per_cls_weights = (1.0 - betas[idx]) / np.array(effective_num)
-        per_cls_weights = per_cls_weights / np.sum(per_cls_weights) * len(class_count_list)
+        per_cls_weights = label_index.effective_number_weights(betas[idx])
         per_cls_weights_enabled = torch.tensor(per_cls_weights, dtype=torch.float, requires_grad=False)
-
+        per_cls_weights_enabled = per_cls_weights_enabled.to(device)
     else:
         per_cls_weights_enabled = None
-    per_cls_weights_enabled = per_cls_weights_enabled.to(device)
-    class_count_list = np.array(class_count_list) / np.sum(class_count_list)
 
-    C = len(class_count_list)
+    C = len(label_index.counts)
 
-    per_cls_weights = C * class_count_list * reweight_factor + 1 - reweight_factor
-    per_cls_weights = per_cls_weights / np.max(per_cls_weights)
+    per_cls_weights = label_index.diversity_weights(reweight_factor)
     T = (reweight_epoch + annealing) / reweight_factor
 
     per_cls_weights_enabled_diversity = torch.tensor(per_cls_weights, dtype=torch.float, requires_grad=False).to(
@@ -250,264 +382,240 @@ if __name__ == '__main__':
     models = []
     optimizers = []
     savers = []
+    checkpoint_writer = CheckpointWriter(args.save_queue)
     config = BertConfig(num_labels=num_class,
                         contrast_loss=args.contrast, graph=args.graph,
                         layer=args.layer, data_path=data_path, multi_label=args.multi,
                         lamb=args.lamb, threshold=args.thre, tau=args.tau)
-    lora_config = LoraConfig(
-        r=128,
-        lora_alpha=4096,
-        target_modules=['bert.encoder.layer.11.intermediate.dense','bert.encoder.layer.11.output.dense'],
-        lora_dropout=0.05,
-        bias="none",
-    )
-
-    for i in range(experts):
-        model = ContrastModel.from_pretrained('bert-base-uncased', num_labels=num_class,
-                                              contrast_loss=args.contrast, graph=args.graph,
-                                              layer=args.layer, data_path=data_path, multi_label=args.multi,
-                                              lamb=args.lamb, threshold=args.thre, tau=args.tau, name=args.name).to(device)
+    pretrained = 'bert-base-uncased'
+    for i, model in enumerate(build_experts(args, num_class, data_path, device, pretrained=pretrained)):
         if i == 0:
             for name, module in model.named_modules():
                 print(f"Layer Name: {name}, Layer Type: {module.__class__.__name__}")
-            print(f"Total number of parameters in the model: {count_parameters(model)}")
-            models.append(model)
-            fgm = FGM(model)
-        else:
-            model = get_peft_model(model, lora_config)
-            print(f"Total number of parameters in the model: {count_parameters(model)}")
-            models.append(model)
-            fgm = FGM(model)
+        print(f"Total number of parameters in the model: {count_parameters(model)}")
+        models.append(model)
+        fgm = FGM(model)
+        optim = FlatAdam if args.flat_adam else Adam
         if args.warmup > 0:
-            optimizer = ScheduledOptim(Adam(model.parameters(),
-                                            lr=args.lr), args.lr,
+            optimizer = ScheduledOptim(optim(model.parameters(),
+                                             lr=args.lr), args.lr,
                                        n_warmup_steps=args.warmup)
         else:
-            optimizer = Adam(model.parameters(),
-                             lr=args.lr)
+            optimizer = optim(model.parameters(),
+                              lr=args.lr)
         optimizers.append(optimizer)
 
-        saver = Saver(model, optimizer, None, args)
+        saver = Saver(model, optimizer, None, args, pretrained, checkpoint_writer)
         savers.append(saver)
 
 
     if args.wandb:
         for model in models:
             wandb.watch(model)
-
-    split = torch.load(os.path.join(data_path, 'split.pt'))
-    train1 = Subset(dataset, split['train'])
-    dev1 = Subset(dataset, split['val'])
-    dataset_size1 = len(train1)
-    combined_dataset = ConcatDataset([train1, dev1])
-    n_splits = 5
-    min_length_per_fold = len(combined_dataset) // n_splits
-    min_length_per_fold = min_length_per_fold + 1 if len(combined_dataset) % n_splits != 0 else min_length_per_fold
-
-    fold_datasets = []
-
-    split_data_count = 0
-
-    for fold in range(n_splits):
-        current_fold_length = min_length_per_fold if fold < len(
-            combined_dataset) % (n_splits) else min_length_per_fold - 1
-        current_fold_dataset = Subset(combined_dataset, range(split_data_count, split_data_count + current_fold_length))
-        fold_datasets.append(current_fold_dataset)
-        split_data_count += current_fold_length
-
-    for fold, fold_dataset in enumerate(fold_datasets):
-        if fold == 1:
-            train_indices = list(set(range(len(combined_dataset))) - set(fold_dataset.indices))
-            train_dataset = Subset(combined_dataset, train_indices)
-            train = DataLoader(train_dataset, batch_size=args.batch, shuffle=True, collate_fn=dataset.collate_fn)
-            dev = DataLoader(fold_dataset, batch_size=args.batch, shuffle=False, collate_fn=dataset.collate_fn)
+    runner = get_runner(models, args.shared_trunk, args.fuse_contrast)
+    fusion = EvidentialFusion(eta)
+    expert_loss = EvidentialExpertLoss(m_list, per_cls_weights_enabled, ta).to(device)
+
+    train, train_sampler = get_loader(dataset, Subset(dataset, train_indices), args.batch, args.max_tokens,
+                                      shuffle=True, seed=args.seed, workers=args.workers,
+                                      prefetch=args.prefetch, device=device)
+    dev, dev_sampler = get_loader(dataset, Subset(dataset, dev_indices), args.batch, args.max_tokens,
+                                  workers=args.workers, prefetch=args.prefetch, device=device)
     best_score_macro = 0
     best_score_micro = 0
+    best_epoch_macro = 0
+    best_epoch_micro = 0
     early_stop_count = 0
-    if not os.path.exists(os.path.join('checkpoints', args.name)):
-        os.mkdir(os.path.join('checkpoints', args.name))
-    log_file = open(os.path.join('checkpoints', args.name, 'log.txt'), 'w')
-    for epoch in range(1000):
+    epochs = 0
+    start_epoch = 0
+    start_step = 0
+    fold_start = time.perf_counter()
+    os.makedirs(save_dir, exist_ok=True)
+    resume_path = os.path.join(save_dir, 'resume.pt')
+    resumed = None
+
+    def save_progress(epoch, step):
+        save_resume(checkpoint_writer, resume_path, savers, epoch=epoch, step=step,
+                    best_score_macro=best_score_macro, best_score_micro=best_score_micro,
+                    best_epoch_macro=best_epoch_macro, best_epoch_micro=best_epoch_micro,
+                    early_stop_count=early_stop_count, epochs=epochs)
+
+    if args.resume and os.path.exists(resume_path):
+        resumed = load_resume(resume_path, savers)
+        start_epoch, start_step = resumed['epoch'], resumed['step']
+        best_score_macro, best_score_micro = resumed['best_score_macro'], resumed['best_score_micro']
+        best_epoch_macro, best_epoch_micro = resumed['best_epoch_macro'], resumed['best_epoch_micro']
+        early_stop_count, epochs = resumed['early_stop_count'], resumed['epochs']
+        print('resuming from epoch {} step {}'.format(start_epoch, start_step))
+    log_file = open(os.path.join(save_dir, 'log.txt'), 'a' if resumed is not None else 'w')
+    # batches whose gradients wait for the next optimizer update, a resume checkpoint would lose them
+    accumulated = 0
+    for epoch in range(start_epoch, 1000):
         if early_stop_count >= args.early_stop:
             print("Early stop!")
+            if args.save_interval > 0:
+                # a finished run resumes to the same result right away
+                save_progress(epoch, 0)
             break
         for model in models:
             model.train()
-        i = 0
+        step = start_step if epoch == start_epoch else 0
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch, step)
         loss = 0
         # Train
         pbar = tqdm(train)
+        data_time = 0
+        epoch_start = step_end = time.perf_counter()
         for data, label, idx in pbar:
-            outputs = []
+            if resumed is not None:
+                # only now, the loader has drawn its seeds for the epoch just as before the state was saved
+                utils.set_rng_state(resumed['rng'])
+                resumed = None
+            elif args.save_interval > 0 and step % args.save_interval == 0 and accumulated == 0:
+                save_progress(epoch, step)
+            data_time += time.perf_counter() - step_end
             padding_mask = data != tokenizer.pad_token_id
-            for model in models:
-                output = model(data, padding_mask, labels=label, return_dict=True, return_pooled_output=True)
-                outputs.append(output)
-            xis = [None] * len(outputs)
-            # evidential
-            for i in range(len(outputs)):
-                xis[i] = outputs[i]['logits']
-            num_classes = outputs[0]['num_labels']
-            w = [torch.ones(len(xis[0]), dtype=torch.bool, device=xis[0].device)]
-            b0 = None
-
-            for xi in xis:
-                alpha = torch.exp(xi) + 1
-                S = alpha.sum(dim=1, keepdim=True)
-                b = (alpha - 1) / S
-                u = num_classes / S.squeeze(-1)
-
-                if b0 is None:
-                    C = 0
-                else:
-                    bb = b0.view(-1, b0.shape[1], 1) @ b.view(-1, 1, b.shape[1])
-                    C = bb.sum(dim=[1, 2]) - bb.diagonal(dim1=1, dim2=2).sum(dim=1)
-                b0 = b
-                w.append(w[-1] * u / (1 - C))
-            exp_w = [torch.exp(wi / eta) for wi in w]
-            exp_w = exp_w[:-1]
-            exp_w_sum = sum(exp_w)
-            normalized_list = [x / exp_w_sum for x in exp_w]
-            exp_w = normalized_list
-            exp_w = [wi.unsqueeze(-1) for wi in exp_w]
-            reweighted_outs = []
-            for i in range(len(xis)):
-                reweighted_outs.append(xis[i] * exp_w[i])
-            xi = torch.mean(torch.stack(reweighted_outs), dim=0)
-            yi = outputs[0]['labels']
-            y = torch.argmax(yi, dim=1)
-            l_values = []
-            kl_values = []
-
-            for i in range(len(xis)):
-                alpha = get_final_output(xis[i], y)
-                S = alpha.sum(dim=1, keepdim=True)
-
-                l = F.nll_loss(torch.log(alpha) - torch.log(S), y, weight=per_cls_weights_enabled,
-                               reduction="none")
-                alpha_tilde = yi + (1 - yi) * (alpha + 1)
-                S_tilde = alpha_tilde.sum(dim=1, keepdim=True)
-                kl = torch.lgamma(S_tilde) - torch.lgamma(torch.tensor(alpha_tilde.shape[1])) - torch.lgamma(
-                    alpha_tilde).sum(dim=1, keepdim=True) \
-                     + ((alpha_tilde - 1) * (torch.digamma(alpha_tilde) - torch.digamma(S_tilde))).sum(dim=1,
-                                                                                                       keepdim=True)
-                l += epoch / T * kl.squeeze(-1)
-                l_values.append(l)
-                kl_values.append(kl)
-            w = w[:-1]
-            wmax = [0] * 9
-            batch_num_elements = w[0].numel()
-            for i in range(batch_num_elements):
-                wmax[i] = max(tensor[i].item() for tensor in w)
-
-            for i in range(len(w)):
-                for j in range(batch_num_elements):
-                    w[i][j] = w[i][j] / wmax[j]
-                w[i] = torch.where(w[i] > ta, True, False)
-                if w[i].sum() == 0:
-                    l_values[i] = 0
-                else:
-                    l_values[i] = (w[i] * l_values[i]).sum() / w[i].sum()
-
-            loss /= args.update
-            outputloss = 0
-            for i in range(len(outputs)):
-                mask = w[i].type_as(outputs[i]['loss'])
-                masked_loss = outputs[i]['loss'] * mask
-                masked_l_values = l_values[i] * mask
-                current_loss = masked_loss.sum() + masked_l_values.sum()
-                outputloss += current_loss
+            outputs = runner(data, padding_mask, labels=label, return_dict=True, return_pooled_output=True)
+            logits = torch.stack([output['logits'] for output in outputs])
+            # evidential, only used to gate the expert losses
+            prefix_weights = fusion(logits.detach())['prefix_weights']
+            outputloss = expert_loss(logits, outputs[0]['labels'], prefix_weights,
+                                     torch.stack([output['loss'] for output in outputs]), epoch / T)
             accelerator.backward(outputloss)
-            loss += outputloss.item()
-            i += 1
-            if i % args.update == 0:
+            loss += outputloss.detach()
+            step += 1
+            accumulated += 1
+            if step % args.update == 0:
                 for optimizer in optimizers:
                     optimizer.step()
                     optimizer.zero_grad()
-
+                accumulated = 0
+            if step % args.log_interval == 0:
+                loss = loss.item() / args.log_interval
                 if args.wandb:
                     wandb.log({'train_loss': loss})
                 pbar.set_description('loss:{:.4f}'.format(loss))
-                i = 0
                 loss = 0
-            torch.cuda.empty_cache()
+            step_end = time.perf_counter()
         pbar.close()
+        epoch_time = time.perf_counter() - epoch_start
+        print('epoch {} took {:.0f}s, {:.1%} waiting for data'.format(epoch, epoch_time, data_time / epoch_time))
+        print('epoch {} took {:.0f}s, {:.1%} waiting for data'.format(epoch, epoch_time, data_time / epoch_time),
+              file=log_file)
 
         for model in models:
             model.eval()
         pbar = tqdm(dev)
+        metrics = MetricAccumulator(num_class)
+        sweep = ThresholdSweep(num_class)
+        writer = None
+        if args.cache_logits is not None:
+            # committed under the checkpoint hashes if this epoch gets saved
+            writer = LogitsStore(args.cache_logits, '{}-dev-{}of{}'.format(args.data, fold, args.n_splits)).writer(
+                dev_indices, num_class, len(models), args.cache_dtype)
         with torch.no_grad():
-            truth = []
-            pred = []
             for data, label, idx in pbar:
-                outputs = []
                 padding_mask = data != tokenizer.pad_token_id
-                for model in models:
-                    output = model(data, padding_mask, labels=label, return_dict=True)
-                    outputs.append(output)
-                xis = [None] * len(outputs)
-                for i in range(len(outputs)):
-                    xis[i] = outputs[i]['logits']
-                num_classes = outputs[0]['num_labels']
-                w = [torch.ones(len(xis[0]), dtype=torch.bool, device=xis[0].device)]
-                b0 = None
-
-                for xi in xis:
-                    alpha = torch.exp(xi) + 1
-                    S = alpha.sum(dim=1, keepdim=True)
-                    b = (alpha - 1) / S
-                    u = num_classes / S.squeeze(-1)
-
-                    if b0 is None:
-                        C = 0
-                    else:
-                        bb = b0.view(-1, b0.shape[1], 1) @ b.view(-1, 1, b.shape[1])
-                        C = bb.sum(dim=[1, 2]) - bb.diagonal(dim1=1, dim2=2).sum(dim=1)
-                    b0 = b
-                    w.append(w[-1] * u / (1 - C))
-                exp_w = [torch.exp(wi / eta) for wi in w]
-                exp_w = exp_w[:-1]
-                exp_w_sum = sum(exp_w)
-                normalized_list = [x / exp_w_sum for x in exp_w]
-                exp_w = normalized_list
-                exp_w = [wi.unsqueeze(-1) for wi in exp_w]
-                reweighted_outs = []
-                for i in range(len(xis)):
-                    reweighted_outs.append(xis[i] * exp_w[i])
-                xi = torch.mean(torch.stack(reweighted_outs), dim=0)
-                for l in label:
-                    t = []
-                    for i in range(l.size(0)):
-                        if l[i].item() == 1:
-                            t.append(i)
-                    truth.append(t)
-                for l in xi:
-                    pred.append(torch.sigmoid(l).tolist())
+                outputs = runner(data, padding_mask, labels=label, return_dict=True)
+                logits = torch.stack([output['logits'] for output in outputs])
+                xi = fusion(logits)['logits']
+                metrics.update(xi, label)
+                sweep.update(xi, label)
+                if writer is not None:
+                    writer.update(idx, logits, label)
         pbar.close()
-        scores = evaluate(pred, truth, label_dict)
+        scores = metrics.compute(label_dict)
         macro_f1 = scores['macro_f1']
         micro_f1 = scores['micro_f1']
         print('macro', macro_f1, 'micro', micro_f1)
         print('macro', macro_f1, 'micro', micro_f1, file=log_file)
+        swept = sweep.compute('macro_f1')
+        swept = 'threshold {:.3f} macro {:.4f}, class thresholds macro {:.4f}'.format(
+            swept['global'], max(swept['macro_f1']), float(np.mean(swept['class_f1'])))
+        print(swept)
+        print(swept, file=log_file)
         if args.wandb:
             wandb.log({'val_macro': macro_f1, 'val_micro': micro_f1, 'best_macro': best_score_macro,
                        'best_micro': best_score_micro})
         early_stop_count += 1
+        epochs += 1
         if macro_f1 > best_score_macro:
             best_score_macro = macro_f1
+            best_epoch_macro = epoch
+            thresholds = sweep.compute('macro_f1')
+            thresholds = {'global': thresholds['global'], 'class': thresholds['class']}
+            checkpoint_paths = []
             for i, saver in enumerate(savers, start=1):
                 extra = f'_macro{i}'
-                checkpoint_path = os.path.join('checkpoints', args.name, f'checkpoint_best{extra}.pt')
-                saver(macro_f1, best_score_macro, checkpoint_path)
+                checkpoint_path = os.path.join(save_dir, f'checkpoint_best{extra}.pt')
+                saver(macro_f1, best_score_macro, checkpoint_path, thresholds, key=(i, epoch))
+                checkpoint_paths.append(checkpoint_path)
+            if writer is not None:
+                checkpoint_writer.flush()
+                writer.commit([checkpoint_hash(path) for path in checkpoint_paths], run_id(save_dir) + '_macro')
 
             early_stop_count = 0
 
         if micro_f1 > best_score_micro:
             best_score_micro = micro_f1
+            best_epoch_micro = epoch
+            thresholds = sweep.compute('micro_f1')
+            thresholds = {'global': thresholds['global'], 'class': thresholds['class']}
+            checkpoint_paths = []
             for i, saver in enumerate(savers, start=1):
                 extra = f'_micro{i}'
-                checkpoint_path = os.path.join('checkpoints', args.name, f'checkpoint_best{extra}.pt')
-                saver(micro_f1, best_score_micro, checkpoint_path)
+                checkpoint_path = os.path.join(save_dir, f'checkpoint_best{extra}.pt')
+                saver(micro_f1, best_score_micro, checkpoint_path, thresholds, key=(i, epoch))
+                checkpoint_paths.append(checkpoint_path)
+            if writer is not None:
+                checkpoint_writer.flush()
+                writer.commit([checkpoint_hash(path) for path in checkpoint_paths], run_id(save_dir) + '_micro')
 
             early_stop_count = 0
+        if writer is not None:
+            writer.close()
+    checkpoint_writer.close()
     log_file.close()
+    if args.wandb:
+        wandb.finish()
+    return {'fold': fold, 'best_macro': best_score_macro, 'best_micro': best_score_micro,
+            'best_macro_epoch': best_epoch_macro, 'best_micro_epoch': best_epoch_micro,
+            'epochs': epochs, 'time': time.perf_counter() - fold_start}
+
+
+def report_folds(results):
+    """Per-fold best scores with their mean and standard deviation over the folds."""
+    report = {'folds': sorted(results, key=lambda r: r['fold'])}
+    for key in ['best_macro', 'best_micro']:
+        values = np.array([r[key] for r in results])
+        report[key] = {'mean': float(values.mean()), 'std': float(values.std())}
+    return report
+
+
+if __name__ == '__main__':
+    torch.autograd.set_detect_anomaly = True
+    args = parser.parse_args()
+    print(args)
+    args.name = args.data + '-' + args.name
+    data_path = os.path.join('data', args.data)
+    split = torch.load(os.path.join(data_path, 'split.pt'))
+    fold_indices = kfold_indices(split, args.n_splits)
+    folds = list(range(args.n_splits)) if args.fold == -1 else [args.fold]
+    devices = args.fold_devices or [args.device]
+    jobs = [(args, fold, fold_indices[fold][0], fold_indices[fold][1], devices[i % len(devices)],
+             checkpoint_dir(args, fold, folds)) for i, fold in enumerate(folds)]
+    if args.fold_workers > 1 and len(folds) > 1:
+        # spawned workers each open the memory-mapped data, which the page cache shares between them
+        with ProcessPoolExecutor(args.fold_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(train_fold, *zip(*jobs)))
+    else:
+        results = [train_fold(*job) for job in jobs]
+    report = report_folds(results)
+    for result in report['folds']:
+        print('fold {fold}: macro {best_macro} (epoch {best_macro_epoch}), '
+              'micro {best_micro} (epoch {best_micro_epoch})'.format(**result))
+    print('macro {mean:.4f} +- {std:.4f}'.format(**report['best_macro']),
+          'micro {mean:.4f} +- {std:.4f}'.format(**report['best_micro']))
+    with open(os.path.join('checkpoints', args.name, 'folds.json'), 'w') as f:
+        json.dump(report, f, indent=2)
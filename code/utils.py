@@ -12,5 +12,19 @@ def seed_torch(seed=1029):
     torch.backends.cudnn.deterministic = False
 
 
+def rng_state():
+    """The state of every random number generator seed_torch seeds."""
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda']:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
 # seed_torch(3)
 # print('Set seed to 3.')